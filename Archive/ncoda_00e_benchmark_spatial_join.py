@@ -0,0 +1,84 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Benchmark of the bulk and loop methods of spatial_join_points_to_poly
+in pyncoda.ncoda_00e_geoutilities.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pyncoda.ncoda_00e_geoutilities import spatial_join_points_to_poly
+
+def benchmark_spatial_join(n_side: int = 100,
+                           n_points: int = 200000,
+                           run_loop: bool = True,
+                           seed: int = 1234):
+    """
+    Benchmark bulk and loop spatial join on a synthetic grid of
+    n_side x n_side square polygons and random points.
+    Ten percent of the points are placed on shared polygon edges
+    to check the tie break.
+
+    Run from the repository folder:
+        python Archive/ncoda_00e_benchmark_spatial_join.py
+    """
+    random_generator = np.random.RandomState(seed)
+    cell = 0.01
+    x0, y0 = -97.0, 30.0
+    col, row = np.meshgrid(np.arange(n_side), np.arange(n_side))
+    col = col.ravel()
+    row = row.ravel()
+    polygons = shapely.box(x0 + col*cell, y0 + row*cell,
+                           x0 + (col+1)*cell, y0 + (row+1)*cell)
+    polygon_gdf = gpd.GeoDataFrame({'GEOID' : ['P'+str(i).zfill(6) for i in range(polygons.shape[0])]},
+                                   geometry = polygons, crs = "epsg:4326")
+
+    x = x0 + random_generator.uniform(0, n_side*cell, n_points)
+    y = y0 + random_generator.uniform(0, n_side*cell, n_points)
+    on_edge = random_generator.uniform(size = n_points) < 0.1
+    x[on_edge] = x0 + np.round((x[on_edge] - x0) / cell) * cell
+    points = shapely.points(x, y)
+    points_gdf = gpd.GeoDataFrame({'pointid' : np.arange(n_points)},
+                                  geometry = points, crs = "epsg:4326")
+    points_gdf['pnt_geometry'] = gpd.GeoSeries(points, crs = "epsg:4326")
+    points_gdf['poly_geometry'] = points_gdf['pnt_geometry']
+
+    results = []
+    output = {}
+    methods = ['bulk', 'loop'] if run_loop else ['bulk']
+    for method in methods:
+        start = time.time()
+        output[method] = spatial_join_points_to_poly(points_gdf, polygon_gdf,
+                            point_var = 'pnt_geometry',
+                            poly_var = 'poly_geometry',
+                            geolevel = 'grid',
+                            join_column_list = ['GEOID'],
+                            method = method)
+        results.append({'method' : method,
+                        'polygons' : polygon_gdf.shape[0],
+                        'points' : n_points,
+                        'seconds' : time.time() - start})
+
+    results = pd.DataFrame(results)
+    print("")
+    print(results.to_string(index = False))
+    if 'loop' in output:
+        same = output['bulk']['gridGEOID'].equals(output['loop']['gridGEOID'])
+        print("Speedup: %5.1f" % (results['seconds'].iloc[1] / results['seconds'].iloc[0]))
+        print("Bulk and loop results are identical:",same)
+
+    return results
+
+if __name__ == "__main__":
+    benchmark_spatial_join()
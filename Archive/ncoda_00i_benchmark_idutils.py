@@ -0,0 +1,78 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Benchmark of the vectorized id functions in pyncoda.ncoda_00i_idutils
+against the row-wise apply they replace.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pyncoda.ncoda_00i_idutils import counter_maxdigits, make_geoid, \
+    zfill_str, make_uniqueid
+
+def benchmark_id_construction(n_rows: int = 5000000,
+                              n_blocks: int = 20000,
+                              legacy_rows: int = 200000,
+                              seed: int = 1234):
+    """
+    Micro-benchmark of row-wise apply against the vectorized functions
+    on a synthetic housing unit inventory.
+
+    The row-wise version is timed on the first legacy_rows rows and scaled
+    to n_rows - running apply on 5 million rows takes several minutes.
+    Both versions are checked for identical ids on the legacy rows.
+
+    Run from the repository folder:
+        python Archive/ncoda_00i_benchmark_idutils.py
+    """
+    print("Building synthetic inventory with",n_rows,"rows in",n_blocks,"blocks.")
+    random_generator = np.random.RandomState(seed)
+    block_row = np.sort(random_generator.randint(0, n_blocks, n_rows))
+    df = pd.DataFrame({'state' : '48',
+                       'county' : '167',
+                       'tract' : (720100 + block_row // 100).astype(str),
+                       'block' : (1000 + block_row % 100).astype(str)})
+    df['hu_counter'] = df.groupby(block_row).cumcount() + 1
+    counter_digits = counter_maxdigits(df['hu_counter'])
+
+    legacy_df = df.iloc[:legacy_rows].copy()
+    start = time.time()
+    for geo_level, length in {'state':2, 'county':3, 'tract':6, 'block':4}.items():
+        legacy_df[geo_level] = legacy_df[geo_level].apply(lambda x: str(x).zfill(length))
+    legacy_df['Block2010'] = legacy_df['state'] + legacy_df['county'] + \
+        legacy_df['tract'] + legacy_df['block']
+    legacy_df['Block2010str'] = legacy_df['Block2010'].apply(lambda x: "B"+str(x).zfill(15))
+    legacy_df['huid'] = legacy_df.apply(lambda x: x['Block2010str'] + "H" +
+                            str(x['hu_counter']).zfill(counter_digits), axis=1)
+    legacy_time = time.time() - start
+    legacy_time_scaled = legacy_time * n_rows / max(legacy_rows, 1)
+
+    start = time.time()
+    padded, geoid = make_geoid(df)
+    block_str = "B" + zfill_str(geoid, 15)
+    huid = make_uniqueid(block_str, df['hu_counter'], counter_digits, "H")
+    vectorized_time = time.time() - start
+
+    same_ids = (huid.iloc[:legacy_rows].values == legacy_df['huid'].values).all()
+    results = pd.DataFrame({
+        'method' : ['row-wise apply', 'vectorized'],
+        'rows timed' : [legacy_rows, n_rows],
+        'seconds' : [legacy_time, vectorized_time],
+        f'seconds for {n_rows} rows' : [legacy_time_scaled, vectorized_time]})
+    print(results.to_string(index=False))
+    print("Speedup: %5.1f" % (legacy_time_scaled / max(vectorized_time, 1e-9)))
+    print("Identical ids on the first",legacy_rows,"rows:",same_ids)
+
+    return results
+
+if __name__ == "__main__":
+    benchmark_id_construction()
@@ -4,7 +4,6 @@
 # terms of the Mozilla Public License v2.0 which accompanies this distribution,
 # and is available at https://www.mozilla.org/en-US/MPL/2.0/
 
-import requests # Census API Calls
 import os  # Operating System (os) For folders and finding working directory
 import pandas as pd
 import sys  # saving CSV files
@@ -12,10 +11,88 @@ import json  # used to read in Census variables
 
 from pyncoda.CommunitySourceData.api_census_gov.acg_00b_hui_block2010 import *
 from pyncoda.CommunitySourceData.api_census_gov.acg_00c_hispan_block2010 import *
+from pyncoda.ncoda_00i_idutils import make_geoid, make_uniqueid, zfill_str
+from pyncoda.CommunitySourceData.api_census_gov.acg_01c_CensusAPIFetcher \
+    import CensusAPIFetcher
+from pyncoda.ncoda_00l_stagecache import stage_manifest, stage_cache_hit, \
+    read_stage, save_stage
+
+# One fetcher per cache folder - shares connection pool and rate limit
+census_api_fetchers = {}
 
 class BaseInventory():
     """Utility methods for generating Housing Unit Inventory or Person Record Inventory"""
 
+    @staticmethod
+    def census_api_fetcher(outputfolders):
+        """
+        Census API fetcher for the output folders.
+        The cache is shared across communities when outputfolders
+        includes CensusAPICache (see directory_design).
+        """
+        if 'CensusAPICache' in outputfolders:
+            cache_folder = outputfolders['CensusAPICache']
+        else:
+            cache_folder = outputfolders['CommunitySourceData']+'/api_census_gov/cache'
+        if cache_folder not in census_api_fetchers:
+            census_api_fetchers[cache_folder] = CensusAPIFetcher(cache_folder = cache_folder)
+
+        return census_api_fetchers[cache_folder]
+
+    @staticmethod
+    def census_api_json_filepath(state_county: str, vintage: str, var_stem: str,
+                                 outputfolders):
+        """
+        JSON file with the Census API table for a county - see obtain_census_api
+        """
+        json_filename = f'{var_stem}_{state_county}_{vintage}'
+        censusapi_folder = outputfolders['CommunitySourceData']+'/api_census_gov'
+
+        return censusapi_folder+"/"+json_filename+'.json'
+
+    @staticmethod
+    def varstems_api_requests(state_county: str, varstems_roots_dictionary: dict,
+                              outputfolders = None):
+        """
+        List of Census API requests for a dictionary of varstems and roots.
+        Used to obtain all tables at once before the tables are reshaped.
+        outputfolders: skip tables that are already saved as county JSON files
+        """
+        vintage         = varstems_roots_dictionary['metadata']['vintage']
+        dataset_name    = varstems_roots_dictionary['metadata']['dataset_name']
+        for_geography   = varstems_roots_dictionary['metadata']['for_geography']
+        char_vars       = varstems_roots_dictionary['metadata']['char_vars']
+        if 'byracehispan' in char_vars:
+            racehispn_groups_dictionary = varstems_roots_dictionary['metadata']['byracehispan']
+        else:
+            racehispn_groups_dictionary = {'' : {'Label' : 'Race and Hispanic Not Applicable'}}
+
+        api_requests = []
+        for varstem in varstems_roots_dictionary:
+            if varstem == 'metadata':
+                continue
+            varoortlist = varstems_roots_dictionary[varstem]
+            varstem_api = varstem
+            # remove _part substring and part number from varstem
+            if '_part' in varstem:
+                varstem = varstem.replace('_part'+varstem[-2:],'')
+            for racehispangroup in racehispn_groups_dictionary:
+                if (outputfolders is not None) and os.path.exists(
+                    BaseInventory.census_api_json_filepath(state_county, vintage,
+                                        varstem_api+racehispangroup, outputfolders)):
+                    continue
+                varstem_race = varstem + racehispangroup
+                get_vars = ','.join(['GEO_ID'] + [varstem_race+varroot_str
+                                                  for varroot_str in varoortlist])
+                api_requests.append({'vintage' : vintage,
+                                     'dataset_name' : dataset_name,
+                                     'get_vars' : get_vars,
+                                     'state' : state_county[0:2],
+                                     'county' : state_county[2:5],
+                                     'for_geography' : for_geography})
+
+        return api_requests
+
 
     @staticmethod
     def get_data_based_on_varstems_and_roots(state_county: str, 
@@ -54,13 +131,24 @@ class BaseInventory():
         csv_filename = f'{group}_{state_county}_{vintage}'
         csv_filepath = outputfolders['TidyCommunitySourceData']+"/"+csv_filename+'.csv'
         
-        # Check if selected data already exists - if yes read in saved file
-        if os.path.exists(csv_filepath):
-            df = pd.read_csv(csv_filepath, low_memory=False) 
+        # Check if selected data already exists with the same inputs - if yes read in saved file
+        manifest = stage_manifest('get_data_based_on_varstems_and_roots',
+                        params = {'state_county' : state_county,
+                                  'varstems_roots_dictionary' : varstems_roots_dictionary},
+                        code = [BaseInventory.get_data_based_on_varstems_and_roots])
+        if stage_cache_hit(outputfolders['TidyCommunitySourceData'], csv_filename, manifest):
+            df = read_stage(outputfolders['TidyCommunitySourceData'], csv_filename)
             # If file already exists return csv as dataframe
             print("File",csv_filepath,"Already exists - Skipping API Call.")
             return df
 
+        # Obtain all tables for the varstems at once with a thread pool
+        # the loop below reads the tables from the cache
+        census_api_fetcher = BaseInventory.census_api_fetcher(outputfolders)
+        census_api_fetcher.fetch_many(BaseInventory.varstems_api_requests(
+                                            state_county, varstems_roots_dictionary,
+                                            outputfolders))
+
         df_varstems = [] # Create empty list to append each group of variables
         for varstem in varstems_roots_dictionary:
             #print(varstem)
@@ -100,9 +188,9 @@ class BaseInventory():
                 # this also helps to identify household characteristics by steps
 
                 # Start list of variables to get
+                # Census API has a limit of 50 variables -
+                # CensusAPIFetcher splits longer lists into batches
                 get_vars = 'GEO_ID'
-                # Census API has a limit of 50 variables
-                get_var_count = 1 
 
                 # add race letter to variable stem
                 varstem_race = varstem + racehispangroup
@@ -117,10 +205,6 @@ class BaseInventory():
                     #print(varroot)
                     # Variable parameters
                     get_vars = get_vars + ','+varstem_race+varroot_str
-                    get_var_count = get_var_count + 1
-                    if get_var_count > 50:
-                        print("too many variables")
-                        return 
                 
                 df[racehispangroup] = BaseInventory.obtain_census_api(state_county = state_county,
                                                         vintage = vintage, 
@@ -202,9 +286,8 @@ class BaseInventory():
         # Drop precode variable
         df_return = df_return.drop(columns=['precode'])
 
-        # Save File as CSV
-        savefile = os.path.join(os.getcwd(), csv_filepath)
-        df_return.to_csv(savefile, index=False)
+        # Save File as Parquet (CSV if pyarrow is not installed)
+        save_stage(df_return, outputfolders['TidyCommunitySourceData'], csv_filename, manifest)
         
         return df_return
 
@@ -242,12 +325,19 @@ class BaseInventory():
         csv_filename = f'{outputfile}_{state_county}_{vintage}'
         csv_filepath = outputfolders['BaseInventory']+"/"+csv_filename+'.csv'
 
-        # Check if selected data already exists - if yes read in saved file
-        if os.path.exists(csv_filepath):
-            df = pd.read_csv(csv_filepath, 
+        # Check if selected data already exists with the same inputs - if yes read in saved file
+        manifest = stage_manifest('get_apidata',
+                        params = {'state_county' : state_county,
+                                  'geo_level' : geo_level,
+                                  'vintage' : vintage,
+                                  'mutually_exclusive_varstems_roots_dictionaries' :
+                                    mutually_exclusive_varstems_roots_dictionaries},
+                        code = [BaseInventory.get_apidata])
+        if stage_cache_hit(outputfolders['BaseInventory'], csv_filename, manifest):
+            df = read_stage(outputfolders['BaseInventory'], csv_filename,
                     dtype={
                             geo_level+vintage: str
-                        }, low_memory=False)
+                        })
             # If file already exists return csv as dataframe
             print("File",csv_filepath,"Already exists - Skipping API Call.")
             return df
@@ -307,8 +397,9 @@ class BaseInventory():
             # Generate unique ID
             counter_var_max = df[counter_var].max()
             counter_var_maxdigits = len(str(counter_var_max))
-            df.loc[:,primary_key] = df.apply(lambda x: x[geolevel+vintage+'str'] + id_type +
-                                            str(x[counter_var]).zfill(counter_var_maxdigits), axis=1)
+            df.loc[:,primary_key] = make_uniqueid(df[geolevel+vintage+'str'],
+                                            df[counter_var],
+                                            counter_var_maxdigits, id_type)
                                                 
             # Reorder columns
             primary_key_list = [primary_key]
@@ -318,8 +409,7 @@ class BaseInventory():
             col_list = primary_key_list + foreign_keys + char_vars
             df = df[col_list]
 
-        savefile = os.path.join(os.getcwd(), csv_filepath)
-        df.to_csv(savefile, index=False)
+        save_stage(df, outputfolders['BaseInventory'], csv_filename, manifest)
 
         return df
 
@@ -356,18 +446,16 @@ class BaseInventory():
         #logger.debug('State:  '+state)
         #logger.debug('County: '+county)
 
-        # Check if final CSV file has already been selected
-        json_filename = f'{var_stem}_{state_county}_{vintage}'
+        # Check if data has already been downloaded
+        json_filepath = BaseInventory.census_api_json_filepath(state_county,
+                                        vintage, var_stem, outputfolders)
 
         # Add Source Data folder for Census API
-        censusapi_folder = outputfolders['CommunitySourceData']+'/api_census_gov'
+        censusapi_folder = os.path.dirname(json_filepath)
         # Make directory to save output
         if not os.path.exists(censusapi_folder):
             os.mkdir(censusapi_folder)
 
-        # Check if data has already been downloaded
-        json_filepath = censusapi_folder+"/"+json_filename+'.json'
-
         # Check if selected data already exists - if yes read in saved file
         if os.path.exists(json_filepath):
              # reading the data from the file
@@ -378,26 +466,22 @@ class BaseInventory():
             df = pd.DataFrame(columns=data[0], data=data[1:])
             return df
 
-        # Set up hyperlink for Census API
-        api_hyperlink = ('https://api.census.gov/data/' + vintage + '/'+dataset_name + '?get=' + get_vars +
-                        '&in=state:' + state + '&in=county:' + county + '&for='+for_geography)
-
-        print("       Census API data from: " + api_hyperlink)
-
-        # Obtain Census API JSON Data
-        apijson = requests.get(api_hyperlink)
-        if apijson.status_code != 200:
-            print("API status code:",apijson.status_code)
-            error_msg = "Failed to download the data from Census API."
-            #logger.error(error_msg)
-            raise Exception(error_msg)
+        # Obtain Census API JSON Data - fetcher retries failed calls
+        # and reads the shared cache if another community made the same call
+        census_api_fetcher = BaseInventory.census_api_fetcher(outputfolders)
+        data = census_api_fetcher.fetch_json(vintage = vintage,
+                                             dataset_name = dataset_name,
+                                             get_vars = get_vars,
+                                             state = state,
+                                             county = county,
+                                             for_geography = for_geography)
 
         # Convert the requested json into pandas dataframe
-        df = pd.DataFrame(columns=apijson.json()[0], data=apijson.json()[1:])
+        df = pd.DataFrame(columns=data[0], data=data[1:])
         
         # save json as text file
         with open(json_filepath, 'w') as convert_file:
-            json.dump(apijson.json(),convert_file)
+            json.dump(data,convert_file)
 
         return df
 
@@ -412,18 +496,17 @@ class BaseInventory():
                       'county': {'len' : 3},
                       'tract':  {'len' : 6},
                       'block':  {'len' : 4}}
+        # Each geolevel is a zero padded string
+        padded, geoid = make_geoid(df, {geo_level : geo_levels[geo_level]['len']
+                                        for geo_level in geo_levels})
         for geo_level in geo_levels:
-            # Each geolevel is a zero padded string
-            len = geo_levels[geo_level]['len']
-            df.loc[:,geo_level] =  df[geo_level].apply(lambda x: str(x).zfill(len))
+            df[geo_level] = padded[geo_level]
 
-        df.loc[:,geolevel+year] = (df['state']+df['county'] +
-                                df['tract']+df['block'])
+        df.loc[:,geolevel+year] = geoid
 
         # To avoid problems with how the block group id is read saving it
         # as a string will reduce possibility for future errors
-        df.loc[:,geolevel+year+'str'] = df[geolevel+year].apply(
-            lambda x: "B"+str(x).zfill(15))
+        df.loc[:,geolevel+year+'str'] = "B" + zfill_str(df[geolevel+year], 15).values
         
         return df
 
@@ -559,9 +642,17 @@ class BaseInventory():
         csv_filename = f'{outputfile}_{new_char}_{state_county}_{basevintage}'
         csv_filepath = outputfolders['BaseInventory']+"/"+csv_filename+'.csv'
 
-        # Check if selected data already exists - if yes read in saved file
-        if os.path.exists(csv_filepath):
-            expanded_hui = pd.read_csv(csv_filepath, 
+        # Check if selected data already exists with the same inputs - if yes read in saved file
+        manifest = stage_manifest('graft_on_new_char',
+                        params = {'state_county' : state_county,
+                                  'new_char' : new_char,
+                                  'new_char_dictionaries' : new_char_dictionaries,
+                                  'basevintage' : basevintage,
+                                  'basegeolevel' : basegeolevel},
+                        inputs = {'base_inventory' : base_inventory},
+                        code = [BaseInventory.graft_on_new_char])
+        if stage_cache_hit(outputfolders['BaseInventory'], csv_filename, manifest):
+            expanded_hui = read_stage(outputfolders['BaseInventory'], csv_filename,
                     dtype={
                             basegeolevel+basevintage: str
                         })
@@ -941,8 +1032,7 @@ class BaseInventory():
                 new_char+" set 1 by greater than counter "+newchar_var
             expanded_hui_recombine.loc[conditions, new_char+'_flagset'] = 1
         
-        savefile = os.path.join(os.getcwd(), csv_filepath)
-        expanded_hui_recombine.to_csv(savefile, index=False)
+        save_stage(expanded_hui_recombine, outputfolders['BaseInventory'], csv_filename, manifest)
 
         return expanded_hui_recombine
 
@@ -0,0 +1,386 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+import os  # Operating System (os) For folders and finding working directory
+import json  # used to read in Census variables
+import time
+import hashlib
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests # Census API Calls
+import pandas as pd
+
+class CensusAPIFetcher():
+    """
+    Concurrent, rate limited Census API fetcher with an on disk cache.
+
+    - One requests.Session with a connection pool is shared by all threads.
+    - At most max_workers requests run at the same time and no more than
+      requests_per_second requests are started each second.
+    - Failed requests (429, 5xx, connection errors) are retried with
+      exponential backoff.
+    - The Census API allows 50 variables per call. Longer variable lists
+      are split into batches and merged on GEO_ID.
+    - Each batch response is saved as JSON in the cache folder. The file
+      name is a hash of vintage, dataset, variables (sorted) and geography
+      so the same request from another community reads the saved file.
+
+    Offline testing - StubCensusServer replays a cache folder:
+        server = StubCensusServer(replay_folder = cache_folder)
+        server.start()
+        fetcher = CensusAPIFetcher(cache_folder = new_folder,
+                                   base_url = server.base_url)
+    """
+
+    # Census API limit on the number of variables in one call
+    max_vars_per_call = 50
+    retry_status_codes = [429, 500, 502, 503, 504]
+
+    def __init__(self,
+            cache_folder: str = 'CensusAPICache',
+            base_url: str = 'https://api.census.gov/data',
+            api_key: str = None,
+            max_workers: int = 8,
+            requests_per_second: float = 10,
+            max_retries: int = 5,
+            backoff_factor: float = 1.0,
+            timeout: float = 60):
+
+        self.cache_folder = cache_folder
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_workers = max_workers
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+
+        # Connection pool sized for the number of threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers,
+                                                pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._rate_lock = threading.Lock()
+        self._next_request_time = 0.0
+        # Threads asking for the same table wait for the first download
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+
+        # Make directory to save output
+        if not os.path.exists(self.cache_folder):
+            os.makedirs(self.cache_folder, exist_ok = True)
+
+    @staticmethod
+    def split_get_vars(get_vars):
+        """
+        List of variables from comma separated string - GEO_ID is removed
+        """
+        if isinstance(get_vars, str):
+            get_vars = get_vars.split(',')
+        return [var for var in get_vars if var not in ['GEO_ID', '']]
+
+    @staticmethod
+    def cache_key(vintage: str, dataset_name: str, get_vars,
+                  state: str, county: str, for_geography: str):
+        """
+        Hash of the request - same variables in any order have the same key
+        """
+        request = {'vintage' : str(vintage),
+                   'dataset_name' : dataset_name,
+                   'get_vars' : sorted(CensusAPIFetcher.split_get_vars(get_vars)),
+                   'state' : state,
+                   'county' : county,
+                   'for_geography' : for_geography}
+        request_str = json.dumps(request, sort_keys = True)
+
+        return hashlib.sha256(request_str.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def cache_filepath(cache_folder: str, key: str):
+        """
+        Cache files are stored in sub folders by first two characters of key
+        """
+        return os.path.join(cache_folder, key[0:2], key+'.json')
+
+    @staticmethod
+    def reorder_columns(data, get_vars):
+        """
+        Reorder JSON table so that columns follow the requested variables.
+        Geography columns (state, county, tract, block) stay at the end.
+        """
+        header = data[0]
+        requested = ['GEO_ID'] + CensusAPIFetcher.split_get_vars(get_vars)
+        requested = [var for var in requested if var in header]
+        col_order = requested + [col for col in header if col not in requested]
+        col_index = [header.index(col) for col in col_order]
+
+        return [[row[i] for i in col_index] for row in data]
+
+    def api_hyperlink(self, vintage, dataset_name, get_vars, state, county, for_geography):
+        """
+        Set up hyperlink for Census API
+        """
+        api_hyperlink = (self.base_url + '/' + str(vintage) + '/' + dataset_name +
+                         '?get=' + get_vars + '&in=state:' + state +
+                         '&in=county:' + county + '&for=' + for_geography)
+        if self.api_key is not None:
+            api_hyperlink = api_hyperlink + '&key=' + self.api_key
+
+        return api_hyperlink
+
+    def wait_for_rate_limit(self):
+        """
+        Space out the start of requests across threads
+        """
+        if self.requests_per_second is None or self.requests_per_second <= 0:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait_time = self._next_request_time - now
+            self._next_request_time = max(now, self._next_request_time) + \
+                1.0 / self.requests_per_second
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def get_with_retry(self, api_hyperlink: str):
+        """
+        Obtain Census API JSON Data - retry with exponential backoff
+        """
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_rate_limit()
+            try:
+                apijson = self.session.get(api_hyperlink, timeout = self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                print("       Census API connection error:",e)
+                apijson = None
+
+            if apijson is not None and apijson.status_code == 200:
+                return apijson.json()
+            if apijson is not None and \
+                apijson.status_code not in self.retry_status_codes:
+                break
+
+            if attempt < self.max_retries:
+                wait_time = self.backoff_factor * 2**attempt
+                if apijson is not None and 'Retry-After' in apijson.headers:
+                    try:
+                        wait_time = max(wait_time, float(apijson.headers['Retry-After']))
+                    except ValueError:
+                        pass
+                print("       Retry",attempt+1,"of",self.max_retries,
+                      "in",wait_time,"seconds.")
+                time.sleep(wait_time)
+
+        if apijson is not None:
+            print("API status code:",apijson.status_code)
+        error_msg = "Failed to download the data from Census API."
+        raise Exception(error_msg)
+
+    def fetch_batch(self, vintage, dataset_name, get_vars: list,
+                    state, county, for_geography):
+        """
+        Obtain one call with 50 or fewer variables - read from cache if saved
+        """
+        key = self.cache_key(vintage, dataset_name, get_vars,
+                             state, county, for_geography)
+        json_filepath = self.cache_filepath(self.cache_folder, key)
+        with self._key_locks_lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Check if data has already been downloaded
+            if os.path.exists(json_filepath):
+                with open(json_filepath) as f:
+                    data = json.load(f)
+                return self.reorder_columns(data, get_vars)
+
+            data = self.download_batch(vintage, dataset_name, get_vars,
+                                       state, county, for_geography, json_filepath)
+
+        return self.reorder_columns(data, get_vars)
+
+    def download_batch(self, vintage, dataset_name, get_vars: list,
+                       state, county, for_geography, json_filepath: str):
+        """
+        Download one call and save the JSON in the cache
+        """
+        get_vars_str = ','.join(['GEO_ID'] + get_vars)
+        api_hyperlink = self.api_hyperlink(vintage, dataset_name, get_vars_str,
+                                           state, county, for_geography)
+        print("       Census API data from: " + api_hyperlink)
+        data = self.get_with_retry(api_hyperlink)
+
+        # save json - write to temporary file first so threads
+        # never read a partial file
+        os.makedirs(os.path.dirname(json_filepath), exist_ok = True)
+        temp_filepath = json_filepath+'.'+str(threading.get_ident())+'.tmp'
+        with open(temp_filepath, 'w') as convert_file:
+            json.dump(data, convert_file)
+        os.replace(temp_filepath, json_filepath)
+
+        return data
+
+    def fetch_json(self,
+            vintage: str = "2010",
+            dataset_name: str = 'dec/sf1',
+            get_vars: str = 'GEO_ID',
+            state: str = '48',
+            county: str = '167',
+            for_geography: str = 'block:*'):
+        """
+        Census API JSON table (list of rows with header row first).
+        Variable lists longer than the API limit are split into batches
+        and the batches are merged on GEO_ID.
+        """
+        var_list = self.split_get_vars(get_vars)
+        batch_size = self.max_vars_per_call - 1
+        batches = [var_list[i:i+batch_size]
+                   for i in range(0, max(len(var_list), 1), batch_size)]
+
+        data = None
+        for batch in batches:
+            batch_data = self.fetch_batch(vintage, dataset_name, batch,
+                                          state, county, for_geography)
+            if data is None:
+                data = batch_data
+                continue
+            # Add batch variables to rows with the same GEO_ID
+            batch_rows = {row[0] : row[1:len(batch)+1] for row in batch_data[1:]}
+            geography_cols = data[0][len(data[0]) - (len(batch_data[0]) - len(batch) - 1):]
+            header = data[0][:len(data[0]) - len(geography_cols)]
+            new_data = [header + batch + geography_cols]
+            for row in data[1:]:
+                new_data.append(row[:len(header)] +
+                                batch_rows.get(row[0], [None]*len(batch)) +
+                                row[len(header):])
+            data = new_data
+
+        return data
+
+    def fetch(self,
+            vintage: str = "2010",
+            dataset_name: str = 'dec/sf1',
+            get_vars: str = 'GEO_ID',
+            state: str = '48',
+            county: str = '167',
+            for_geography: str = 'block:*'):
+        """
+        Census API data as a pandas dataframe
+        """
+        data = self.fetch_json(vintage, dataset_name, get_vars,
+                               state, county, for_geography)
+
+        # Convert the requested json into pandas dataframe
+        return pd.DataFrame(columns=data[0], data=data[1:])
+
+    def fetch_many(self, api_requests: list):
+        """
+        Run a list of requests with a thread pool.
+        Each request is a dictionary with the arguments for fetch_json.
+        Returns a list of JSON tables in the same order as the requests.
+        """
+        if len(api_requests) == 0:
+            return []
+
+        print("\n**********************************")
+        print("Obtain",len(api_requests),"Census API tables with",
+              self.max_workers,"workers")
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            futures = [executor.submit(self.fetch_json, **api_request)
+                       for api_request in api_requests]
+            results = [future.result() for future in futures]
+
+        return results
+
+
+class StubCensusServer():
+    """
+    Local HTTP server that replays recorded Census API JSON.
+    replay_folder is a CensusAPIFetcher cache folder. Requests that are
+    not in the folder return 404.
+    fail_first_requests: number of requests that return 503 before
+        replaying - used to check retry and backoff.
+    """
+
+    def __init__(self, replay_folder: str, port: int = 0,
+                 fail_first_requests: int = 0):
+        self.replay_folder = replay_folder
+        self.port = port
+        self.fail_first_requests = fail_first_requests
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def make_handler(self):
+        stub = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status_code: int, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.request_count += 1
+                    request_count = stub.request_count
+                if request_count <= stub.fail_first_requests:
+                    self.send_json(503, {'error' : 'stub failure'})
+                    return
+
+                parsed = urllib.parse.urlparse(self.path)
+                # path is /data/<vintage>/<dataset_name>
+                path_parts = parsed.path.strip('/').split('/')
+                vintage = path_parts[1]
+                dataset_name = '/'.join(path_parts[2:])
+                query = urllib.parse.parse_qs(parsed.query)
+                get_vars = query['get'][0]
+                in_geography = dict(value.split(':') for value in query['in'])
+
+                key = CensusAPIFetcher.cache_key(vintage, dataset_name, get_vars,
+                                                 in_geography['state'],
+                                                 in_geography['county'],
+                                                 query['for'][0])
+                json_filepath = CensusAPIFetcher.cache_filepath(stub.replay_folder, key)
+                if not os.path.exists(json_filepath):
+                    self.send_json(404, {'error' : 'not recorded'})
+                    return
+                with open(json_filepath) as f:
+                    data = json.load(f)
+                self.send_json(200, CensusAPIFetcher.reorder_columns(data, get_vars))
+
+        return StubHandler
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:'+str(self._server.server_address[1])+'/data'
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port),
+                                           self.make_handler())
+        self._thread = threading.Thread(target = self._server.serve_forever,
+                                        daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
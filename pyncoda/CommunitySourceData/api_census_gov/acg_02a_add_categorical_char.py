@@ -6,11 +6,20 @@
 
 import requests # Census API Calls
 import os  # Operating System (os) For folders and finding working directory
+import numpy as np
 import pandas as pd
 import sys  # saving CSV files
+import json  # round checkpoint state
+import hashlib
 
 from pyncoda.CommunitySourceData.api_census_gov.acg_00b_hui_block2010 import *
 from pyncoda.CommunitySourceData.api_census_gov.acg_00c_hispan_block2010 import *
+from pyncoda.ncoda_00i_idutils import make_uniqueid
+from pyncoda.ncoda_00k_geokeys import geokey_index
+from pyncoda.ncoda_00j_checkpoint import checkpoint_exists, read_checkpoint, \
+    save_checkpoint, remove_checkpoint
+from pyncoda.ncoda_00l_stagecache import stage_manifest, stage_cache_hit, \
+    read_stage, save_stage
 
 class add_new_char_by_random_merge_2dfs():
     """"
@@ -29,6 +38,28 @@ class add_new_char_by_random_merge_2dfs():
     For example, the group B19001 has all households (family and non-family.)
     The group B19101 has family households. Merging the 2 groups creates a new group
     that identifies families and non-families.
+
+    engine: "pandas" (default) sorts and merges each group with pd.merge.
+        "numpy" encodes the group by variables as integer codes once and
+        pairs the k-th random primary row with the k-th random secondary row
+        using argsort/searchsorted. Both engines give the same result for
+        a given seed.
+        "partitioned" draws the random numbers separately for each geovar
+        value of the round (rows are only paired within the same geovar).
+        Random numbers come from a counter-based generator (Philox) keyed
+        by the seed, round and geovar value, so the draw for one tract or
+        block does not change when other geographies are added or removed.
+        It is a different random draw than the pandas and numpy engines
+        and is not faster than the numpy engine.
+    round_checkpoints: when savefiles is True the flags, new characteristic
+        and round counter are saved before each geo level of
+        run_random_merge_2dfs. An interrupted run resumes from the last
+        saved geo level if the inputs have not changed. Round checkpoints
+        are deleted when the merge finishes.
+    keep_round_checkpoints: number of round checkpoints kept on disk
+    incremental_flags: keep the rows without the geovar flag set as an
+        index and only update flags for those rows and the rows matched by
+        the merge. Set to False for the full table flag passes.
     """
 
     def __init__(self,
@@ -46,7 +77,11 @@ class add_new_char_by_random_merge_2dfs():
         outputfolder: str = "",
         check_merge: str = "check_merge",
         reuse_secondary: bool = False,
-        savefiles: bool = True):
+        savefiles: bool = True,
+        engine: str = "pandas",
+        round_checkpoints: bool = True,
+        keep_round_checkpoints: int = 1,
+        incremental_flags: bool = True):
 
         self.seed = seed
         self.dfs = dfs
@@ -60,6 +95,14 @@ class add_new_char_by_random_merge_2dfs():
         self.check_merge = check_merge
         self.reuse_secondary = reuse_secondary
         self.savefiles = savefiles
+        if engine not in ["pandas", "numpy", "partitioned"]:
+            raise ValueError(f"Random merge engine must be pandas, numpy or partitioned, not {engine}")
+        self.engine = engine
+        self.round_checkpoints = round_checkpoints
+        self.keep_round_checkpoints = max(keep_round_checkpoints, 1)
+        self.incremental_flags = incremental_flags
+        # Rows without flags set by data key - see init_flag_state
+        self.flag_state = {}
 
         # Variables that might be updated by rounds
         self.geolevel = geolevel
@@ -255,10 +298,17 @@ class add_new_char_by_random_merge_2dfs():
                 add_geovarid_df[geovarid] += add_geovarid_df[geo_level.lower()]
         elif 'Block' + self.geovintage in geovarids_available:
             print('Dataframe has Block', self.geovintage, 'for new geovar', geovarid)
-            add_geovarid_df[geovarid] = add_geovarid_df['Block' + self.geovintage].astype(str).str.zfill(15).str[:total_length_of_geovar]
+            # Parent ids are made once for each unique block
+            add_geovarid_df[geovarid] = geokey_index(
+                add_geovarid_df['Block' + self.geovintage]).strings(self.geolevel)
         elif 'Tract' + self.geovintage in geovarids_available:
             print('Dataframe has Tract', self.geovintage, 'for new geovar', geovarid)
-            add_geovarid_df[geovarid] = add_geovarid_df['Tract' + self.geovintage].astype(str).str.zfill(11).str[:total_length_of_geovar]
+            if total_length_of_geovar <= 11:
+                add_geovarid_df[geovarid] = geokey_index(
+                    add_geovarid_df['Tract' + self.geovintage],
+                    geolevel = 'Tract').strings(self.geolevel)
+            else:
+                add_geovarid_df[geovarid] = add_geovarid_df['Tract' + self.geovintage].astype(str).str.zfill(11).str[:total_length_of_geovar]
         elif 'GEO_ID' in column_list:
             print('Dataframe has GEO_ID for new geovar', geovarid)
             add_geovarid_df[geovarid] = add_geovarid_df['GEO_ID'].astype(str).apply(lambda x: x.zfill(11)[x.find("US") + 2:total_length_of_geovar + x.find("US") + 2])
@@ -337,8 +387,9 @@ class add_new_char_by_random_merge_2dfs():
             # Need to zero pad part2 find the max number of characters
             part2_max = add_uniqueid_df['unique_part2'].max()
             part2_maxdigits = len(str(part2_max))
-            add_uniqueid_df.loc[:,primary_key_name] = add_uniqueid_df[uniqueid_part1] + \
-                add_uniqueid_df['unique_part2'].apply(lambda x : str(int(x)).zfill(part2_maxdigits))
+            add_uniqueid_df.loc[:,primary_key_name] = make_uniqueid(
+                add_uniqueid_df[uniqueid_part1], add_uniqueid_df['unique_part2'],
+                part2_maxdigits)
             # Check if values are unique
             error = self.primary_key_error_check(add_uniqueid_df,primary_key_name)
         
@@ -411,8 +462,7 @@ class add_new_char_by_random_merge_2dfs():
     
         # Add unique ID based on group vars
         df.loc[:,'unique_part2'] = df.groupby([uniqueid_part1]).cumcount() + 1
-        df.loc[:,'uniqueid'] = df[uniqueid_part1] + \
-            df['unique_part2'].apply(lambda x : str(int(x)).zfill(5)) 
+        df.loc[:,'uniqueid'] = make_uniqueid(df[uniqueid_part1], df['unique_part2'], 5)
         if df['uniqueid'].is_unique:
             print("Unique variable is unique.")
         else:
@@ -484,13 +534,292 @@ class add_new_char_by_random_merge_2dfs():
 
         return merged_groups
 
+    @staticmethod
+    def sort_codes(values, ascending = True):
+        """
+        Convert a column into integer codes that sort the same way as
+        sort_values - missing values are placed last in both directions.
+        """
+        codes, uniques = pd.factorize(values, sort=True)
+        codes = codes.astype(np.int64)
+        n_uniques = len(uniques)
+        if not ascending:
+            codes = np.where(codes >= 0, n_uniques - 1 - codes, codes)
+        codes[codes < 0] = n_uniques
+
+        return codes
+
+    @staticmethod
+    def random_mergeorder_codes(unique_rank, group_codes, seed, sort_codes_list = []):
+        """
+        Random merge order from integer codes.
+        unique_rank: rank of the unique id - random numbers are drawn in this order
+        group_codes: integer code for the group by variables, ordered the same
+            way as the group by variables would be sorted.
+        sort_codes_list: integer codes for the sort vars (most important first)
+        Returns the random merge order (counter within group starting at 1) in row order.
+        """
+        size_row = unique_rank.shape[0]
+        random_generator = np.random.RandomState(seed)
+
+        # Random numbers are drawn after sorting by the unique id
+        unique_order = np.argsort(unique_rank, kind='stable')
+        random_order = np.empty(size_row)
+        random_order[unique_order] = random_generator.uniform(0, 1, size_row)
+
+        return add_new_char_by_random_merge_2dfs.mergeorder_from_random_order(
+            unique_rank, random_order, group_codes, sort_codes_list)
+
+    @staticmethod
+    def mergeorder_from_random_order(unique_rank, random_order, group_codes,
+                                     sort_codes_list = []):
+        """
+        Counter within group after sorting by group, sort vars and random order.
+        """
+        size_row = unique_rank.shape[0]
+
+        # np.lexsort uses the last key as the primary sort key
+        # unique rank breaks ties the same way as the stable pandas sort
+        sort_keys = [unique_rank, random_order] + list(reversed(sort_codes_list)) \
+            + [group_codes]
+        sorted_rows = np.lexsort(sort_keys)
+
+        # Counter within group - same as groupby cumcount + 1
+        sorted_groups = group_codes[sorted_rows]
+        positions = np.arange(size_row)
+        group_start = np.ones(size_row, dtype=bool)
+        group_start[1:] = sorted_groups[1:] != sorted_groups[:-1]
+        first_position = np.maximum.accumulate(np.where(group_start, positions, 0))
+        random_mergeorder = np.empty(size_row, dtype=np.int64)
+        random_mergeorder[sorted_rows] = positions - first_position + 1
+
+        return random_mergeorder
+
+    @staticmethod
+    def pair_mergeorder(group1_codes, group1_mergeorder, group2_codes, group2_mergeorder):
+        """
+        Pair rows with the same group code and random merge order.
+        Returns the group2 row for each group1 row, -1 if there is no match.
+        """
+        length_group1 = group1_codes.shape[0]
+        length_group2 = group2_codes.shape[0]
+        max_order = max(group1_mergeorder.max(initial=0),
+                        group2_mergeorder.max(initial=0)) + 1
+        group1_keys = group1_codes * max_order + group1_mergeorder
+        group2_keys = group2_codes * max_order + group2_mergeorder
+        group2_match = np.full(length_group1, -1, dtype=np.int64)
+        if length_group2 > 0:
+            group2_sorted = np.argsort(group2_keys, kind='stable')
+            positions = np.searchsorted(group2_keys[group2_sorted], group1_keys)
+            positions = np.minimum(positions, length_group2 - 1)
+            matched = group2_keys[group2_sorted][positions] == group1_keys
+            group2_match[matched] = group2_sorted[positions][matched]
+
+        return group2_match
+
+    @staticmethod
+    def partition_key(geovar_value):
+        """
+        Integer key for a geovar value - same key in every process and run
+        """
+        return int.from_bytes(hashlib.sha256(str(geovar_value).encode()).digest()[:8],
+                              'little')
+
+    @staticmethod
+    def random_order_by_geovar(unique_rank, geo_codes, geo_keys, seed_key):
+        """
+        Random numbers drawn separately for each geovar value.
+        Each geovar value draws from its own Philox generator keyed by
+        (seed, round, seed increment, geovar key), so the draws for one
+        geovar do not depend on the rows of the other geovars.
+        Returns random numbers in row order.
+        """
+        random_order = np.empty(unique_rank.shape[0])
+        # Rows by geovar value in unique id order
+        rows_sorted = np.lexsort((unique_rank, geo_codes))
+        geo_sorted = geo_codes[rows_sorted]
+        geo_start = np.flatnonzero(np.r_[True, geo_sorted[1:] != geo_sorted[:-1]])
+        geo_start = geo_start[geo_start < geo_sorted.shape[0]]
+        geo_end = np.r_[geo_start[1:], geo_sorted.shape[0]]
+        for start, end in zip(geo_start, geo_end):
+            seed_sequence = np.random.SeedSequence(seed_key +
+                [int(geo_keys[geo_sorted[start]])])
+            random_generator = np.random.Generator(np.random.Philox(seed_sequence))
+            random_order[rows_sorted[start:end]] = random_generator.random(end - start)
+
+        return random_order
+
+    def random_merge_partitioned(self, key_dfs, key_codes, geovar, randmerge_options):
+        """
+        Random merge order and pairs with random numbers drawn by geovar.
+        Missing geovar values are one more geovar value, as in sort_codes.
+        Returns merge order for primary and secondary rows and the
+        secondary row for each primary row (-1 if no match).
+        """
+        geo_values = pd.concat([key_dfs['primary'][geovar], key_dfs['secondary'][geovar]],
+                               ignore_index=True)
+        geo_uniques = pd.factorize(geo_values, sort=True)[1]
+        geo_keys = np.array([self.partition_key(value) for value in geo_uniques] +
+                            [self.partition_key(np.nan)], dtype=np.uint64)
+        geo_codes = self.sort_codes(geo_values.values)
+        length_primary = key_dfs['primary'].shape[0]
+        row_geo_codes = {'primary' : geo_codes[:length_primary],
+                         'secondary' : geo_codes[length_primary:]}
+
+        print("Random merge by",geovar,"for",len(geo_uniques),"geovar values.")
+        mergeorder = {}
+        for key in ['primary', 'secondary']:
+            key_df = key_dfs[key]
+            unique_rank = self.sort_codes(
+                key_df[randmerge_options[key]['unique_sort_vars'][0]].values)
+            sort_codes_list = [self.sort_codes(key_df[var].values, ascending)
+                for var, ascending in zip(randmerge_options[key]['sort_vars'],
+                                          randmerge_options[key]['sort_vars_ascending'])]
+            random_order = self.random_order_by_geovar(unique_rank, row_geo_codes[key],
+                geo_keys, randmerge_options[key]['seed_key'])
+            mergeorder[key] = self.mergeorder_from_random_order(
+                unique_rank, random_order, key_codes[key], sort_codes_list)
+
+        group2_match = self.pair_mergeorder(key_codes['primary'], mergeorder['primary'],
+                                            key_codes['secondary'], mergeorder['secondary'])
+
+        return mergeorder, group2_match
+
+    def random_mergeorder_numpy(self, key_df, group_codes, seed,
+                                unique_sort_vars, sort_vars, sort_vars_ascending):
+        """
+        Array version of prepare_randommerge.
+        Returns the random merge order for each row of key_df (in row order).
+        """
+        unique_rank = self.sort_codes(key_df[unique_sort_vars[0]].values)
+        sort_codes_list = [self.sort_codes(key_df[var].values, ascending)
+                           for var, ascending in zip(sort_vars, sort_vars_ascending)]
+
+        return self.random_mergeorder_codes(unique_rank, group_codes, seed, sort_codes_list)
+
+    def merge_groups_numpy(self, group1_df, group2_df, groupby_vars, randmerge_options):
+        """
+        Array version of prepare_randommerge and merge_groups.
+        Group by variables are encoded once as integer codes across both dataframes.
+        The k-th random row in the primary group is paired with the k-th random
+        row in the secondary group with searchsorted.
+        Returns the same columns as merge_groups.
+        """
+        group1_df = group1_df.reset_index(drop=True)
+        group2_df = group2_df.reset_index(drop=True)
+        length_group1 = group1_df.shape[0]
+        length_group2 = group2_df.shape[0]
+        merge_vars = groupby_vars + ['random_mergeorder']
+        print("Check merge vars includes geovarid:",merge_vars)
+
+        # Encode group by variables as one integer code shared by both groups
+        if len(groupby_vars) > 0:
+            var_codes = [self.sort_codes(pd.concat([group1_df[var], group2_df[var]],
+                                        ignore_index=True).values)
+                                for var in groupby_vars]
+            _, group_codes = np.unique(np.column_stack(var_codes), axis=0,
+                                       return_inverse=True)
+            group_codes = group_codes.reshape(-1).astype(np.int64)
+        else:
+            group_codes = np.zeros(length_group1 + length_group2, dtype=np.int64)
+        group1_codes = group_codes[:length_group1]
+        group2_codes = group_codes[length_group1:]
+
+        if (self.engine == "partitioned") and (len(groupby_vars) > 0):
+            # Rows are only paired within the same geovar
+            mergeorder, group2_match = self.random_merge_partitioned(
+                key_dfs = {'primary' : group1_df, 'secondary' : group2_df},
+                key_codes = {'primary' : group1_codes, 'secondary' : group2_codes},
+                geovar = groupby_vars[0],
+                randmerge_options = randmerge_options)
+        else:
+            mergeorder = {}
+            for key, key_df, key_codes in [('primary', group1_df, group1_codes),
+                                           ('secondary', group2_df, group2_codes)]:
+                print("Generating random merge order for",key,"by",groupby_vars)
+                mergeorder[key] = self.random_mergeorder_numpy(key_df = key_df,
+                    group_codes = key_codes,
+                    seed = randmerge_options[key]['seed'],
+                    unique_sort_vars = randmerge_options[key]['unique_sort_vars'],
+                    sort_vars = randmerge_options[key]['sort_vars'],
+                    sort_vars_ascending = randmerge_options[key]['sort_vars_ascending'])
+
+            # Pair rows with the same group code and random merge order
+            group2_match = self.pair_mergeorder(group1_codes, mergeorder['primary'],
+                                                group2_codes, mergeorder['secondary'])
+        group1_df['random_mergeorder'] = mergeorder['primary']
+        group2_df['random_mergeorder'] = mergeorder['secondary']
+        matched = group2_match >= 0
+        group2_used = np.zeros(length_group2, dtype=bool)
+        group2_used[group2_match[matched]] = True
+        group2_only = np.flatnonzero(~group2_used)
+
+        # Rows in outer merge order - sorted by group code and merge order
+        left_rows = np.concatenate([np.arange(length_group1),
+                                    np.full(group2_only.shape[0], -1)])
+        right_rows = np.concatenate([group2_match, group2_only])
+        out_codes = np.concatenate([group1_codes, group2_codes[group2_only]])
+        out_mergeorder = np.concatenate([mergeorder['primary'],
+                                         mergeorder['secondary'][group2_only]])
+        out_order = np.lexsort((out_mergeorder, out_codes))
+        left_rows = left_rows[out_order]
+        right_rows = right_rows[out_order]
+        has_left = left_rows >= 0
+        has_right = right_rows >= 0
+
+        # Keep flag vars
+        group1_flag_vars = [col for col in group1_df if '_flagsetrm' in col]
+        group2_flag_vars = [col for col in group2_df if '_flagsetrm' in col]
+        # Keep primary key and merge group vars
+        keep_vars_group1 = [self.primary_key_group1] + merge_vars + group1_flag_vars
+        keep_vars_group2 = [self.primary_key_group2] + merge_vars \
+            + [self.new_char] + self.extra_vars + group2_flag_vars
+        nonkey_group1 = [col for col in keep_vars_group1 if col not in merge_vars]
+        nonkey_group2 = [col for col in keep_vars_group2 if col not in merge_vars]
+
+        # Build merged columns in the same layout as pd.merge
+        # Reindex with -1 fills missing rows with NaN as in an outer merge
+        merged_columns = {}
+        for col in keep_vars_group1:
+            if col in merge_vars:
+                combined = pd.concat([group1_df[col], group2_df[col]], ignore_index=True)
+                take_rows = np.where(has_left, left_rows, length_group1 + right_rows)
+                merged_columns[col] = combined.take(take_rows).values
+            else:
+                new_col = col+'_x' if col in nonkey_group2 else col
+                merged_columns[new_col] = group1_df[col].reindex(left_rows).values
+        for col in nonkey_group2:
+            new_col = col+'_y' if col in nonkey_group1 else col
+            merged_columns[new_col] = group2_df[col].reindex(right_rows).values
+        merged_groups = pd.DataFrame(merged_columns)
+        merge_indicator = np.where(has_left & has_right, 'both',
+                            np.where(has_left, 'left_only', 'right_only'))
+        merged_groups[self.check_merge] = pd.Categorical(merge_indicator,
+                            categories=['left_only', 'right_only', 'both'])
+
+        # Fill in missing variables
+        merged_groups[self.new_char] = merged_groups[self.new_char].\
+            fillna(value=self.fillna_value)
+
+        # Check non-matching observations
+        length_nonmatch1 = (has_left & ~has_right).sum()
+        print("Primary data frame has extra",self.new_char,\
+            " observations with no match:",length_nonmatch1)
+        print("Observations with no match filled with",self.fillna_value)
+        length_nonmatch2 = (~has_left & has_right).sum()
+        print("Merge found extra",self.new_char," observations:",length_nonmatch2)
+
+        return merged_groups
+
     def setup_run_random_merge_2dfs(self):
         """
         Intersect 2 data frames based on groups, variable set and random merge
         """
         # Prepare data for merge
         preped_for_merge_data = {}
+        randmerge_options = {}
         for key in self.dfs.keys():
+            randmerge_options[key] = {}
             print("\n***************************************")
             print("    Setting up ",key,"data with primary key and flags")
             print("***************************************\n")
@@ -499,18 +828,29 @@ class add_new_char_by_random_merge_2dfs():
             # Add geovar
             lower_case_geovars = ['block','blockgroup','tract','county']
             upper_case_geovars = ['Block','BlockGroup','Tract','County']
-            if self.geolevel in lower_case_geovars + upper_case_geovars:
-                self.dfs[key]['data'] = self.add_geovarid(self.dfs[key]['data'])
-            # Add primary key
-            self.dfs[key]['data'] = self.add_primarykey(self.dfs[key]['data'],key)
-
-            # Add set flag variable by groups with geovar
-            self.dfs[key]['data']  = self.set_flags_for_merge(
-                self.dfs[key]['data'] )
+            if self.incremental_flags and self.flag_state_is_current(key):
+                # Geovar and primary key are set for this geolevel
+                # Flags only change for rows without the geovar flag set
+                self.set_flags_for_unset_rows(key)
+            else:
+                if self.geolevel in lower_case_geovars + upper_case_geovars:
+                    self.dfs[key]['data'] = self.add_geovarid(self.dfs[key]['data'])
+                # Add primary key
+                self.dfs[key]['data'] = self.add_primarykey(self.dfs[key]['data'],key)
+
+                # Add set flag variable by groups with geovar
+                self.dfs[key]['data']  = self.set_flags_for_merge(
+                    self.dfs[key]['data'] )
+                if self.incremental_flags:
+                    self.init_flag_state(key)
             # Copy data with flag not set
-            flag_not_set_condition = \
-                (self.dfs[key]['data'][self.flaggeo_var] == 0)
-            key_df = self.dfs[key]['data'].loc[flag_not_set_condition].copy()
+            if self.incremental_flags:
+                key_df = self.dfs[key]['data'].\
+                    iloc[self.flag_state[key]['unset']].copy()
+            else:
+                flag_not_set_condition = \
+                    (self.dfs[key]['data'][self.flaggeo_var] == 0)
+                key_df = self.dfs[key]['data'].loc[flag_not_set_condition].copy()
             print("Attempting random merge for",key_df.shape[0],key,"observations.")
 
             # Check if sort vars options have been set
@@ -544,6 +884,16 @@ class add_new_char_by_random_merge_2dfs():
             # add seed increment to ensure random merge
             seed_increment = 1
             for by_group in self.by_groups:
+                if self.engine in ["numpy", "partitioned"]:
+                    # Random merge order is set when the groups are merged
+                    randmerge_options[key][by_group] = {
+                        'seed' : self.seed+self.round+seed_increment,
+                        'seed_key' : [self.seed, self.round, seed_increment],
+                        'unique_sort_vars' : [self.primary_key_name[key]],
+                        'sort_vars' : self.sort_vars,
+                        'sort_vars_ascending' : self.sort_vars_ascending}
+                    seed_increment += 1
+                    continue
                 print("\n***************************************")
                 print("    Preparing",key,"by",by_group,"data for random merge.")
                 print("***************************************\n")
@@ -573,7 +923,14 @@ class add_new_char_by_random_merge_2dfs():
             print("\n***************************************")
             print("    Random Merge",group1,"with",group2,"by",by_group)
             print("***************************************\n")
-            merged_dfs[by_group] = self.merge_groups(group1_df = group1_df,
+            if self.engine in ["numpy", "partitioned"]:
+                merged_dfs[by_group] = self.merge_groups_numpy(group1_df = group1_df,
+                             group2_df = group2_df,
+                             groupby_vars = self.groupby_vars[by_group],
+                             randmerge_options = {'primary' : randmerge_options[group1][by_group],
+                                        'secondary' : randmerge_options[group2][by_group]})
+            else:
+                merged_dfs[by_group] = self.merge_groups(group1_df = group1_df,
                              group2_df = group2_df,
                              groupby_vars = self.groupby_vars[by_group]) 
                     
@@ -605,6 +962,9 @@ class add_new_char_by_random_merge_2dfs():
         print("   Generate output data")
         print("***************************************\n")
 
+        if self.incremental_flags:
+            return self.update_rows_after_merge(merged_dfs_recombine)
+
         # Save output data for keys
         output_df = {}
         percent_left_to_predict = {}
@@ -696,6 +1056,137 @@ class add_new_char_by_random_merge_2dfs():
 
         return input_df
 
+    def init_flag_state(self, key):
+        """
+        Positions of rows without the geovar flag set.
+        Flags for rows with the geovar flag set do not change until
+        the geolevel changes, so later passes only look at the unset rows.
+        """
+        data = self.dfs[key]['data']
+        self.flag_state[key] = {
+            'geovar' : self.geovar,
+            'nrows' : data.shape[0],
+            'key_positions' : pd.Index(data[self.primary_key_name[key]]),
+            'unset' : np.flatnonzero((data[self.flaggeo_var] == 0).to_numpy())}
+
+    def flag_state_is_current(self, key):
+        """
+        Check if flag state was set for the data and geovar
+        """
+        if key not in self.flag_state:
+            return False
+        state = self.flag_state[key]
+        data = self.dfs[key]['data']
+        flaggeo_var = self.new_char+'_'+self.geovar+'_flagsetrm'
+
+        return (state['geovar'] == self.geovar) and \
+            (flaggeo_var in data.columns) and \
+            (state['nrows'] == data.shape[0])
+
+    def update_unset_rows(self, key):
+        """
+        Drop rows with the geovar flag set from the unset rows
+        """
+        state = self.flag_state[key]
+        flaggeo = self.dfs[key]['data'][self.flaggeo_var].to_numpy()
+        state['unset'] = state['unset'][flaggeo[state['unset']] == 0]
+
+    def update_rows(self, key, positions, update_df, update_vars,
+                    missing_upcast: bool = False):
+        """
+        Update columns in data for rows at positions.
+        Missing values in update_df keep the current value, same as
+        update_cols_after_merge.
+        missing_upcast: integer columns become float if only some rows are
+            updated - same types as the left merge in the full table update
+        """
+        data = self.dfs[key]['data']
+        nrows = data.shape[0]
+        partial = len(positions) < nrows
+        for var in update_vars:
+            values = pd.Series(update_df[var].to_numpy(), index = positions)
+            if var not in data.columns:
+                if not partial:
+                    column = np.empty(nrows, dtype = values.dtype)
+                    column[positions] = values.to_numpy()
+                    data[var] = column
+                    continue
+                if pd.api.types.is_numeric_dtype(values):
+                    data[var] = np.nan
+                else:
+                    data[var] = pd.Series(np.nan, index = data.index, dtype = object)
+            else:
+                current = pd.Series(data[var].to_numpy()[positions], index = positions)
+                values = values.where(values.notnull(), current)
+
+            if pd.api.types.is_numeric_dtype(data[var]) and \
+                pd.api.types.is_numeric_dtype(values):
+                upcast_dtypes = [data[var].dtype, values.dtype]
+                if missing_upcast and partial:
+                    upcast_dtypes.append(np.float64)
+                dtype = np.result_type(*upcast_dtypes)
+            else:
+                dtype = np.dtype(object)
+            if data[var].dtype != dtype:
+                data[var] = data[var].astype(dtype)
+            data.iloc[positions, data.columns.get_loc(var)] = \
+                values.to_numpy().astype(dtype)
+
+    def set_flags_for_unset_rows(self, key):
+        """
+        Set flags before merge for rows without the geovar flag set
+        """
+        unset = self.flag_state[key]['unset']
+        unset_df = self.set_flags_for_merge(self.dfs[key]['data'].iloc[unset])
+        self.update_rows(key, unset, unset_df, [self.flag_var, self.flaggeo_var])
+        self.update_unset_rows(key)
+
+    def update_rows_after_merge(self, merged_df):
+        """
+        Copy new characteristic and flags from merged data to the rows
+        matched by primary key. Replaces the left merge of the full table.
+        """
+        output_df = {}
+        percent_left_to_predict = {}
+        for key in self.dfs.keys():
+            primary_key = self.dfs[key]['primarykey']
+            result_df = merged_df.loc[merged_df[primary_key].notnull()]
+            if not result_df[primary_key].is_unique:
+                raise pd.errors.MergeError(
+                    "Merge keys are not unique in right dataset; not a one-to-one merge")
+            flag_vars = [col for col in result_df if '_flagsetrm' in col]
+            update_vars = [self.new_char] + flag_vars + self.extra_vars
+
+            positions = self.flag_state[key]['key_positions'].\
+                get_indexer(result_df[primary_key])
+            result_df = result_df.loc[positions >= 0]
+            positions = positions[positions >= 0]
+            # Column order of the left merge and update_cols_after_merge -
+            # new columns, then updated columns moved to the end
+            columns = list(self.dfs[key]['data'].columns)
+            column_order = [col for col in columns if col not in update_vars] + \
+                [var for var in update_vars if var not in columns] + \
+                [var for var in update_vars if var in columns]
+            self.update_rows(key, positions, result_df, update_vars,
+                             missing_upcast = True)
+            self.dfs[key]['data'] = self.dfs[key]['data'][column_order]
+            self.update_unset_rows(key)
+
+            print("\n***************************************")
+            print("    Check random merge results for",key,"data.")
+            print("***************************************\n")
+            nrows = self.flag_state[key]['nrows']
+            obs_left_to_predict = len(self.flag_state[key]['unset'])
+            percent_left_to_predict[key] = (obs_left_to_predict/nrows)*100
+            print("Updated",len(positions),"of",nrows,key,"observations.")
+            print("Outputdata has",nrows - obs_left_to_predict,\
+                "Observations with predicted",self.new_char)
+            print("Percent left to predict: %5.2f" % (percent_left_to_predict[key]))
+
+            output_df[key] = self.dfs[key]['data']
+
+        return output_df, percent_left_to_predict
+
     def set_flags_for_merge(self,input_df):
         """
         Function to set flags before or after merge
@@ -857,6 +1348,156 @@ class add_new_char_by_random_merge_2dfs():
         return rounds
     
 
+    def round_checkpoint_statefile(self, csv_filename):
+        """
+        Path to json file that points to the saved round checkpoints
+        """
+        return os.path.join(self.outputfolder, csv_filename+'_rounds.json')
+
+    @staticmethod
+    def round_options_signature(rounds):
+        """
+        Geo levels and options - a checkpoint is only resumed with the same rounds
+        """
+        return {'geo_levels' : list(rounds['geo_levels']),
+                'options' : [str(option) for option in rounds['options']]}
+
+    def save_round_checkpoint(self, csv_filename, rounds, position, state = None,
+                              stage_key = None):
+        """
+        Save data before the next geo level of the random merge.
+        position: restart pass, geo level and option index of the next option
+        stage_key: stage manifest key of the random merge inputs - see
+            ncoda_00l_stagecache
+        The data has the flag variables and the new characteristic.
+        Random numbers in each round are seeded by seed + round, so the round
+        counter is the random number state.
+        The data files are saved first and the state file is replaced last,
+        so the state file always points to complete checkpoints.
+        """
+        if state is None:
+            state = {'checkpoints' : []}
+        checkpoint_number = 1
+        if len(state['checkpoints']) > 0:
+            checkpoint_number = state['checkpoints'][-1]['number'] + 1
+
+        checkpoint = {'number' : checkpoint_number,
+                      'round' : self.round,
+                      'position' : position,
+                      'files' : {},
+                      'dtypes' : {}}
+        for key in self.dfs.keys():
+            name = f'{csv_filename}_roundcheckpoint{checkpoint_number}_{key}'
+            save_checkpoint(self.dfs[key]['data'], self.outputfolder, name)
+            checkpoint['files'][key] = name
+            checkpoint['dtypes'][key] = \
+                self.dfs[key]['data'].dtypes.astype(str).to_dict()
+
+        state['seed'] = self.seed
+        state['rounds'] = self.round_options_signature(rounds)
+        state['stage_key'] = stage_key
+        state['checkpoints'].append(checkpoint)
+        pruned_checkpoints = state['checkpoints'][:-self.keep_round_checkpoints]
+        state['checkpoints'] = state['checkpoints'][-self.keep_round_checkpoints:]
+
+        statefile = self.round_checkpoint_statefile(csv_filename)
+        with open(statefile+'.tmp', 'w') as f:
+            json.dump(state, f, indent = 1)
+        os.replace(statefile+'.tmp', statefile)
+
+        # Remove older checkpoints after the state file no longer uses them
+        self.remove_round_checkpoints(pruned_checkpoints)
+
+        return state
+
+    def remove_round_checkpoints(self, checkpoints):
+        """
+        Delete data files for a list of round checkpoints
+        """
+        for checkpoint in checkpoints:
+            for name in checkpoint['files'].values():
+                remove_checkpoint(self.outputfolder, name)
+
+    def clear_round_checkpoints(self, csv_filename, state):
+        """
+        Delete all round checkpoints and the state file after the merge finishes
+        """
+        if state is not None:
+            self.remove_round_checkpoints(state['checkpoints'])
+        statefile = self.round_checkpoint_statefile(csv_filename)
+        if os.path.exists(statefile):
+            os.remove(statefile)
+
+    def read_round_checkpoint(self, csv_filename, rounds, stage_key = None):
+        """
+        Restore data and round counter from the last round checkpoint.
+        The checkpoint is only resumed with the same seed, rounds and
+        stage key - new primary or secondary data starts from the first round.
+        Returns the state and the position of the next option
+        or None, None if there is no checkpoint to resume.
+        """
+        statefile = self.round_checkpoint_statefile(csv_filename)
+        if not os.path.exists(statefile):
+            return None, None
+        with open(statefile) as f:
+            state = json.load(f)
+
+        if (state.get('seed') != self.seed) or \
+            (state.get('rounds') != self.round_options_signature(rounds)) or \
+            (state.get('stage_key') != stage_key) or \
+            (len(state.get('checkpoints', [])) == 0):
+            print("Round checkpoint",statefile,"does not match the random merge options.")
+            print("Random merge will start from the first round.")
+            return None, None
+
+        checkpoint = state['checkpoints'][-1]
+        checkpoint_dfs = {}
+        for key in self.dfs.keys():
+            name = checkpoint['files'].get(key)
+            dtypes = checkpoint['dtypes'].get(key, {})
+            if (name is None) or (not checkpoint_exists(self.outputfolder, name)):
+                print("Round checkpoint file missing for",key,"- starting from the first round.")
+                return None, None
+            str_vars = {var : str for var, dtype in dtypes.items() if dtype == 'object'}
+            checkpoint_df = read_checkpoint(self.outputfolder, name,
+                                            schema = None, dtype = str_vars)
+            # CSV checkpoints do not keep integer and category types
+            for var, dtype in dtypes.items():
+                if (var in checkpoint_df.columns) and (var not in str_vars) and \
+                    (str(checkpoint_df[var].dtype) != dtype):
+                    try:
+                        checkpoint_df[var] = checkpoint_df[var].astype(dtype)
+                    except (ValueError, TypeError):
+                        pass
+            checkpoint_dfs[key] = checkpoint_df
+
+        for key in self.dfs.keys():
+            self.dfs[key]['data'] = checkpoint_dfs[key]
+        self.round = checkpoint['round']
+        self.flag_state = {}
+
+        print("\n***************************************")
+        print("    Resuming random merge from round checkpoint",checkpoint['number'])
+        print("    Round",self.round,"geo level",
+              rounds['geo_levels'][checkpoint['position']['geo_level_index']],
+              "option",list(rounds['options'])[checkpoint['position']['option_index']])
+        print("***************************************\n")
+
+        return state, checkpoint['position']
+
+    def stage_params(self, rounds):
+        """
+        Parameters that change the random merge output - see ncoda_00l_stagecache
+        """
+        return {'seed' : self.seed,
+                'rounds' : rounds,
+                'new_char' : self.new_char,
+                'extra_vars' : self.extra_vars,
+                'fillna_value' : self.fillna_value,
+                'reuse_secondary' : self.reuse_secondary,
+                'primarykeys' : self.primary_key_name,
+                'geovintage' : self.geovintage}
+
     def run_random_merge_2dfs(self, rounds):
         """"
         Function runs full process and checks merge by rounds
@@ -869,13 +1510,21 @@ class add_new_char_by_random_merge_2dfs():
         csv_filename_primary = csv_filename+'_primary'
         csv_filename_secondary = csv_filename+'_secondary'
         csv_filepath_primary = self.outputfolder+"/"+csv_filename_primary+'.csv'
-        csv_filepath_secondary = self.outputfolder+"/"+csv_filename_secondary+'.csv'
 
-        # Check if selected data already exists - if yes read in saved file
-        if os.path.exists(csv_filepath_primary) & os.path.exists(csv_filepath_secondary):
+        # Check if selected data already exists with the same inputs - if yes read in saved file
+        # The merge engine does not change the output and is not in the stage key
+        manifest = None
+        if self.savefiles == True:
+            manifest = stage_manifest('run_random_merge_2dfs',
+                            params = self.stage_params(rounds),
+                            inputs = {key : self.dfs[key]['data'] for key in self.dfs},
+                            code = [add_new_char_by_random_merge_2dfs])
+        if (manifest is not None) and \
+            stage_cache_hit(self.outputfolder, csv_filename_primary, manifest) & \
+            stage_cache_hit(self.outputfolder, csv_filename_secondary, manifest):
             output_df = {}
-            output_df['primary'] = pd.read_csv(csv_filepath_primary, low_memory=False)
-            output_df['secondary'] = pd.read_csv(csv_filepath_secondary, low_memory=False)
+            output_df['primary'] = read_stage(self.outputfolder, csv_filename_primary)
+            output_df['secondary'] = read_stage(self.outputfolder, csv_filename_secondary)
             # If file already exists return csv as dataframe
             print("File",csv_filepath_primary,"Already exists - Skipping Random Merge.")
             print("File",csv_filename_secondary,"Already exists - Skipping Random Merge.")
@@ -885,20 +1534,49 @@ class add_new_char_by_random_merge_2dfs():
         # Assume percent_left_to_predict starts off at 100
         round_percent_left_to_predict = 100
 
+        # Resume from the last round checkpoint of an interrupted run
+        use_round_checkpoints = (self.savefiles == True) & self.round_checkpoints
+        checkpoint_state = None
+        resume_position = None
+        if use_round_checkpoints:
+            checkpoint_state, resume_position = \
+                self.read_round_checkpoint(csv_filename, rounds, manifest['key'])
+
         # Need an outer loop that will restart process 
         # Restart needs to happen if secondary data is used up
         should_restart = True
+        restart_pass = 0
         while should_restart:
             print("Round",self.round)
             should_restart = False
+            if resume_position is not None:
+                restart_pass = resume_position['restart_pass']
+                should_restart = resume_position['should_restart']
             # Run options until all values are predicted
-            for geo_level in rounds['geo_levels']:
+            for geo_level_index, geo_level in enumerate(rounds['geo_levels']):
                 print("\n***************************************")
                 print("***************************************\n")
                 print('Performing random merge at geography level:',geo_level)
                 print("\n***************************************")
                 print("***************************************\n")
-                for option in rounds['options']:
+                for option_index, option in enumerate(rounds['options']):
+                    # Skip options completed before the round checkpoint
+                    if resume_position is not None:
+                        if [geo_level_index, option_index] < \
+                            [resume_position['geo_level_index'],
+                             resume_position['option_index']]:
+                            continue
+                        resume_position = None
+                    elif use_round_checkpoints & (option_index == 0):
+                        # One checkpoint for each geo level
+                        position = {'restart_pass' : restart_pass,
+                                    'geo_level_index' : geo_level_index,
+                                    'option_index' : option_index,
+                                    'should_restart' : should_restart}
+                        checkpoint_state = self.save_round_checkpoint(
+                            csv_filename, rounds, position, checkpoint_state,
+                            manifest['key'])
+
                     print("\n***************************************")
                     print("***************************************\n")
                     print(rounds['options'][option]['notes'])
@@ -948,16 +1626,20 @@ class add_new_char_by_random_merge_2dfs():
 
                         if self.savefiles == True:
                             print("Save primary and secondary files with all columns")
-                            savefile = os.path.join(os.getcwd(), csv_filepath_primary)
-                            output_df['primary'].to_csv(savefile, index=False)
-                            savefile = os.path.join(os.getcwd(), csv_filepath_secondary)
-                            output_df['secondary'].to_csv(savefile, index=False)
+                            save_stage(output_df['primary'],
+                                       self.outputfolder, csv_filename_primary, manifest)
+                            save_stage(output_df['secondary'],
+                                       self.outputfolder, csv_filename_secondary, manifest)
+                        if use_round_checkpoints:
+                            self.clear_round_checkpoints(csv_filename, checkpoint_state)
 
                         return output_df
                     # Create break if rounds exceeds 100
                     if self.round > 100:
                         print("Possible loop error.")
                         should_restart = False
+                        if use_round_checkpoints:
+                            self.clear_round_checkpoints(csv_filename, checkpoint_state)
                         return output_df
                     if round_percent_left_to_predict['secondary']  == 0:
                         if self.reuse_secondary == True:
@@ -969,6 +1651,7 @@ class add_new_char_by_random_merge_2dfs():
                             # Reset all flags
                             self.dfs['secondary']['data'].loc[:, self.flag_var] = 0
                             self.dfs['secondary']['data'].loc[:, self.flaggeo_var] = 0
+                            self.flag_state.pop('secondary', None)
                             # reset option to 1
                             should_restart = True
                             break
@@ -978,8 +1661,7 @@ class add_new_char_by_random_merge_2dfs():
                             print("    All secondary will not be reused.")
                             print("***************************************\n")
                             break
-
-
+            restart_pass += 1
 
         print("\n***************************************")
         print("    Random merge almost complete.")
@@ -992,6 +1674,8 @@ class add_new_char_by_random_merge_2dfs():
             csv_filepath_secondary_almost = self.outputfolder+"/"+csv_filename_secondary+'_almost.csv'
             savefile = os.path.join(os.getcwd(), csv_filepath_secondary_almost)
             output_df['secondary'].to_csv(savefile, index=False)
+        if use_round_checkpoints:
+            self.clear_round_checkpoints(csv_filename, checkpoint_state)
         return output_df
 
 
@@ -31,13 +31,124 @@ def make_incomegroup_dict():
 
     return incomegroup_dict
 
+def group_dict_values(codes, group_dict, value_name):
+    """
+    Value for each code from a group dictionary.
+    The dictionary is turned into an array indexed by group code,
+    instead of a dictionary lookup for each row.
+    """
+    group_codes = pd.Index(list(group_dict.keys()))
+    group_values = np.array([group_dict[code][value_name] for code in group_codes])
+    positions = group_codes.get_indexer(codes)
+    if (positions < 0).any():
+        missing_codes = pd.unique(np.asarray(codes)[positions < 0])
+        raise KeyError(f"Group codes not in dictionary: {list(missing_codes)}")
+
+    return group_values[positions]
+
+
+def random_integers(low, high, seed, random_method: str = 'legacy'):
+    """
+    Random integer for each row between low (inclusive) and high (exclusive)
+    with one batched draw.
+
+    random_method:
+        legacy - np.random.RandomState(seed).randint. Gives the same values
+            as one randint call for each row, so existing seeds give the
+            same output.
+        generator - np.random.default_rng(seed).integers. Faster, but the
+            values are different from legacy for the same seed.
+    """
+    low = np.asarray(low, dtype = np.int64)
+    high = np.asarray(high, dtype = np.int64)
+    if random_method == 'legacy':
+        random_generator = np.random.RandomState(seed)
+        return random_generator.randint(low, high)
+    if random_method == 'generator':
+        random_generator = np.random.default_rng(seed)
+        return random_generator.integers(low, high)
+
+    raise ValueError(f"random_method must be legacy or generator, not {random_method}")
+
+
+def interval_group_codes(values, group_dict, min_key, max_key):
+    """
+    Group code for each value from a dictionary of groups with min and
+    max values. Same result as looping over the groups in order and setting
+    the group where min <= value <= max - later groups replace earlier
+    groups where the intervals overlap. Values not in any group are NaN.
+
+    The edges of all groups are sorted once. A value is either equal to an
+    edge or between two edges, so the group for each edge and each gap
+    between edges is found once and each value is looked up with a
+    single searchsorted.
+    """
+    edges = np.unique(np.array([[group_dict[group][min_key],
+                                 group_dict[group][max_key]]
+                                for group in group_dict], dtype = float))
+    # Points to test - each edge and a point in each gap between edges
+    gap_points = np.concatenate([[edges[0] - 1],
+                                 (edges[:-1] + edges[1:]) / 2,
+                                 [edges[-1] + 1]])
+    edge_codes = np.full(edges.shape[0], np.nan)
+    gap_codes = np.full(gap_points.shape[0], np.nan)
+    for group in group_dict:
+        minvalue = group_dict[group][min_key]
+        maxvalue = group_dict[group][max_key]
+        edge_codes[(edges >= minvalue) & (edges <= maxvalue)] = group
+        gap_codes[(gap_points >= minvalue) & (gap_points <= maxvalue)] = group
+
+    values = np.asarray(values, dtype = float)
+    positions = np.searchsorted(edges, values, side = 'left')
+    on_edge = (positions < edges.shape[0]) & \
+        (edges[np.minimum(positions, edges.shape[0] - 1)] == values)
+    codes = np.where(on_edge,
+                     edge_codes[np.minimum(positions, edges.shape[0] - 1)],
+                     gap_codes[positions])
+    codes[np.isnan(values)] = np.nan
+
+    return codes
+
+
+def set_interval_groups(df, varname, groupvar, group_dict, min_key, max_key):
+    """
+    Set groupvar from varname with interval_group_codes.
+    Rows not in any group keep the current value of groupvar.
+    """
+    codes = interval_group_codes(df[varname], group_dict, min_key, max_key)
+    if groupvar in df.columns:
+        in_group = ~np.isnan(codes)
+        df.loc[in_group, groupvar] = codes[in_group]
+    else:
+        df[groupvar] = codes
+
+    return df
+
+
+def keyed_threshold_below(values, keys, threshold_dict):
+    """
+    1 if the value is below the threshold for the key, 0 if not.
+    NaN if the key is not in threshold_dict or the value is missing.
+    For example poverty thresholds by household size.
+    """
+    key_codes = pd.Index(list(threshold_dict.keys()))
+    thresholds = np.array([threshold_dict[key] for key in key_codes], dtype = float)
+    positions = key_codes.get_indexer(keys)
+    values = np.asarray(values, dtype = float)
+    threshold = thresholds[np.maximum(positions, 0)]
+    below = np.where(values < threshold, 1.0, 0.0)
+    below[(positions < 0) | np.isnan(values)] = np.nan
+
+    return below
+
+
 def add_minmaxincome(input_df,incomegroup_dict):
     #condition = (df['incomegroup'].notnull())
     output_df = input_df.copy()
-    output_df['minincome'] = output_df.\
-        apply(lambda x: incomegroup_dict[x['incomegroup']]['minincome'], axis=1)
-    output_df['maxincome'] = output_df.\
-        apply(lambda x: incomegroup_dict[x['incomegroup']]['maxincome'], axis=1)
+    output_df['minincome'] = group_dict_values(output_df['incomegroup'],
+        incomegroup_dict, 'minincome')
+    output_df['maxincome'] = group_dict_values(output_df['incomegroup'],
+        incomegroup_dict, 'maxincome')
 
     return output_df
 
@@ -61,8 +172,12 @@ def remove_cat0_randincome(input_df):
     return output_df
 
 
-def add_randincome(df, seed):
-    random_generator = np.random.RandomState(seed)
+def add_randincome(df, seed, random_method: str = 'legacy'):
+    """
+    Add random income between the min and max income of the income group.
+    random_method: legacy reproduces the values of earlier versions,
+        see random_integers
+    """
 
     output_df = df.copy()
     #Make sure income group has 0 category
@@ -76,8 +191,8 @@ def add_randincome(df, seed):
     output_df = add_minmaxincome(output_df,incomegroup_dict)
 
     # Add random income value
-    output_df['randincomeB19101'] = output_df.apply(lambda x: \
-        random_generator.randint(x['minincome'],x['maxincome']), axis=1)
+    output_df['randincomeB19101'] = random_integers(output_df['minincome'],
+        output_df['maxincome'], seed, random_method)
     
     # remove income from income category 0
     output_df = remove_cat0_randincome(output_df)
@@ -107,17 +222,13 @@ def add_poverty(input_df):
                 6: 31471,
                 7: 35743}
 
-    for numprec in poverty_by_numprec_dict:
-        randincome_less_than    = (output_df['randincomeB19101'] < \
-            poverty_by_numprec_dict[numprec])
-        numprec_equals = (output_df['numprec'] == numprec)
-        conditions = randincome_less_than & numprec_equals
-        output_df.loc[conditions,'poverty'] = 1
-
-        randincome_greater_than    = (output_df['randincomeB19101'] >= \
-            poverty_by_numprec_dict[numprec])
-        conditions = randincome_greater_than & numprec_equals
-        output_df.loc[conditions,'poverty'] = 0
+    below_poverty = keyed_threshold_below(output_df['randincomeB19101'],
+        output_df['numprec'], poverty_by_numprec_dict)
+    in_dict = ~np.isnan(below_poverty)
+    if 'poverty' in output_df.columns:
+        output_df.loc[in_dict,'poverty'] = below_poverty[in_dict]
+    else:
+        output_df['poverty'] = below_poverty
 
     # Add 0 hhinc - for no income group
     randincome_missing =  (output_df['randincomeB19101'].isnull())
@@ -142,11 +253,8 @@ def add_hhinc_groups(input_df):
     4: {'minincome': 75000, 'maxincome': 99999},
     5: {'minincome': 100000, 'maxincome': 10000000}}
 
-    for hhinc in hhinc_dict:
-        randincome_greater_than = (output_df['randincomeB19101'] >= hhinc_dict[hhinc]['minincome'])
-        randincome_less_than    = (output_df['randincomeB19101'] <= hhinc_dict[hhinc]['maxincome'])
-        conditions = randincome_greater_than & randincome_less_than
-        output_df.loc[conditions,'hhinc'] = hhinc
+    output_df = set_interval_groups(output_df, 'randincomeB19101', 'hhinc',
+        hhinc_dict, 'minincome', 'maxincome')
 
     # Add 0 hhinc - for no income group
     randincome_missing =  (output_df['randincomeB19101'].isnull())
@@ -1,8 +1,12 @@
-import pandas as pd
-import numpy as np
+from pyncoda.CommunitySourceData.api_census_gov.acg_02b_incomefunctions \
+    import random_integers, set_interval_groups
 
-def add_randage(df, seed, varname):
-    random_generator = np.random.RandomState(seed)
+def add_randage(df, seed, varname, random_method: str = 'legacy'):
+    """
+    Add random age between the min and max age of the age group.
+    random_method: legacy reproduces the values of earlier versions,
+        see random_integers
+    """
 
     output_df = df.copy()
 
@@ -16,8 +20,9 @@ def add_randage(df, seed, varname):
     # If min age is less than max age then use random number generator
     minage_less_maxage = (output_df['minageyrs'] < output_df['maxageyrs'])
     conditions = minage_less_maxage & minage_notmissing
-    output_df.loc[conditions, varname] = output_df[conditions].apply(lambda x: \
-        random_generator.randint(x['minageyrs'],x['maxageyrs']), axis=1)
+    output_df.loc[conditions, varname] = random_integers(
+        output_df.loc[conditions, 'minageyrs'],
+        output_df.loc[conditions, 'maxageyrs'], seed, random_method)
 
     return output_df
 
@@ -53,13 +58,8 @@ def add_P12age_groups(input_df,varname):
     22: {'minageyrs': 80, 'maxageyrs': 84},
     23: {'minageyrs': 85, 'maxageyrs': 110}}
 
-    for agegroup in agegroupP12_dict:
-        randincome_greater_than = \
-            (output_df[varname] >= agegroupP12_dict[agegroup]['minageyrs'])
-        randincome_less_than    = \
-            (output_df[varname] <= agegroupP12_dict[agegroup]['maxageyrs'])
-        conditions = randincome_greater_than & randincome_less_than
-        output_df.loc[conditions,'agegroupP12'] = agegroup
+    output_df = set_interval_groups(output_df, varname, 'agegroupP12',
+        agegroupP12_dict, 'minageyrs', 'maxageyrs')
 
     # Add 0 agegroup - for no age data
     randage_missing =  (output_df[varname].isnull())
@@ -85,13 +85,8 @@ def add_H17age_groups(input_df,varname):
     8: {'minageyrs': 75, 'maxageyrs': 84},
     9: {'minageyrs': 85, 'maxageyrs': 110}}
 
-    for agegroup in agegroupH17_dict:
-        randvar_greater_than = \
-            (output_df[varname] >= agegroupH17_dict[agegroup]['minageyrs'])
-        randvar_less_than    = \
-            (output_df[varname] <= agegroupH17_dict[agegroup]['maxageyrs'])
-        conditions = randvar_greater_than & randvar_less_than
-        output_df.loc[conditions,'agegroupH17'] = agegroup
+    output_df = set_interval_groups(output_df, varname, 'agegroupH17',
+        agegroupH17_dict, 'minageyrs', 'maxageyrs')
 
     # Add 0 agegroup - for no age data
     randage_missing =  (output_df[varname].isnull())
@@ -112,13 +107,8 @@ def add_H18age_groups(input_df,varname):
         2: {'minageH18': 35, 'maxageH18': 64},
         3: {'minageH18': 65, 'maxageH18': 110}}
 
-    for agegroup in agegroupH18_dict:
-        randvar_greater_than = \
-            (output_df[varname] >= agegroupH18_dict[agegroup]['minageH18'])
-        randvar_less_than    = \
-            (output_df[varname] <= agegroupH18_dict[agegroup]['maxageH18'])
-        conditions = randvar_greater_than & randvar_less_than
-        output_df.loc[conditions,'agegroupH18'] = agegroup
+    output_df = set_interval_groups(output_df, varname, 'agegroupH18',
+        agegroupH18_dict, 'minageH18', 'maxageH18')
 
     # Add 0 agegroup - for no age data
     randage_missing =  (output_df[varname].isnull())
@@ -139,13 +129,8 @@ def add_B19037age_groups(input_df,varname):
         3: {'minageyrs': 45, 'maxageyrs': 64},
         4: {'minageyrs': 65, 'maxageyrs': 110}}
 
-    for agegroup in agegroupB19037_dict:
-        randvar_greater_than = \
-            (output_df[varname] >= agegroupB19037_dict[agegroup]['minageyrs'])
-        randvar_less_than    = \
-            (output_df[varname] <= agegroupB19037_dict[agegroup]['maxageyrs'])
-        conditions = randvar_greater_than & randvar_less_than
-        output_df.loc[conditions,'agegroupB19037'] = agegroup
+    output_df = set_interval_groups(output_df, varname, 'agegroupB19037',
+        agegroupB19037_dict, 'minageyrs', 'maxageyrs')
 
     # Add 0 agegroup - for no age data
     randage_missing =  (output_df[varname].isnull())
@@ -165,13 +150,8 @@ def add_P43age_groups(input_df,varname):
         2: {'minageyrs': 18, 'maxageyrs': 64},
         3: {'minageyrs': 65, 'maxageyrs': 110}}
 
-    for agegroup in agegroupP43_dict:
-        randvar_greater_than = \
-            (output_df[varname] >= agegroupP43_dict[agegroup]['minageyrs'])
-        randvar_less_than    = \
-            (output_df[varname] <= agegroupP43_dict[agegroup]['maxageyrs'])
-        conditions = randvar_greater_than & randvar_less_than
-        output_df.loc[conditions,'agegroupP43'] = agegroup
+    output_df = set_interval_groups(output_df, varname, 'agegroupP43',
+        agegroupP43_dict, 'minageyrs', 'maxageyrs')
 
     # Add 0 agegroup - for no age data
     randage_missing =  (output_df[varname].isnull())
@@ -41,6 +41,9 @@ class hui_workflow_functions():
     """
     Function runs full process for generating the housing unit inventories
     Process runs for 1 county.
+
+    merge_engine: engine for add_new_char_by_random_merge_2dfs
+        "pandas" (default) or "numpy" - both give the same result
     """
 
     def __init__(self,
@@ -52,7 +55,8 @@ class hui_workflow_functions():
             basevintage: str = 2010,
             outputfolder: str ="",
             outputfolders = {},
-            savefiles: bool = True):
+            savefiles: bool = True,
+            merge_engine: str = "pandas"):
 
         self.state_county = state_county
         self.state_county_name = state_county_name
@@ -63,6 +67,7 @@ class hui_workflow_functions():
         self.outputfolder = outputfolder
         self.outputfolders = outputfolders
         self.savefiles = savefiles
+        self.merge_engine = merge_engine
 
 
     def save_environment_version_details(self):
@@ -84,10 +89,6 @@ class hui_workflow_functions():
         """
         Workflow to produce Housing Unit Inventory
         """
-        # Start empty containers to store block level and tract level data
-        tract_df = {}
-        block_df = {}
-
         # Save output description as text
         output_filename = f'hui_{self.version_text}_{self.state_county}_{self.basevintage}_rs{self.seed}'
         self.output_filename = output_filename
@@ -98,6 +99,25 @@ class hui_workflow_functions():
             logfile.start(log_filepath)
             self.save_environment_version_details()
 
+        block_df, tract_df = self.load_hui_inputs()
+        block_income_df = self.random_merge_hui_inputs(block_df, tract_df)
+
+        # Stop log file
+        if savelog == True:
+            logfile.stop()
+
+        return block_income_df
+
+    def load_hui_inputs(self):
+        """
+        Block and tract inventories from the Census API.
+        The inputs do not depend on the seed and can be reused
+        for many seeds - see random_merge_hui_inputs.
+        """
+        # Start empty containers to store block level and tract level data
+        tract_df = {}
+        block_df = {}
+
         print("\n***************************************")
         print("    Obtain and clean core housing unit characteristics for",self.state_county_name)
         print("***************************************\n")
@@ -144,7 +164,14 @@ class hui_workflow_functions():
                                                             [family_varstem_roots],
                                         outputfolders = self.outputfolders,
                                         outputfile = "B19101")
-                    
+
+        return block_df, tract_df
+
+    def random_merge_hui_inputs(self, block_df, tract_df):
+        """
+        Random merge of household and family income with the block data.
+        Only this step depends on the seed.
+        """
         print("\n***************************************")
         print("    Random income data with core characteristics.")
         print("***************************************\n")
@@ -170,7 +197,8 @@ class hui_workflow_functions():
         state_county = self.state_county,
         outputfile = "B19001rmB19101",
         outputfolder = self.outputfolders['RandomMerge'],
-        savefiles = self.savefiles)
+        savefiles = self.savefiles,
+        engine = self.merge_engine)
 
         # Set up round options
         rounds = income_by_family.make_round_options_dict()
@@ -204,17 +232,14 @@ class hui_workflow_functions():
         outputfile = "hui_B19001rmB19101",
         outputfolder = self.outputfolders['RandomMerge'],
         reuse_secondary = True,
-        savefiles = self.savefiles)
+        savefiles = self.savefiles,
+        engine = self.merge_engine)
 
         # Set up round options
         rounds = block_income.make_round_options_dict()
 
         block_income_df = block_income.run_random_merge_2dfs(rounds)
 
-        # Stop log file
-        if savelog == True:
-            logfile.stop()
-
         return block_income_df
 
     def try_polish(self, input_df):
@@ -255,11 +280,12 @@ class hui_workflow_functions():
         return hui_df
 
 
-    def save_incore_version2(self, input_df):
+    def save_incore_version2(self, input_df, savecsv: bool = True):
         """
         IN-CORE expects specific columns
         Alpha release of housing unit inventories had 
         columns in specific order
+        savecsv: False returns the IN-CORE columns without saving the file
         """
 
         output_df = input_df.copy()
@@ -330,10 +356,11 @@ class hui_workflow_functions():
         print("    Save IN-CORE v2 data file.")
         print("***************************************\n")
 
-        csv_filepath = self.outputfolders['top']+"/"+output_filename+'.csv'
-        savefile = os.path.join(os.getcwd(), csv_filepath)
-        output_df.to_csv(savefile, index=False)
-        print("File saved:",savefile)       
+        if savecsv == True:
+            csv_filepath = self.outputfolders['top']+"/"+output_filename+'.csv'
+            savefile = os.path.join(os.getcwd(), csv_filepath)
+            output_df.to_csv(savefile, index=False)
+            print("File saved:",savefile)       
         return output_df    
 
 
@@ -5,6 +5,7 @@
 # New functions in that could be added to https://github.com/IN-CORE/pyincore/blob/master/pyincore
 
 import pandas as pd
+import numpy as np
 import os                 # Operating System (os) For folders and finding working directory
 import wget # for importing data from the web
 import sys  # saving CSV files
@@ -16,6 +17,8 @@ import itertools # Used in creating list of possible pairs of jobs
 
 from pyincoredata_addons.SourceData.lehd_ces_census_gov.\
     _lodes_data_structure import all_segstems
+from pyncoda.ncoda_00i_idutils import make_uniqueid, zfill_int
+from pyncoda.ncoda_00k_geokeys import geokey_index
 
 def download_lodes(year: str, 
                  od : str,
@@ -149,10 +152,12 @@ def get_statelist(df, geocodevar):
     """
     # Create a 15 character string based on Census Block that is zero padded
     # States such as Alabama have a FIPS code of 01 - without zfill it would be 1
-    df[geocodevar+'_str'] = df[geocodevar].apply(lambda x : str(int(x)).zfill(15))
-    df['stfips'] = df[geocodevar+'_str'].str[0:2]
+    geokeys = geokey_index(df[geocodevar])
+    df[geocodevar+'_str'] = geokeys.strings('Block')
+    df['stfips'] = geokeys.strings('State')
     # Create lower case state abbrevation based on fips code
-    df['stabbr'] = df['stfips'].apply(lambda x :  str.lower(us.states.lookup(x).abbr))
+    df['stabbr'] = geokeys.apply_unique('State',
+        lambda x :  str.lower(us.states.lookup(x).abbr))
 
     home_states = df['stabbr'].unique().tolist()
 
@@ -202,12 +207,13 @@ def check_out_of_state_rac(df):
     # using the home and work geocodes (blockid) find the 2 digit state fips code
     # using the 2 digit state fips code find the state abbreviation
     for prefix in ['h','w']:
-        df.loc[:, prefix+'_geocode'+'_str'] = df[prefix+'_geocode'].apply(lambda x : str(int(x)).zfill(15))
-        df.loc[:, prefix+'_stfips'] = df[prefix+'_geocode'+'_str'].str[0:2]
+        geokeys = geokey_index(df[prefix+'_geocode'])
+        df.loc[:, prefix+'_geocode'+'_str'] = geokeys.strings('Block')
+        df.loc[:, prefix+'_stfips'] = geokeys.strings('State')
         # Create lower case state abbrevation based on fips code
-        df.loc[:, prefix+'_stabbr'] = df[prefix+'_stfips'].apply(lambda x :  str.lower(us.states.lookup(x).abbr))
-        df.loc[:, prefix+'_geocode'+'_str'] = df[prefix+'_geocode'].apply(lambda x : str(int(x)).zfill(15))
-        df.loc[:, prefix+'_countyfips'] = df[prefix+'_geocode'+'_str'].str[0:5]
+        df.loc[:, prefix+'_stabbr'] = geokeys.apply_unique('State',
+            lambda x :  str.lower(us.states.lookup(x).abbr))
+        df.loc[:, prefix+'_countyfips'] = geokeys.strings('County')
         
     # create out-of-state varaible 
     df.loc[:, 'out-of-state'] = 0
@@ -326,7 +332,7 @@ def import_lodes(year: str,
     append_studyarea = []
     for geocode_var in geocode_vars:
         # Convert BLOCKID10 to a string - zero padded 15 characters long
-        df[geocode_var+'str'] = df[geocode_var].apply(lambda x : str(int(x)).zfill(15))
+        df[geocode_var+'str'] = geokey_index(df[geocode_var]).strings('Block')
         
         # Add County Variable - from Geography Crosswalk
         # Note can not call the variable County - will be included in column list
@@ -971,7 +977,15 @@ def wac_rac_od_joblist(od_df, wac_df,rac_df, char_vars):
     Function uses od, wac, and rac data frames to select jobs that match across
     the OD pairs.
 
-    Function loops through each OD Pair to further reduce possible job type combinations
+    Each OD pair is joined to the WAC jobs in the work block and the RAC jobs
+    in the home block with the same jobidod. Jobs have to match on jobidac,
+    jobidac_counter, year and the characteristic variables.
+    The joins are done for all OD pairs at once - same result as looping
+    through each OD pair and merging the WAC and RAC jobs.
+
+    OD pairs without a match and with a home block in another state keep
+    the OD jobs (anti-join). In these cases the wac_rac file will only have
+    age, earnings and supersector data.
 
     od_df = reshapecascade_df['od','na'].copy()
     wac_df = df_append_wide_keep['wac'].copy()
@@ -980,56 +994,75 @@ def wac_rac_od_joblist(od_df, wac_df,rac_df, char_vars):
     """
 
     print("Checking jobs that appear in across OD pairs for WAC and RAC.")
-    wac_rac = {} # start empty dictionary to collect dataframes
-
-
-    # Itterate through each row of the origin-destination file
-    for index, odpair in od_df.iterrows():
-        #print(odpair['jobidod'])
-        
-        # what is the jobidod counter 
-        # This will help determine how many job pairs need to be selected 
-        jobidod_counter = odpair['jobidod_counter']
-        # Select Observations from WAC and RAC to merge
-        wac = wac_df.loc[(wac_df['jobidod'] == odpair['jobidod']) &
-                        (wac_df['w_geocode'] == odpair['w_geocode'])].copy()
-        rac = rac_df.loc[(rac_df['jobidod'] == odpair['jobidod']) &
-                        (rac_df['h_geocode'] == odpair['h_geocode'])].copy()
-        
-        # Find char vars
-        possible_char_vars = char_vars
-        merge_char_vars = [col for col in wac if col in possible_char_vars]
-        # merge WAC with RAC to find index
-        wac_rac[index] = pd.merge(left = wac,
-                        right = rac[['jobidod','jobidac','jobidac_counter',\
-                            'h_geocode','year']+merge_char_vars],
-                        left_on = ['jobidod','jobidac','jobidac_counter',\
-                            'year']+merge_char_vars,
-                        right_on = ['jobidod','jobidac','jobidac_counter',\
-                            'year']+merge_char_vars,
-                        how = "inner",
-                        validate= "one_to_one")
-        # Check to see if the merge worked - for RAC that are out of state the 
-        # WAC_RAC file may not have any observations
-        h_geocode_str = str(int(odpair['h_geocode'])).zfill(15)
-        rac_stfips = h_geocode_str[0:2]
-        w_geocode_str = str(int(odpair['w_geocode'])).zfill(15)
-        wac_stfips = w_geocode_str[0:2]
-        out_of_state_rac = wac_stfips != rac_stfips
-        if (len(wac_rac[index]) == 0) & (out_of_state_rac):
-            # if no data for wac_rac merge set wac_rac equal to the odpair
-            # In these cases the wac_rac file will only have age, earnings and supersector data
-            wac_rac[index] = od_df.loc[(od_df['jobidod'] == odpair['jobidod']) &
-                        (od_df['h_geocode'] == odpair['h_geocode'])].copy()
-        #print("For ",index, odpair['jobidod']," \
-        # the list of wac-od-rac jobtypes inlcudes: ",len(wac_rac[index]))
-        # Add job od id counter
-        #print('setting jobidod counter to',jobidod_counter,'for pair',w_geocode_str,h_geocode_str,)
-        wac_rac[index]['jobidod_counter'] = jobidod_counter
 
-        
-    # Stack wac + rac observations
-    wac_rac_od = pd.concat(wac_rac.values(), ignore_index=True)
+    # Find char vars
+    possible_char_vars = char_vars
+    merge_char_vars = [col for col in wac_df if col in possible_char_vars]
+    job_vars = ['jobidod','jobidac','jobidac_counter','year']+merge_char_vars
+
+    # OD pairs with position to keep the order of the OD file
+    odpair_vars = ['jobidod','w_geocode','h_geocode','jobidod_counter']
+    odpairs = od_df[odpair_vars].reset_index(drop = True)
+    odpairs['odpair_row'] = np.arange(odpairs.shape[0])
+
+    # Jobs can only match one job in each OD pair
+    wac_df = wac_df.reset_index(drop = True)
+    rac_df = rac_df.reset_index(drop = True)
+    for od_jobs_df, geo_var in [(wac_df, 'w_geocode'), (rac_df, 'h_geocode')]:
+        od_jobs_in_pairs = pd.merge(left = od_jobs_df[[geo_var]+job_vars],
+                                    right = odpairs[['jobidod',geo_var]].drop_duplicates(),
+                                    on = ['jobidod',geo_var],
+                                    how = 'inner')
+        if od_jobs_in_pairs.duplicated(subset = [geo_var]+job_vars).any():
+            raise pd.errors.MergeError("Merge keys are not unique in "+geo_var+
+                                       " job list; not a one-to-one merge")
+
+    # Join OD pairs to WAC jobs in work block
+    wac_df['job_row'] = np.arange(wac_df.shape[0])
+    wac_od = pd.merge(left = odpairs[['odpair_row','jobidod','w_geocode','h_geocode']],
+                      right = wac_df,
+                      on = ['jobidod','w_geocode'],
+                      how = 'inner')
+    # Join to RAC jobs in home block
+    wac_rac_od = pd.merge(left = wac_od,
+                          right = rac_df[['h_geocode']+job_vars],
+                          on = ['h_geocode']+job_vars,
+                          how = 'inner')
+    wac_rac_od = wac_rac_od.sort_values(by = ['odpair_row','job_row'])
+    wac_rac_od = pd.merge(left = wac_rac_od,
+                          right = odpairs[['odpair_row','jobidod_counter']],
+                          on = 'odpair_row',
+                          how = 'left')
+    # Same columns as the merged WAC + RAC jobs
+    col_list = [col for col in wac_df if col not in ['job_row','jobidod_counter']] + \
+        ['h_geocode','jobidod_counter','odpair_row']
+    wac_rac_od = wac_rac_od[col_list]
+
+    # Check to see if the merge worked - for RAC that are out of state the 
+    # WAC_RAC file may not have any observations
+    unmatched = odpairs.loc[~odpairs['odpair_row'].isin(wac_rac_od['odpair_row'])]
+    rac_stfips = zfill_int(unmatched['h_geocode'], 15).str[0:2].values
+    wac_stfips = zfill_int(unmatched['w_geocode'], 15).str[0:2].values
+    out_of_state_rac = unmatched.loc[wac_stfips != rac_stfips]
+    # if no data for wac_rac merge set wac_rac equal to the od jobs
+    # with the same jobidod and home block
+    od_jobs = od_df.reset_index(drop = True)
+    od_jobs['job_row'] = np.arange(od_jobs.shape[0])
+    od_fallback = pd.merge(left = out_of_state_rac[['odpair_row','jobidod','h_geocode','jobidod_counter']],
+                           right = od_jobs.drop(columns = ['jobidod_counter']),
+                           on = ['jobidod','h_geocode'],
+                           how = 'inner')
+    od_fallback = od_fallback.sort_values(by = ['odpair_row','job_row'])
+    od_fallback = od_fallback[list(od_df.columns) + ['odpair_row']]
+
+    # Stack wac + rac observations in order of OD pairs
+    stack_list = [wac_rac_od, od_fallback]
+    if (od_fallback.shape[0] > 0) & (wac_rac_od.shape[0] > 0):
+        if od_fallback['odpair_row'].min() < wac_rac_od['odpair_row'].min():
+            stack_list = [od_fallback, wac_rac_od]
+    wac_rac_od = pd.concat(stack_list, ignore_index=True)
+    wac_rac_od = wac_rac_od.sort_values(by = 'odpair_row', kind = 'stable')
+    wac_rac_od = wac_rac_od.drop(columns = ['odpair_row']).reset_index(drop = True)
 
     # Keep only observations where the Area Characteristics counter matches the OD counter
     #wac_rac_od = wac_rac_od.loc[wac_rac_od['jobidac_counter'] == wac_rac_od['jobidod_counter']]
@@ -1111,17 +1144,21 @@ def add_latlon(df):
     append_states = []
 
     # Add state list to work states
-    df['w_geocode_str'] = df['w_geocode'].apply(lambda x : str(int(x)).zfill(15))
-    df['w_stfips'] = df['w_geocode_str'].str[0:2]
+    geokeys = geokey_index(df['w_geocode'])
+    df['w_geocode_str'] = geokeys.strings('Block')
+    df['w_stfips'] = geokeys.strings('State')
     # Create lower case state abbrevation based on fips code
-    df['w_stabbr'] = df['w_stfips'].apply(lambda x :  str.lower(us.states.lookup(x).abbr))
+    df['w_stabbr'] = geokeys.apply_unique('State',
+        lambda x :  str.lower(us.states.lookup(x).abbr))
     work_state_list = df['w_stabbr'].unique().tolist()
 
     # Add state list to home states - home states can be outside of the community state
-    df['h_geocode_str'] = df['h_geocode'].apply(lambda x : str(int(x)).zfill(15))
-    df['h_stfips'] = df['h_geocode_str'].str[0:2]
+    geokeys = geokey_index(df['h_geocode'])
+    df['h_geocode_str'] = geokeys.strings('Block')
+    df['h_stfips'] = geokeys.strings('State')
     # Create lower case state abbrevation based on fips code
-    df['h_stabbr'] = df['h_stfips'].apply(lambda x :  str.lower(us.states.lookup(x).abbr))
+    df['h_stabbr'] = geokeys.apply_unique('State',
+        lambda x :  str.lower(us.states.lookup(x).abbr))
 
     home_state_list = df['h_stabbr'].unique().tolist()
 
@@ -1268,22 +1305,25 @@ def wkt_line(df,x1,y1,x2,y2):
 
 def add_stfips(df,geocodevar):
     
-    df[geocodevar+'_str'] = df[geocodevar].apply(lambda x : str(int(x)).zfill(15))
-    df[geocodevar+'_stfips'] = df[geocodevar+'_str'].str[0:2]
+    geokeys = geokey_index(df[geocodevar])
+    df[geocodevar+'_str'] = geokeys.strings('Block')
+    df[geocodevar+'_stfips'] = geokeys.strings('State')
     
     return df
 
 def add_tractid(df,geocodevar):
     
-    df[geocodevar+'_str'] = df[geocodevar].apply(lambda x : str(int(x)).zfill(15))
-    df[geocodevar+'_tractid'] = df[geocodevar+'_str'].str[0:11]
+    geokeys = geokey_index(df[geocodevar])
+    df[geocodevar+'_str'] = geokeys.strings('Block')
+    df[geocodevar+'_tractid'] = geokeys.strings('Tract')
     
     return df
 
 def add_countyid(df,geocodevar):
     
-    df[geocodevar+'_str'] = df[geocodevar].apply(lambda x : str(int(x)).zfill(15))
-    df[geocodevar+'_countyid'] = df[geocodevar+'_str'].str[0:5]
+    geokeys = geokey_index(df[geocodevar])
+    df[geocodevar+'_str'] = geokeys.strings('Block')
+    df[geocodevar+'_countyid'] = geokeys.strings('County')
     
     return df
     
@@ -1499,8 +1539,9 @@ def add_primarykey(input_df, primary_key_name, uniqueid_part1):
         # Need to zero pad part2 find the max number of characters
         part2_max = add_uniqueid_df['unique_part2'].max()
         part2_maxdigits = len(str(part2_max))
-        add_uniqueid_df[primary_key_name] = add_uniqueid_df[uniqueid_part1] + \
-            add_uniqueid_df['unique_part2'].apply(lambda x : str(int(x)).zfill(part2_maxdigits))
+        add_uniqueid_df[primary_key_name] = make_uniqueid(
+            add_uniqueid_df[uniqueid_part1], add_uniqueid_df['unique_part2'],
+            part2_maxdigits)
         # Check if values are unique
         error = primary_key_error_check(add_uniqueid_df,primary_key_name)
     
@@ -1,6 +1,5 @@
 import sys
 import us
-import os
 import numpy as np
 import pandas as pd
 
@@ -22,6 +21,9 @@ from . import remove_duplicate_block_error
 from . import add_total_count_byvar
 from . import add_jobidod_pair
 
+from pyncoda.ncoda_00j_checkpoint import checkpoint_exists, read_checkpoint, \
+    save_checkpoint
+
 # Use LODES Data Structure set of dictionaires to setup loops
 from  . import all_ods, all_segparts, all_jobtypes, all_segstems, all_mxjobtypes
 
@@ -115,13 +117,14 @@ def obtain_lodes_county_loop(countylist,
                     seg_stem = segstems[newvar]
                     # Check if block level list has already been made
                     filename = f'{state}_{countyfips}_{od}_{year}_{seg_stem}'
-                    savefile_path = sys.path[0]+"/"+outputfoldername+"/"+filename+".csv"
+                    savefolder = sys.path[0]+"/"+outputfoldername
 
                     # Check if selected data already exists - if yes break out of function
-                    if os.path.exists(savefile_path):
-                        # read in existing CSV - make sure to check data types 
+                    if checkpoint_exists(savefolder, filename):
+                        # read in existing file - make sure to check data types 
                         # year is a string
-                        stacked_df[state,countyfips,od,year,seg_stem] = pd.read_csv(savefile_path, 
+                        stacked_df[state,countyfips,od,year,seg_stem] = read_checkpoint(savefolder,
+                                                                                    filename,
                                                                                     dtype={'year' : str})
                     else:
                         segparts_list = list_of_segements_or_parts[newvar]
@@ -175,7 +178,8 @@ def obtain_lodes_county_loop(countylist,
                         stacked_df[state,countyfips,od,year,seg_stem] = keep_nonzeros(stacked_df[state,countyfips,od,year,seg_stem],'jobcount')
 
                         # Save stacked file
-                        stacked_df[state,countyfips,od,year,seg_stem].to_csv(savefile_path)
+                        save_checkpoint(stacked_df[state,countyfips,od,year,seg_stem],
+                                        savefolder, filename, index = True)
 
     return stacked_df
 
@@ -102,6 +102,12 @@ def mcma_sa_job_concurrent_futures(function_name, num_workers, *args):
     """
     output_dfs = []
 
+    # Run in this process - avoids starting a pool inside a scheduler worker
+    if num_workers <= 1:
+        for ret1 in map(function_name, *args):
+            output_dfs.append(ret1)
+        return output_dfs
+
     with concurrent.futures.ProcessPoolExecutor(
             max_workers=num_workers) as executor:
         for ret1 in executor.map(function_name, *args):
@@ -425,11 +431,18 @@ def outer_mcmc_sa_loop(years,
                  random_accept_threshold,
                  mcmcsa_filepath,
                  start_reduction_threshold,
-                 num_procs=1
+                 num_procs=1,
+                 use_scheduler: bool = False,
+                 max_workers: int = None
                 ):
     """
     Part2 takes the output of part1 and attempts to run the MCMC SA on 
     all work blocks for the jobtype
+
+    use_scheduler: run the work blocks in parallel on max_workers processes
+        with lodes_scheduler. Each work block starts from
+        random_accept_threshold. The sequential loop keeps the threshold
+        set by the previous work block, so results can differ.
     """
 
     np.random.seed(seed)
@@ -453,154 +466,35 @@ def outer_mcmc_sa_loop(years,
     # start with blocks that have high probability of selection first
     joblist_df = joblist_df.sort_values(by='initprobability_selected', ascending=False)
 
-    wac_rac_od_joblist_df = {}
+    if use_scheduler == True:
+        return outer_mcmc_sa_scheduler(years = years,
+                        focus_jobtype = focus_jobtype,
+                        stacked_jobtype_df = stacked_jobtype_df,
+                        joblist_df = joblist_df,
+                        seed = seed,
+                        random_accept_threshold = random_accept_threshold,
+                        mcmcsa_filepath = mcmcsa_filepath,
+                        start_reduction_threshold = start_reduction_threshold,
+                        max_workers = max_workers)
+
     output_df_dict = {}    
     work_blocks = get_workblock_list(joblist_df)
 
     for year in years:
         #for work_block in work_blocks[0:4]: # to test on part of work block list
         for work_block in work_blocks:
-            print("Running MCMC SA on block",work_block)
-            wac_rac_od_joblist_df[work_block] = {}
-            wac_joblist_df = {}
-
-            possible_block_joblist_df = joblist_df.loc[\
-                joblist_df['w_geocode']==work_block].copy()
-
-            # Start MCMC SA with a random selection of jobs
-            possible_block_joblist_df =data_util.add_probability_job_selected(
-                df = possible_block_joblist_df,
-                prob_value = 'jobidac', 
-                by_vars = ['w_geocode','h_geocode','jobidod','jobidod_counter',\
-                    'jobtype','jobidod_pair'])
-            rand_select_alljobs_df = rand_select_jobs(possible_block_joblist_df, seedk)
-
-            county_jobcounts_df = stacked_jobtype_df[focus_jobtype]
-            block_str = str(int(work_block)).zfill(15)
-            stfips = block_str[0:2]
-            stabbr = str.lower(us.states.lookup(stfips).abbr)
-            countyfips = block_str[0:5]
-            # Compare random selection of jobs with the WAC jobs list by Earnings, Age, and SuperSector
-            wac_joblist_df = {}
-            wac_joblist_df['Earnings'] = data_util.explorebyblock(county_jobcounts_df[stabbr,countyfips,\
-                'wac',year,'SE'],'w_geocode',[work_block])
-            wac_joblist_df['Age'] = data_util.explorebyblock(county_jobcounts_df[stabbr,countyfips,\
-                'wac',year,'SA'],'w_geocode',[work_block])
-            wac_joblist_df['SuperSector'] = data_util.explorebyblock(county_jobcounts_df[stabbr,countyfips,\
-                'wac',year,'SI'],'w_geocode',[work_block])
-
-            start_totalfitness = calculate_total_fitness(rand_select_alljobs_df, 
-                                wac_joblist_df, 
-                                iteration =1, seed = seedi)
-            start_combinedfitness = calculate_combined_fitness(rand_select_alljobs_df, 
-                                wac_joblist_df, 
-                                iteration =1, seed = seedi)
-            outer_start_fitness = start_totalfitness['fitness'].squeeze()
-            outer_combined_fitness = start_combinedfitness['fitness'].squeeze()
-            print('The starting outer total fitness =',outer_start_fitness,\
-                'and outer combined fitness =',outer_combined_fitness)
-            # Store previous combined fitness to check if loop gets stuck
-            previous_outer_combined_fitness = outer_combined_fitness
-            stuck_outer1_loop = 0
-
-            # Start with a low reduction threshold
-            reduction_threshold = start_reduction_threshold
-            while (stuck_outer1_loop < 3):
-                print("#################################")
-                print('Attempt to reduce size of possible job list by',reduction_threshold)
-                print("#################################")
-                wac_rac_od_joblist_df[work_block][year], wac_joblist_df[work_block] = \
-                    mcmc_sa_loop(work_block = work_block, 
-                                        year = year,
-                                        county_jobcounts_df = stacked_jobtype_df[focus_jobtype],
-                                        possible_block_joblist_df = possible_block_joblist_df,
-                                        seedk = seedk,
-                                        seedi = seedi,
-                                        seedj = seedj,
-                                        random_accept_threshold = random_accept_threshold,
-                                        reduction_threshold = reduction_threshold,
-                                        num_procs=num_procs)
-            
-                # Clean up possible joblist for next run
-                possible_block_joblist_df = \
-                    drop_extra_columns(wac_rac_od_joblist_df[work_block][year])
-
-                outer_combined_fitness_df = calculate_combined_fitness(
-                        possible_block_joblist_df, 
-                        wac_joblist_df[work_block], iteration =1, seed = seedi)
-                outer_combined_fitness = outer_combined_fitness_df['fitness'].squeeze()
-                #print('Combined fitness',combined_fitness)
-
-                # Check if Combined fitness is stuck
-                if outer_combined_fitness < previous_outer_combined_fitness:
-                    previous_outer_combined_fitness = outer_combined_fitness
-                elif outer_combined_fitness >= previous_outer_combined_fitness:
-                    stuck_outer1_loop += 1
-                if stuck_outer1_loop > 3:
-                    print("  Outer Combined Fitness Loop seems stuck at fitness",\
-                        outer_combined_fitness)
-                    print("  Outer loop will end.")  
-
-                # Check if length of possible joblist is equal to expected length
-                length_possible_joblist = len(possible_block_joblist_df)
-                length_expected_joblist = \
-                    np.array(wac_joblist_df[work_block]['SuperSector']['C000']).sum()
-                if length_possible_joblist == length_expected_joblist:
-                    print("Possible and expected job lists have the same length:",\
-                        length_possible_joblist)
-                    if outer_combined_fitness != 0:
-                        print("If desired fitness not met \n",
-                        "Consider changing random seed and starting over to get lower fitness.")
-                    break
-                # Increase reduction threshold
-                reduction_threshold = reduction_threshold + 0.1
-                # increase acceptance of randomness
-                #random_accept_threshold = random_accept_threshold + 0.05
-            
-            if (outer_combined_fitness != 0) & \
-                (length_possible_joblist > length_expected_joblist):
-                # Run MCMC SA on reduced joblist - without splitting the data
-                # adjust threshholds for final MCMC SA loop 
-                ## NEED A BETTER WAY TO DEFINE THESE THRESHOLDS
-                print("****************************")
-                print("Combined fitness",outer_combined_fitness)
-                print("Try to run MCMC SA without split")
-                print("****************************")
-                random_accept_threshold = 0.05
-                reduction_threshold = 0.9
-                    # Start MCMC SA with a random selection of jobs
-                possible_block_joblist_df = data_util.add_probability_job_selected(
-                    df = possible_block_joblist_df,
-                    prob_value = 'jobidac', 
-                    by_vars = ['w_geocode','h_geocode','jobidod','jobidod_counter',\
-                        'jobtype','jobidod_pair'])
-
-                # Start MCMC SA with a new random selection of jobs - round 2
-                rand_select_alljobsr2_df = rand_select_jobs(
-                        possible_block_joblist_df, seedk)
-
-                output_df_dict[work_block], mcmcsa_df = markov_chain_monte_carlo_simanneal(
-                                    rand_select_alljobsr2_df, 
-                                    wac_joblist_df[work_block],
-                                    random_accept_threshold = random_accept_threshold,
-                                    reduction_threshold = reduction_threshold,
-                                    seedi = seedi,
-                                    seedj = seedj,
-                                    seedk = seedk)
-            else:
-                output_df_dict[work_block] = possible_block_joblist_df
-            
-            # What is the final fitness
-            final_totalfitness = calculate_total_fitness(rand_select_alljobs_df, 
-                                wac_joblist_df, 
-                                iteration =1, seed = seedi)
-            final_combinedfitness = calculate_combined_fitness(rand_select_alljobs_df, 
-                                wac_joblist_df, 
-                                iteration =1, seed = seedi)
-            outer_final_fitness = final_totalfitness['fitness'].squeeze()
-            outer_combined_final_fitness = final_combinedfitness['fitness'].squeeze()
-            print('The final outer total fitness =',outer_final_fitness,\
-                'and outer combined fitness =',outer_combined_final_fitness)
+            # Next work block starts from the threshold used by this block
+            output_df_dict[work_block], random_accept_threshold = \
+                mcmc_sa_work_block(work_block = work_block,
+                                year = year,
+                                joblist_df = joblist_df,
+                                county_jobcounts_df = stacked_jobtype_df[focus_jobtype],
+                                seedi = seedi,
+                                seedj = seedj,
+                                seedk = seedk,
+                                random_accept_threshold = random_accept_threshold,
+                                start_reduction_threshold = start_reduction_threshold,
+                                num_procs = num_procs)
 
             # Save file for workblock
             work_block_string = str(work_block).zfill(15)
@@ -621,6 +515,223 @@ def outer_mcmc_sa_loop(years,
     
     return output_df
 
+def outer_mcmc_sa_scheduler(years,
+                 focus_jobtype,
+                 stacked_jobtype_df,
+                 joblist_df,
+                 seed,
+                 random_accept_threshold,
+                 mcmcsa_filepath,
+                 start_reduction_threshold,
+                 max_workers = None
+                ):
+    """
+    Part2 with the work blocks run by lodes_scheduler.
+    Work block files are saved with the same names as outer_mcmc_sa_loop,
+    and a rerun skips work blocks that are already saved.
+    """
+    from .lodes_scheduler import run_lodes_scheduler, checkpoint_name, \
+        read_task_checkpoint
+
+    checkpoint_folder = os.path.dirname(mcmcsa_filepath)
+    outputfolder = os.path.relpath(checkpoint_folder, sys.path[0])
+    # Job list by county - outer_mcmc_sa_input makes one county
+    joblist_county = joblist_df['w_geocode'].map(
+        lambda work_block: str(int(work_block)).zfill(15)[0:5])
+    countylist = joblist_county.unique().tolist()
+    mcmcsa_input_df = {(countyfips, year) : joblist_df.loc[joblist_county == countyfips]
+                       for countyfips in countylist for year in years}
+
+    status_df = run_lodes_scheduler(stacked_jobtype_df,
+                        focus_jobtype = focus_jobtype,
+                        years = years,
+                        outputfolder = outputfolder,
+                        seed = seed,
+                        random_accept_threshold = random_accept_threshold,
+                        start_reduction_threshold = start_reduction_threshold,
+                        countylist = countylist,
+                        max_workers = max_workers,
+                        mcmcsa_input_df = mcmcsa_input_df)
+    if (status_df['status'] != 'done').any():
+        print("Some work blocks did not finish - run again to finish the remaining blocks.")
+        return None
+
+    # Same output as the last year of outer_mcmc_sa_loop
+    output_df = pd.concat([read_task_checkpoint(checkpoint_folder,
+                            checkpoint_name(('combine', countyfips, years[-1]),
+                                            focus_jobtype, seed))
+                           for countyfips in countylist], ignore_index=True)
+
+    return output_df
+
+def mcmc_sa_work_block(work_block,
+                 year,
+                 joblist_df,
+                 county_jobcounts_df,
+                 seedi,
+                 seedj,
+                 seedk,
+                 random_accept_threshold,
+                 start_reduction_threshold,
+                 num_procs = 1
+                ):
+    """
+    Run the MCMC SA on the possible job list for a single work block.
+    Each block starts from the given thresholds, so blocks can run in any
+    order or in parallel (see lodes_scheduler). outer_mcmc_sa_loop passes
+    the returned random_accept_threshold to the next block.
+
+    joblist_df = possible job list - output of outer_mcmc_sa_input
+    county_jobcounts_df = stacked_jobtype_df[focus_jobtype]
+    Returns the job list for the work block with select_job and the
+    random_accept_threshold at the end of the block - the MCMC SA without
+    split lowers it to 0.05
+    """
+    wac_rac_od_joblist_df = {}
+    output_df_dict = {}
+    print("Running MCMC SA on block",work_block)
+    wac_rac_od_joblist_df[work_block] = {}
+    wac_joblist_df = {}
+
+    possible_block_joblist_df = joblist_df.loc[\
+        joblist_df['w_geocode']==work_block].copy()
+
+    # Start MCMC SA with a random selection of jobs
+    possible_block_joblist_df =data_util.add_probability_job_selected(
+        df = possible_block_joblist_df,
+        prob_value = 'jobidac', 
+        by_vars = ['w_geocode','h_geocode','jobidod','jobidod_counter',\
+            'jobtype','jobidod_pair'])
+    rand_select_alljobs_df = rand_select_jobs(possible_block_joblist_df, seedk)
+
+    block_str = str(int(work_block)).zfill(15)
+    stfips = block_str[0:2]
+    stabbr = str.lower(us.states.lookup(stfips).abbr)
+    countyfips = block_str[0:5]
+    # Compare random selection of jobs with the WAC jobs list by Earnings, Age, and SuperSector
+    wac_joblist_df = {}
+    wac_joblist_df['Earnings'] = data_util.explorebyblock(county_jobcounts_df[stabbr,countyfips,\
+        'wac',year,'SE'],'w_geocode',[work_block])
+    wac_joblist_df['Age'] = data_util.explorebyblock(county_jobcounts_df[stabbr,countyfips,\
+        'wac',year,'SA'],'w_geocode',[work_block])
+    wac_joblist_df['SuperSector'] = data_util.explorebyblock(county_jobcounts_df[stabbr,countyfips,\
+        'wac',year,'SI'],'w_geocode',[work_block])
+
+    start_totalfitness = calculate_total_fitness(rand_select_alljobs_df, 
+                        wac_joblist_df, 
+                        iteration =1, seed = seedi)
+    start_combinedfitness = calculate_combined_fitness(rand_select_alljobs_df, 
+                        wac_joblist_df, 
+                        iteration =1, seed = seedi)
+    outer_start_fitness = start_totalfitness['fitness'].squeeze()
+    outer_combined_fitness = start_combinedfitness['fitness'].squeeze()
+    print('The starting outer total fitness =',outer_start_fitness,\
+        'and outer combined fitness =',outer_combined_fitness)
+    # Store previous combined fitness to check if loop gets stuck
+    previous_outer_combined_fitness = outer_combined_fitness
+    stuck_outer1_loop = 0
+
+    # Start with a low reduction threshold
+    reduction_threshold = start_reduction_threshold
+    while (stuck_outer1_loop < 3):
+        print("#################################")
+        print('Attempt to reduce size of possible job list by',reduction_threshold)
+        print("#################################")
+        wac_rac_od_joblist_df[work_block][year], wac_joblist_df[work_block] = \
+            mcmc_sa_loop(work_block = work_block, 
+                                year = year,
+                                county_jobcounts_df = county_jobcounts_df,
+                                possible_block_joblist_df = possible_block_joblist_df,
+                                seedk = seedk,
+                                seedi = seedi,
+                                seedj = seedj,
+                                random_accept_threshold = random_accept_threshold,
+                                reduction_threshold = reduction_threshold,
+                                num_procs=num_procs)
+    
+        # Clean up possible joblist for next run
+        possible_block_joblist_df = \
+            drop_extra_columns(wac_rac_od_joblist_df[work_block][year])
+
+        outer_combined_fitness_df = calculate_combined_fitness(
+                possible_block_joblist_df, 
+                wac_joblist_df[work_block], iteration =1, seed = seedi)
+        outer_combined_fitness = outer_combined_fitness_df['fitness'].squeeze()
+        #print('Combined fitness',combined_fitness)
+
+        # Check if Combined fitness is stuck
+        if outer_combined_fitness < previous_outer_combined_fitness:
+            previous_outer_combined_fitness = outer_combined_fitness
+        elif outer_combined_fitness >= previous_outer_combined_fitness:
+            stuck_outer1_loop += 1
+        if stuck_outer1_loop > 3:
+            print("  Outer Combined Fitness Loop seems stuck at fitness",\
+                outer_combined_fitness)
+            print("  Outer loop will end.")  
+
+        # Check if length of possible joblist is equal to expected length
+        length_possible_joblist = len(possible_block_joblist_df)
+        length_expected_joblist = \
+            np.array(wac_joblist_df[work_block]['SuperSector']['C000']).sum()
+        if length_possible_joblist == length_expected_joblist:
+            print("Possible and expected job lists have the same length:",\
+                length_possible_joblist)
+            if outer_combined_fitness != 0:
+                print("If desired fitness not met \n",
+                "Consider changing random seed and starting over to get lower fitness.")
+            break
+        # Increase reduction threshold
+        reduction_threshold = reduction_threshold + 0.1
+        # increase acceptance of randomness
+        #random_accept_threshold = random_accept_threshold + 0.05
+    
+    if (outer_combined_fitness != 0) & \
+        (length_possible_joblist > length_expected_joblist):
+        # Run MCMC SA on reduced joblist - without splitting the data
+        # adjust threshholds for final MCMC SA loop 
+        ## NEED A BETTER WAY TO DEFINE THESE THRESHOLDS
+        print("****************************")
+        print("Combined fitness",outer_combined_fitness)
+        print("Try to run MCMC SA without split")
+        print("****************************")
+        random_accept_threshold = 0.05
+        reduction_threshold = 0.9
+            # Start MCMC SA with a random selection of jobs
+        possible_block_joblist_df = data_util.add_probability_job_selected(
+            df = possible_block_joblist_df,
+            prob_value = 'jobidac', 
+            by_vars = ['w_geocode','h_geocode','jobidod','jobidod_counter',\
+                'jobtype','jobidod_pair'])
+
+        # Start MCMC SA with a new random selection of jobs - round 2
+        rand_select_alljobsr2_df = rand_select_jobs(
+                possible_block_joblist_df, seedk)
+
+        output_df_dict[work_block], mcmcsa_df = markov_chain_monte_carlo_simanneal(
+                            rand_select_alljobsr2_df, 
+                            wac_joblist_df[work_block],
+                            random_accept_threshold = random_accept_threshold,
+                            reduction_threshold = reduction_threshold,
+                            seedi = seedi,
+                            seedj = seedj,
+                            seedk = seedk)
+    else:
+        output_df_dict[work_block] = possible_block_joblist_df
+    
+    # What is the final fitness
+    final_totalfitness = calculate_total_fitness(rand_select_alljobs_df, 
+                        wac_joblist_df, 
+                        iteration =1, seed = seedi)
+    final_combinedfitness = calculate_combined_fitness(rand_select_alljobs_df, 
+                        wac_joblist_df, 
+                        iteration =1, seed = seedi)
+    outer_final_fitness = final_totalfitness['fitness'].squeeze()
+    outer_combined_final_fitness = final_combinedfitness['fitness'].squeeze()
+    print('The final outer total fitness =',outer_final_fitness,\
+        'and outer combined fitness =',outer_combined_final_fitness)
+
+    return output_df_dict[work_block], random_accept_threshold
+
 def compare_expected_possible(joblist_mcmcsa_df, 
                                 stacked_jobtype_df,
                                 year = '2010',
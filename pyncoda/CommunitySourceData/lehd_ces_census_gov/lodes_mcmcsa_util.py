@@ -17,6 +17,7 @@ from . import all_stems
 
 # open, read, and execute python program with reusable commands
 import pyincoredata_addons.SourceData.lehd_ces_census_gov.lodes_datautil as data_util
+from pyncoda.ncoda_00k_geokeys import geokey_index
 
 def add_random_number(df, seed_i, by_vars = ['w_geocode','h_geocode','jobidod','jobidod_counter']):
     df = df.sort_index()
@@ -304,13 +305,145 @@ def calculate_total_fitness(df1,
     
     return compare_total_fitness_df
 
+class total_fitness_delta():
+    """
+    Total fitness with job counts stored as numpy arrays.
+
+    Same fitness as calculate_total_fitness - for each characteristic the
+    sum of absolute differences between the selected job count and the
+    WAC total by w_geocode, jobtype and characteristic value.
+
+    Each job row has one cell per characteristic. A flip changes
+    select_job for the rows in one od pair, so the new fitness only needs
+    the counts of the cells for those rows. No dataframes are copied or
+    pivoted in the MCMC SA loop.
+    """
+
+    def __init__(self, df, wac_joblist_df,
+                 charstems = all_stems,
+                 by_vars = ['w_geocode','jobtype']):
+
+        # Same comparison table as calculate_total_fitness
+        first_key = list(wac_joblist_df.keys())[0]
+        compare_df = wac_joblist_df[first_key]
+
+        self.select_job = df['select_job'].values.astype(np.int64).copy()
+        self.chars = [char for char in df if char in charstems and char != 'jobtype']
+        self.row_cells = {}
+        self.counts = {}
+        self.targets = {}
+        self.char_fitness = {}
+        length_df = df.shape[0]
+        for char in self.chars:
+            char_stem = charstems[char]
+            target_df = compare_df
+            # Add missing education category before comparing
+            if char_stem == 'CD':
+                target_df = data_util.add_missingeducation(target_df.copy())
+            fitness_cols = [col for col in target_df if col.startswith(char_stem)]
+            categories = [int(str(col[len(char_stem):len(char_stem)+2]))
+                          for col in fitness_cols]
+            n_cat = len(categories)
+            target_sum = target_df[by_vars+fitness_cols].astype(
+                {var : int for var in fitness_cols}).groupby(by_vars).sum()
+
+            # Groups shared by the job list and the wac totals
+            keys = pd.concat([df[by_vars].reset_index(drop = True),
+                              target_sum.index.to_frame(index = False)],
+                             ignore_index = True)
+            group_codes = keys.groupby(by_vars, sort = False).ngroup().values
+            n_groups = max(group_codes.max() + 1, 0)
+            row_group = group_codes[:length_df]
+            target_group = group_codes[length_df:]
+
+            cat_pos = pd.Index(categories).get_indexer(df[char].values)
+            self.row_cells[char] = np.where((cat_pos >= 0) & (row_group >= 0),
+                                            row_group * n_cat + cat_pos, -1)
+            target = np.zeros(n_groups * n_cat, dtype = np.int64)
+            target_cells = (target_group[:, None] * n_cat + np.arange(n_cat)).ravel()
+            target[target_cells] = target_sum.values.ravel()
+            self.targets[char] = target
+
+            selected = (self.select_job == 1) & (self.row_cells[char] >= 0)
+            self.counts[char] = np.bincount(self.row_cells[char][selected],
+                                            minlength = target.shape[0]).astype(np.int64)
+            self.char_fitness[char] = int(np.abs(self.counts[char] - target).sum())
+
+        self.fitness = sum(self.char_fitness.values())
+
+    @staticmethod
+    def group_positions(df, by_vars = ['w_geocode','h_geocode','jobidod','jobidod_counter']):
+        """
+        Row positions for each od pair
+        """
+        return df.reset_index(drop = True).groupby(by_vars, sort = False).indices
+
+    def propose_flip(self, odpair_positions, flip_position):
+        """
+        Fitness if flip_position is the only selected job in the od pair.
+        Returns new fitness, new fitness by characteristic and the changes.
+        """
+        new_select = np.zeros(odpair_positions.shape[0], dtype = np.int64)
+        new_select[odpair_positions == flip_position] = 1
+        change = new_select - self.select_job[odpair_positions]
+        changed = change != 0
+        change_positions = odpair_positions[changed]
+        change = change[changed]
+
+        new_char_fitness = dict(self.char_fitness)
+        for char in self.chars:
+            cells = self.row_cells[char][change_positions]
+            valid = cells >= 0
+            if not valid.any():
+                continue
+            unique_cells, inverse = np.unique(cells[valid], return_inverse = True)
+            cell_change = np.bincount(inverse, weights = change[valid]).astype(np.int64)
+            old_count = self.counts[char][unique_cells]
+            target = self.targets[char][unique_cells]
+            new_char_fitness[char] += int(np.abs(old_count + cell_change - target).sum() -
+                                          np.abs(old_count - target).sum())
+        new_fitness = sum(new_char_fitness.values())
+
+        return new_fitness, new_char_fitness, (change_positions, change)
+
+    def apply_flip(self, new_char_fitness, changes):
+        """
+        Update selection and counts in place
+        """
+        change_positions, change = changes
+        self.select_job[change_positions] += change
+        for char in self.chars:
+            cells = self.row_cells[char][change_positions]
+            valid = cells >= 0
+            np.add.at(self.counts[char], cells[valid], change[valid])
+        self.char_fitness = dict(new_char_fitness)
+        self.fitness = sum(self.char_fitness.values())
+
+    def fitness_record(self, char_fitness, iteration, seed, accept = True):
+        """
+        Row with the same columns as calculate_total_fitness
+        """
+        record = {char+'jobtype' : char_fitness[char] for char in self.chars}
+        record['fitness'] = sum(char_fitness.values())
+        record['iteration'] = iteration
+        record['seed'] = seed
+        record['accept'] = accept
+
+        return record
+
 def markov_chain_monte_carlo_simanneal(df, 
                                        wac_joblist_df,
                                        random_accept_threshold,
                                        reduction_threshold,
                                        seedi,
                                        seedj,
-                                       seedk):
+                                       seedk,
+                                       fitness_engine: str = 'delta'):
+    """
+    fitness_engine: 'delta' updates the total fitness for each flip with
+        total_fitness_delta, 'dataframe' recalculates the total fitness
+        on a copy of the job list for each flip.
+    """
 
     i = 2
     j = 1 # outer loop
@@ -351,7 +484,13 @@ def markov_chain_monte_carlo_simanneal(df,
         index=['w_geocode','h_geocode','jobidod','jobidod_counter'],
                                 aggfunc='count')
     od_block_list.reset_index(inplace= True)
+    odpair_vars = ['w_geocode','h_geocode','jobidod','jobidod_counter']
 
+    # Delta fitness engine - job list is updated in place from the engine
+    delta_records = []
+    if fitness_engine == 'delta':
+        delta_fitness = total_fitness_delta(df, wac_joblist_df)
+        odpair_rows = total_fitness_delta.group_positions(df, odpair_vars)
 
     # Store previous combined fitness to check if loop gets stuck
     previous_combined_fitness = combined_fitness
@@ -370,6 +509,9 @@ def markov_chain_monte_carlo_simanneal(df,
             total_mcmcsa[k,1] = calculate_total_fitness(\
                 df, wac_joblist_df, iteration =k, seed = seed_k)
             old_fitness = total_mcmcsa[k,1]['fitness'].squeeze()
+            if fitness_engine == 'delta':
+                delta_fitness = total_fitness_delta(df, wac_joblist_df)
+                odpair_rows = total_fitness_delta.group_positions(df, odpair_vars)
             print('Loop',k,'Restart Total fitness',old_fitness)
 
             i = 2
@@ -394,7 +536,22 @@ def markov_chain_monte_carlo_simanneal(df,
             # loop through each od pair and select a new job
             # if the new job selected increases the fitness 
             # Then keep the new selection - if not move on to the next pair
-            for index, odpair in od_block_list.iterrows():
+            if fitness_engine == 'delta':
+                old_fitness, i = delta_fitness_odpair_loop(delta_fitness,
+                                    odpair_rows = odpair_rows,
+                                    odpair_keys = od_block_list[odpair_vars].itertuples(
+                                        index = False, name = None),
+                                    random_accept_threshold = random_accept_threshold,
+                                    precent_fitness_threshold = precent_fitness_threshold,
+                                    seedi = seedi, i = i,
+                                    delta_records = delta_records)
+                # Update job list with selected jobs
+                df = df.assign(select_job = delta_fitness.select_job)
+                od_block_list_dataframe = []
+            else:
+                od_block_list_dataframe = od_block_list.iterrows()
+
+            for index, odpair in od_block_list_dataframe:
                 # Increase increment for loop over block pairs
                 i = i+1
                 # flip one job in od pair
@@ -416,7 +573,7 @@ def markov_chain_monte_carlo_simanneal(df,
 
                 # Select new job
                 flip_job_index = shuffle_array[0:1]
-                flip_job_index = np.asscalar(flip_job_index)
+                flip_job_index = flip_job_index.item()
 
                 # select new job based on new index
                 odpair_joblist['select_job'] = 0
@@ -498,11 +655,66 @@ def markov_chain_monte_carlo_simanneal(df,
             
 
     # Stack mcmcsa observations
+    if len(delta_records) > 0:
+        total_mcmcsa['delta'] = pd.DataFrame(delta_records)
     total_mcmcsa_df = pd.concat(total_mcmcsa.values(), ignore_index=True)
     combined_mcmcsa_df = pd.concat(combined_mcmcsa.values(), ignore_index=True)
 
     return df, total_mcmcsa_df
 
+def delta_fitness_odpair_loop(delta_fitness,
+                              odpair_rows,
+                              odpair_keys,
+                              random_accept_threshold,
+                              precent_fitness_threshold,
+                              seedi, i,
+                              delta_records):
+    """
+    One pass over the od pairs with the delta fitness engine.
+    Same random seeds and acceptance rules as the dataframe loop.
+    Returns the total fitness and the updated iteration counter.
+    """
+    old_fitness = delta_fitness.fitness
+    for odpair_key in odpair_keys:
+        # Increase increment for loop over block pairs
+        i = i+1
+        odpair_positions = odpair_rows.get(odpair_key)
+        if odpair_positions is None or odpair_positions.shape[0] == 0:
+            continue
+
+        # increment seed for random sort
+        seed_i = seedi + i
+        # shuffle the od pair jobs and select new job
+        shuffle_array = odpair_positions.copy()
+        np.random.seed(seed_i)
+        np.random.shuffle(shuffle_array)
+        flip_position = shuffle_array[0]
+
+        old_fitness = delta_fitness.fitness
+        new_fitness, new_char_fitness, changes = \
+            delta_fitness.propose_flip(odpair_positions, flip_position)
+
+        # Update job list if fitness is "better"
+        if new_fitness < old_fitness:
+            accept = True
+        else:
+            # pick a random number and compare to threshold
+            np.random.seed(seed_i)
+            random_select = np.random.random_sample()
+            accept = random_select < random_accept_threshold
+        if accept:
+            delta_fitness.apply_flip(new_char_fitness, changes)
+            old_fitness = new_fitness
+        delta_records.append(delta_fitness.fitness_record(new_char_fitness,
+                                    iteration = i, seed = seed_i, accept = accept))
+
+        if new_fitness == precent_fitness_threshold:
+            old_fitness = new_fitness
+            #print('Total fitness threshold met ',new_fitness)
+            break
+
+    return old_fitness, i
+
 def check_flip(df,odpair,odpair_joblist,j,i):
     """
     helpful code to check flip for odpair
@@ -556,7 +768,7 @@ def prepare_joblist_columns(joblist_df):
 
     for geocodevar in ['w_geocode','h_geocode']:
         output_df.loc[:,geocodevar+'_str'] = \
-            output_df[geocodevar].apply(lambda x : str(int(x)).zfill(15))
+            geokey_index(output_df[geocodevar]).strings('Block')
 
     # rename race - lowercase R - to match Person Record Inventory
     output_df = output_df.rename(columns={"Race": "race"})
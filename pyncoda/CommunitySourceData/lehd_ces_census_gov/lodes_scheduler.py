@@ -0,0 +1,441 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Scheduler for the LODES job list and MCMC SA steps.
+
+The work is split into tasks that depend on each other (a DAG):
+    joblist      (county, year, work block) - block_to_joblist
+    mcmcsa_input (county, year)             - combine block job lists, add unique id
+    mcmcsa       (county, year, work block) - mcmc_sa_work_block
+    combine      (county, year)             - stack work blocks and save job list
+
+Work block tasks run on one process pool that is started once for the
+whole run. The stacked county job counts are shared with the workers once
+- with the fork start method (Linux) the workers use the parent's memory
+pages without copying; otherwise each worker loads them once from a pickle
+file. Each task only sends the task id and the rows for its work block.
+
+Every task saves a checkpoint when it finishes. If the run is interrupted,
+running the scheduler again skips tasks with a checkpoint and continues
+with the rest. The checkpoint names match the files saved by
+outer_mcmc_sa_input and outer_mcmc_sa_loop.
+
+Example:
+    stacked_df = obtain_lodes_county_loop(countylist, years, outputfolder)
+    stacked_jobtype_df = split_stack_df_byjobtype(stacked_df)
+    status = run_lodes_scheduler(stacked_jobtype_df, focus_jobtype = 'JT11',
+                    years = ['2010'], outputfolder = outputfolder, seed = 1234,
+                    random_accept_threshold = 0.1,
+                    start_reduction_threshold = 0.1,
+                    max_workers = 64)
+
+The MCMC SA step of the LODES workflow can use the scheduler with
+    outer_mcmc_sa_loop(..., use_scheduler = True, max_workers = 64)
+which runs the work blocks of the job list from outer_mcmc_sa_input.
+"""
+
+import os
+import sys
+import time
+import heapq
+import pickle
+import itertools
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from pyncoda.ncoda_00j_checkpoint import checkpoint_exists, read_checkpoint, \
+    save_checkpoint
+
+from . import block_to_joblist
+from . import add_primarykey
+from .lodes_mcmcsa_loops import mcmc_sa_work_block
+
+# Inputs shared by all tasks in a worker process
+shared_inputs = {}
+
+# Tasks that run in the parent process - they need the output of many tasks
+parent_stages = ['mcmcsa_input', 'combine']
+
+def mcmcsa_seeds(seed):
+    """
+    Three random seeds based on the initial random seed
+    Same seeds as outer_mcmc_sa_loop
+    """
+    np.random.seed(seed)
+    seed_array = np.random.randint(1, 100000, 3)
+    seedi = seed_array[0]
+    seedk = seed_array[1]
+    seedj = seed_array[2]
+
+    return seedi, seedj, seedk
+
+def work_block_str(work_block):
+    """
+    Work block as 15 character string
+    """
+    return str(int(work_block)).zfill(15)
+
+def checkpoint_name(task_id, focus_jobtype, seed):
+    """
+    Checkpoint file name for a task
+    """
+    stage, countyfips, year = task_id[0:3]
+    filename = "joblist_v010_"+focus_jobtype+"_"+countyfips+"_"+year
+    if stage == 'joblist':
+        return filename+"_"+work_block_str(task_id[3])+"_blockjoblist"
+    if stage == 'mcmcsa_input':
+        return filename+"_mcmcsainput"
+    if stage == 'mcmcsa':
+        return filename+"_"+work_block_str(task_id[3])+"_rs"+str(seed)
+    if stage == 'combine':
+        return filename+"_rs"+str(seed)+"_alljobs"
+
+def lodes_task_dag(county_jobcounts_df, years, countylist = None, mcmcsa_input_df = None):
+    """
+    Tasks and dependencies for each county, year and work block.
+    county_jobcounts_df = stacked_jobtype_df[focus_jobtype]
+    Work blocks are the blocks in the WAC earnings file.
+    mcmcsa_input_df: job lists by (countyfips, year) that are already made -
+        these counties have no job list tasks and the MCMC SA work blocks
+        are the blocks in the job list.
+    Returns dictionary with task id and list of tasks it depends on.
+    """
+    if mcmcsa_input_df is None:
+        mcmcsa_input_df = {}
+    dag = {}
+    for key in county_jobcounts_df.keys():
+        stabbr, countyfips, od, year, seg_stem = key
+        if (od != 'wac') or (seg_stem != 'SE') or (year not in years):
+            continue
+        if (countylist is not None) and (countyfips not in countylist):
+            continue
+
+        if (countyfips, year) in mcmcsa_input_df:
+            work_blocks = mcmcsa_input_df[countyfips, year]['w_geocode'].unique().tolist()
+            dag['mcmcsa_input', countyfips, year] = []
+        else:
+            work_blocks = county_jobcounts_df[key]['w_geocode'].unique().tolist()
+            joblist_tasks = [('joblist', countyfips, year, work_block)
+                             for work_block in work_blocks]
+            for task_id in joblist_tasks:
+                dag[task_id] = []
+            dag['mcmcsa_input', countyfips, year] = joblist_tasks
+        mcmcsa_tasks = [('mcmcsa', countyfips, year, work_block)
+                        for work_block in work_blocks]
+        for task_id in mcmcsa_tasks:
+            dag[task_id] = [('mcmcsa_input', countyfips, year)]
+        dag['combine', countyfips, year] = mcmcsa_tasks
+
+    print("\n***************************************")
+    print("    LODES task graph has",len(dag),"tasks.")
+    for stage in ['joblist','mcmcsa_input','mcmcsa','combine']:
+        print("   ",stage,":",sum(1 for task_id in dag if task_id[0] == stage))
+    print("***************************************\n")
+
+    return dag
+
+def init_worker(shared_inputs_filepath = None):
+    """
+    Load shared inputs once for each worker process
+    """
+    if (shared_inputs_filepath is not None) and (len(shared_inputs) == 0):
+        with open(shared_inputs_filepath, 'rb') as shared_file:
+            shared_inputs.update(pickle.load(shared_file))
+
+def run_joblist_task(task_id, checkpoint_folder, checkpoint_filename):
+    """
+    Possible job list for one work block
+    """
+    stage, countyfips, year, work_block = task_id
+    start_time = time.time()
+    joblist_df = block_to_joblist(stacked_df = shared_inputs['county_jobcounts_df'],
+                                  work_block = work_block,
+                                  years = [year],
+                                  outputfoldername = shared_inputs['outputfolder'])
+    save_checkpoint(joblist_df[year], checkpoint_folder, checkpoint_filename)
+
+    return task_id, time.time() - start_time
+
+def run_mcmcsa_task(task_id, block_joblist_df, checkpoint_folder, checkpoint_filename):
+    """
+    MCMC SA for one work block
+    """
+    stage, countyfips, year, work_block = task_id
+    start_time = time.time()
+    seedi, seedj, seedk = mcmcsa_seeds(shared_inputs['seed'])
+    output_df, random_accept_threshold = mcmc_sa_work_block(work_block = work_block,
+                        year = year,
+                        joblist_df = block_joblist_df,
+                        county_jobcounts_df = shared_inputs['county_jobcounts_df'],
+                        seedi = seedi,
+                        seedj = seedj,
+                        seedk = seedk,
+                        random_accept_threshold = shared_inputs['random_accept_threshold'],
+                        start_reduction_threshold = shared_inputs['start_reduction_threshold'],
+                        num_procs = 1)
+    save_checkpoint(output_df, checkpoint_folder, checkpoint_filename)
+
+    return task_id, time.time() - start_time
+
+def read_task_checkpoint(checkpoint_folder, checkpoint_filename):
+    """
+    Read checkpoint - drops the index column of legacy CSV files
+    """
+    df = read_checkpoint(checkpoint_folder, checkpoint_filename, dtype = {'year' : str})
+    if 'Unnamed: 0' in df.columns:
+        df = df.drop(columns = ['Unnamed: 0'])
+
+    return df
+
+def run_mcmcsa_input_task(task_id, dag, focus_jobtype, seed, checkpoint_folder):
+    """
+    Combine block job lists for a county and year and add unique id.
+    Same steps as outer_mcmc_sa_input and the start of outer_mcmc_sa_loop.
+    """
+    joblist_blocks = [read_task_checkpoint(checkpoint_folder,
+                        checkpoint_name(joblist_task, focus_jobtype, seed))
+                      for joblist_task in dag[task_id]]
+    joblist_df = pd.concat(joblist_blocks, ignore_index=True)
+
+    # Add unique id
+    joblist_df['uniqueid_part1'] = 'WB' + joblist_df['w_geocode'].astype(str) + \
+        'HB' + joblist_df['h_geocode'].astype(str) + joblist_df['jobidac'].astype(str)
+    # move unique id to first column
+    joblist_df = add_primarykey(joblist_df, 'uniquejobid', 'uniqueid_part1')
+
+    # How many jobs have a 100% probability of being selected
+    joblist_df['initprobability_selected'] = joblist_df['S000'] / joblist_df['possible_S000']
+    joblist_df['select_job_beforemcmcsa'] = \
+        (joblist_df['initprobability_selected'] == 1).astype(int)
+    # start with blocks that have high probability of selection first
+    joblist_df = joblist_df.sort_values(by='initprobability_selected', ascending=False)
+
+    save_checkpoint(joblist_df, checkpoint_folder,
+                    checkpoint_name(task_id, focus_jobtype, seed))
+
+    return joblist_df
+
+def run_combine_task(task_id, dag, focus_jobtype, seed, checkpoint_folder):
+    """
+    Stack work block job lists and save all jobs and selected jobs
+    """
+    output_blocks = [read_task_checkpoint(checkpoint_folder,
+                        checkpoint_name(mcmcsa_task, focus_jobtype, seed))
+                     for mcmcsa_task in dag[task_id]]
+    output_df = pd.concat(output_blocks, ignore_index=True)
+    save_checkpoint(output_df, checkpoint_folder,
+                    checkpoint_name(task_id, focus_jobtype, seed))
+
+    selected_wac_rac_od_joblist = output_df.loc[output_df['select_job'] == 1]
+    save_checkpoint(selected_wac_rac_od_joblist, checkpoint_folder,
+                    checkpoint_name(task_id, focus_jobtype, seed)[:-len("_alljobs")])
+
+    return output_df
+
+def run_lodes_scheduler(stacked_jobtype_df,
+                        focus_jobtype,
+                        years,
+                        outputfolder,
+                        seed,
+                        random_accept_threshold,
+                        start_reduction_threshold,
+                        countylist = None,
+                        max_workers = None,
+                        start_method = None,
+                        max_pending = None,
+                        mcmcsa_input_df = None):
+    """
+    Run the job list and MCMC SA tasks for all counties, years and work
+    blocks in stacked_jobtype_df[focus_jobtype].
+
+    max_workers: number of worker processes - default os.cpu_count()
+    start_method: multiprocessing start method - default fork if available
+    max_pending: maximum number of submitted tasks - default 2 * max_workers
+    mcmcsa_input_df: job lists by (countyfips, year) that are already made -
+        see outer_mcmc_sa_loop(use_scheduler = True). The job list and
+        mcmcsa_input tasks for these counties do not run.
+
+    Returns dataframe with the status and run time of each task.
+    Run again after an interruption or failure to finish the remaining tasks.
+    """
+    county_jobcounts_df = stacked_jobtype_df[focus_jobtype]
+    checkpoint_folder = sys.path[0]+"/"+outputfolder
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    if start_method is None:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            start_method = 'fork'
+        else:
+            start_method = 'spawn'
+
+    if mcmcsa_input_df is None:
+        mcmcsa_input_df = {}
+    dag = lodes_task_dag(county_jobcounts_df, years, countylist, mcmcsa_input_df)
+    names = {task_id : checkpoint_name(task_id, focus_jobtype, seed) for task_id in dag}
+    status = {task_id : 'waiting' for task_id in dag}
+    run_time = {}
+    for task_id in dag:
+        if checkpoint_exists(checkpoint_folder, names[task_id]):
+            status[task_id] = 'done'
+        if (task_id[0] == 'mcmcsa_input') and (task_id[1:3] in mcmcsa_input_df):
+            status[task_id] = 'done'
+    print("Resuming with",sum(value == 'done' for value in status.values()),
+          "of",len(dag),"tasks already done.")
+
+    # Tasks that wait for each task and number of tasks each task waits for
+    dependents = {task_id : [] for task_id in dag}
+    for task_id, depends_on in dag.items():
+        for depends_task in depends_on:
+            dependents[depends_task].append(task_id)
+    remaining = {task_id : sum(status[depends_task] != 'done'
+                               for depends_task in dag[task_id]) for task_id in dag}
+
+    # Share inputs with workers
+    shared_inputs.clear()
+    shared_inputs.update({'county_jobcounts_df' : county_jobcounts_df,
+                          'outputfolder' : outputfolder,
+                          'seed' : seed,
+                          'random_accept_threshold' : random_accept_threshold,
+                          'start_reduction_threshold' : start_reduction_threshold})
+    shared_inputs_filepath = None
+    if start_method != 'fork':
+        shared_inputs_filepath = os.path.join(checkpoint_folder,
+            "lodes_scheduler_inputs_"+focus_jobtype+"_rs"+str(seed)+".pkl")
+        with open(shared_inputs_filepath, 'wb') as shared_file:
+            pickle.dump(shared_inputs, shared_file, protocol = pickle.HIGHEST_PROTOCOL)
+
+    # Job lists for the MCMC SA tasks by county and year
+    block_joblist_df = {}
+    def block_joblist(task_id):
+        input_task = ('mcmcsa_input',) + task_id[1:3]
+        if input_task not in block_joblist_df:
+            if task_id[1:3] in mcmcsa_input_df:
+                joblist_df = mcmcsa_input_df[task_id[1:3]]
+            else:
+                joblist_df = read_task_checkpoint(checkpoint_folder, names[input_task])
+            block_joblist_df[input_task] = dict(tuple(
+                joblist_df.groupby('w_geocode', sort = False)))
+        return block_joblist_df[input_task].get(task_id[3])
+
+    # Ready tasks - parent tasks first, then large work blocks first
+    ready = []
+    ready_order = itertools.count()
+    def add_ready(task_id):
+        if task_id[0] in parent_stages:
+            priority = -np.inf
+        elif task_id[0] == 'mcmcsa':
+            joblist_df = block_joblist(task_id)
+            priority = 0 if joblist_df is None else -joblist_df.shape[0]
+        else:
+            priority = 0
+        heapq.heappush(ready, (priority, next(ready_order), task_id))
+
+    def task_done(task_id):
+        status[task_id] = 'done'
+        for dependent_task in dependents[task_id]:
+            remaining[dependent_task] -= 1
+            if (remaining[dependent_task] == 0) and (status[dependent_task] == 'waiting'):
+                add_ready(dependent_task)
+
+    def task_failed(task_id, e):
+        print("Task",task_id,"failed:",e)
+        # Skip tasks that depend on failed task
+        failed_tasks = [task_id]
+        while len(failed_tasks) > 0:
+            failed_task = failed_tasks.pop()
+            status[failed_task] = 'failed'
+            failed_tasks += [dependent_task for dependent_task in dependents[failed_task]
+                             if status[dependent_task] == 'waiting']
+
+    for task_id in dag:
+        if (status[task_id] == 'waiting') and (remaining[task_id] == 0):
+            add_ready(task_id)
+
+    mp_context = multiprocessing.get_context(start_method)
+    start_time = time.time()
+    pending = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers = max_workers,
+                                                mp_context = mp_context,
+                                                initializer = init_worker,
+                                                initargs = (shared_inputs_filepath,)) as executor:
+        try:
+            while (len(ready) > 0) or (len(pending) > 0):
+                # Submit ready tasks
+                while (len(ready) > 0) and (len(pending) < max_pending):
+                    priority, order, task_id = heapq.heappop(ready)
+                    if status[task_id] != 'waiting':
+                        continue
+                    # Run tasks that need many task outputs in this process
+                    if task_id[0] in parent_stages:
+                        task_start_time = time.time()
+                        try:
+                            if task_id[0] == 'mcmcsa_input':
+                                run_mcmcsa_input_task(task_id, dag, focus_jobtype, seed,
+                                                      checkpoint_folder)
+                            else:
+                                run_combine_task(task_id, dag, focus_jobtype, seed,
+                                                 checkpoint_folder)
+                            run_time[task_id] = time.time() - task_start_time
+                            task_done(task_id)
+                        except Exception as e:
+                            task_failed(task_id, e)
+                        continue
+                    if task_id[0] == 'joblist':
+                        future = executor.submit(run_joblist_task, task_id,
+                                                 checkpoint_folder, names[task_id])
+                    else:
+                        future = executor.submit(run_mcmcsa_task, task_id,
+                                                 block_joblist(task_id),
+                                                 checkpoint_folder, names[task_id])
+                    pending[future] = task_id
+                    status[task_id] = 'running'
+
+                if len(pending) == 0:
+                    continue
+
+                # Wait for a work block task to finish
+                finished, not_done = concurrent.futures.wait(pending,
+                    return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task_id = pending.pop(future)
+                    try:
+                        task_id, run_time[task_id] = future.result()
+                        task_done(task_id)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        # Worker was killed - rerun to resume from checkpoints
+                        raise
+                    except Exception as e:
+                        task_failed(task_id, e)
+                print("LODES scheduler:",len(run_time),"tasks run,",len(pending),
+                      "running,",len(ready),"ready after",
+                      round(time.time() - start_time, 1),"seconds.")
+        except KeyboardInterrupt:
+            print("Scheduler interrupted - finished tasks are saved.")
+            executor.shutdown(wait = False, cancel_futures = True)
+            raise
+
+    if shared_inputs_filepath is not None:
+        os.remove(shared_inputs_filepath)
+
+    status_df = pd.DataFrame({'stage' : [task_id[0] for task_id in dag],
+                              'countyfips' : [task_id[1] for task_id in dag],
+                              'year' : [task_id[2] for task_id in dag],
+                              'work_block' : [task_id[3] if len(task_id) > 3 else None
+                                              for task_id in dag],
+                              'status' : [status[task_id] for task_id in dag],
+                              'seconds' : [run_time.get(task_id) for task_id in dag]})
+
+    print("\n***************************************")
+    print("    LODES scheduler finished in",round(time.time() - start_time, 1),"seconds.")
+    print(status_df.groupby(['stage','status']).size().to_string())
+    print("***************************************\n")
+
+    return status_df
@@ -9,7 +9,8 @@ import sys
 
     
 def directory_design(state_county_name,
-                     outputfolder):
+                     outputfolder,
+                     cache_folders: bool = True):
     """
     Setup output directories 
     Process generates many files 
@@ -17,6 +18,7 @@ def directory_design(state_county_name,
     easy to find and easy to understand inputs
 
     Process centers around individual counties.
+    cache_folders: add the Census API and TIGER caches in outputfolder
     """
 
     # Make directory to save output
@@ -65,4 +67,45 @@ def directory_design(state_county_name,
         outputfolders[directory_name] = check_folder_exists
         counter += 1
 
-    return outputfolders
\ No newline at end of file
+    if cache_folders == True:
+        outputfolders = add_cache_folders(outputfolders, outputfolder)
+
+    return outputfolders
+
+def add_cache_folders(outputfolders, outputfolder):
+    """
+    Census API responses and TIGER/Line files are shared by all
+    counties in the output folder
+    """
+    for cache_folder in ['CensusAPICache', 'TIGERCache']:
+        outputfolders[cache_folder] = outputfolder+'/'+cache_folder
+        if not os.path.exists(outputfolders[cache_folder]):
+            os.mkdir(outputfolders[cache_folder])
+
+    return outputfolders
+
+def county_directory_design(state_county,
+                            outputfolder):
+    """
+    Setup output directories shared by all communities with the county.
+    County results that do not depend on the community - Census API data,
+    base inventories, random merges, county housing unit inventories
+    and census block data - are saved in
+        outputfolder/Counties/state_county
+    File names have the county, vintage, seed and version, so a county
+    is computed once for all communities that include it.
+
+    Same folders as directory_design.
+    """
+    counties_folder = outputfolder+'/Counties'
+    if not os.path.exists(outputfolder):
+        os.mkdir(outputfolder)
+    if not os.path.exists(counties_folder):
+        os.mkdir(counties_folder)
+
+    outputfolders = directory_design(state_county_name = state_county,
+                                     outputfolder = counties_folder,
+                                     cache_folders = False)
+    outputfolders = add_cache_folders(outputfolders, outputfolder)
+
+    return outputfolders
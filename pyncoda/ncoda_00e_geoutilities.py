@@ -18,6 +18,7 @@ from shapely.wkt import loads
 # new method 
 # https://pyproj4.github.io/pyproj/stable/gotchas.html#axis-order-changes-in-proj-6
 from pyproj import CRS
+import shapely # STRtree bulk query for spatial join
 
 def df2gdf_WKTgeometry(df: pd.DataFrame, 
                        projection = "epsg:4326", 
@@ -111,9 +112,77 @@ def add_representative_point(polygon_gdf,
 
     return polygon_gdf
 
+# Mean earth radius in meters - haversine distances
+earth_radius_m = 6371008.8
+
+def point_coordinates(gdf: gpd.GeoDataFrame):
+    """
+    X and Y arrays of the geometry centroids - points are not changed
+    """
+    centroids = shapely.centroid(gdf.geometry.to_numpy())
+
+    return shapely.get_x(centroids), shapely.get_y(centroids)
+
+def nearest_pt_query(x_a, y_a, x_b, y_b, k: int = 1,
+                     metric: str = 'euclidean',
+                     chunk_size: int = None,
+                     max_memory_mb: int = 256):
+    """
+    Find the k nearest locations a for each location b.
+    metric: euclidean - distance in coordinate units (meters if CRS UTM)
+            haversine - x and y are longitude and latitude in degrees,
+            distance is the great circle distance in meters.
+            The points are placed on a unit sphere and the tree finds the
+            nearest chord, which is also the nearest great circle distance.
+    chunk_size: number of locations b in each query - default uses
+        max_memory_mb for the query results
+    Returns:
+        distances, indices: arrays with one row for each location b and
+        one column for each neighbor. If there are fewer than k locations a
+        the distance is inf and the index is the number of locations a.
+    """
+    x_a, y_a = np.asarray(x_a, dtype = float), np.asarray(y_a, dtype = float)
+    x_b, y_b = np.asarray(x_b, dtype = float), np.asarray(y_b, dtype = float)
+    if metric == 'haversine':
+        def sphere_points(lon, lat):
+            lon, lat = np.radians(lon), np.radians(lat)
+            return np.column_stack([np.cos(lat) * np.cos(lon),
+                                    np.cos(lat) * np.sin(lon),
+                                    np.sin(lat)])
+        points_a, points_b = sphere_points(x_a, y_a), sphere_points(x_b, y_b)
+    elif metric == 'euclidean':
+        points_a, points_b = np.column_stack([x_a, y_a]), np.column_stack([x_b, y_b])
+    else:
+        raise ValueError("metric must be euclidean or haversine: "+str(metric))
+
+    distances = np.full((len(points_b), k), np.inf)
+    indices = np.full((len(points_b), k), len(points_a), dtype = np.int64)
+    if (len(points_a) == 0) or (len(points_b) == 0):
+        return distances, indices
+
+    # Query results and work arrays are about 32 bytes for each neighbor
+    if chunk_size is None:
+        chunk_size = max(1, int(max_memory_mb * 2**20 // (32 * k)))
+    kd = KDTree(points_a)
+    for start in range(0, len(points_b), chunk_size):
+        end = min(start + chunk_size, len(points_b))
+        # k as a list returns 2D arrays for k = 1
+        distances[start:end], indices[start:end] = \
+            kd.query(points_b[start:end], k = list(range(1, k+1)))
+
+    if metric == 'haversine':
+        # chord length on the unit sphere to great circle distance
+        found = np.isfinite(distances)
+        distances[found] = 2 * earth_radius_m * \
+            np.arcsin(np.minimum(distances[found] / 2, 1))
+
+    return distances, indices
+
 def nearest_pt_search(gdf_a: gpd.GeoDataFrame, gdf_b: gpd.GeoDataFrame, 
                     uniqueid_a: str, uniqueid_b: str, k=1,
-                    dist_cutoff = 99999):
+                    dist_cutoff = None,
+                    metric: str = None,
+                    chunk_size: int = None):
         """Given two sets of points add unique id from locations a to locations b
         Inspired by: https://towardsdatascience.com/using-scikit-learns-binary-trees-to-efficiently-find-latitude-and-longitude-neighbors-909979bd929b
         
@@ -133,9 +202,13 @@ def nearest_pt_search(gdf_a: gpd.GeoDataFrame, gdf_b: gpd.GeoDataFrame,
             gdf_b: Geodataframe with list of locations with unique id
             uniqueid_b: Unique ID for gdf with locations b
             k : The amount of neighbors to return
-            dist_cutoff : Integer value distance - meters if CRS UTM
+            dist_cutoff : Integer value distance - meters if CRS UTM or 
+                if the CRS is lat/lon (haversine distance)
                 if distance is greater than cutoff neighbor is not considered
-                initially set to 9999 which will set the value to outliers
+                default None keeps all neighbors, 9999 will set the value to outliers
+            metric : haversine or euclidean - default is haversine if 
+                the CRS is lat/lon and euclidean for projected CRS
+            chunk_size : number of locations b in each query - see nearest_pt_query
         Returns:
             GeoDataFrame: Locations b with nearest unique id from Locations a Geopandas DataFrame object
         
@@ -144,14 +217,18 @@ def nearest_pt_search(gdf_a: gpd.GeoDataFrame, gdf_b: gpd.GeoDataFrame,
         """
         
         # Check if both gdf have the same CRS
-        if gdf_a.crs == gdf_b.crs:
-            save_crs = gdf_a.crs
+        save_crs = gdf_a.crs
+        if (gdf_b.crs is not None) and (save_crs is not None) and (gdf_b.crs != save_crs):
+            print("Reprojecting locations b to the CRS of locations a")
+            gdf_b = gdf_b.to_crs(save_crs)
+        if metric is None:
+            metric = 'haversine' if (save_crs is not None) and save_crs.is_geographic \
+                else 'euclidean'
         
         # set up locations a
         locations_a = gdf_a[[uniqueid_a,'geometry']].copy()
         
-        locations_a['LON'] = locations_a.geometry.apply(lambda p: p.centroid.x)
-        locations_a['LAT'] = locations_a.geometry.apply(lambda p: p.centroid.y)
+        locations_a['LON'], locations_a['LAT'] = point_coordinates(locations_a)
         
         # Critical step: reset index for locations a
         locations_a = locations_a.reset_index()
@@ -159,20 +236,20 @@ def nearest_pt_search(gdf_a: gpd.GeoDataFrame, gdf_b: gpd.GeoDataFrame,
         # set up locations b
         locations_b = gdf_b[[uniqueid_b,'geometry']].copy()
         
-        locations_b['LON'] = locations_b.geometry.apply(lambda p: p.centroid.x)
-        locations_b['LAT'] = locations_b.geometry.apply(lambda p: p.centroid.y)
+        locations_b['LON'], locations_b['LAT'] = point_coordinates(locations_b)
         
         # Takes the first group's latitude and longitude values to construct
-        # the kd tree.
-        kd = KDTree(locations_a[["LAT", "LON"]].values)
-
-        # Executes a query with the second group. This will return two
-        # arrays.
-        distances, indices = kd.query(locations_b[["LAT", "LON"]], k=k)
+        # the tree and queries the second group in chunks.
+        # This will return two arrays with one column for each neighbor.
+        distances, indices = nearest_pt_query(
+                    x_a = locations_a['LON'], y_a = locations_a['LAT'],
+                    x_b = locations_b['LON'], y_b = locations_b['LAT'],
+                    k = k,
+                    metric = metric,
+                    chunk_size = chunk_size)
         
-        # add distance to output - what unit is distance? 
-        # if projection is UTM the distance is in meters
-        # place distance array columns in new dataframe columns
+        # add distance to output
+        # if projection is UTM or lat/lon the distance is in meters
         
         # Identify outliers based on mean and standard deviation of nearest neighbors
         # outlier was considered but distances were too large and created errors
@@ -181,40 +258,34 @@ def nearest_pt_search(gdf_a: gpd.GeoDataFrame, gdf_b: gpd.GeoDataFrame,
         if dist_cutoff == 9999:
             dist_cutoff = outlier
         
-        # start an empty container to hold all of the locations
-        append_locations = []
-        for i in range(0,k):
-            # copy locations b to new dataframe
-            locations = locations_b.copy(deep=True)
-            
-            # Which neighbor is this match
-            locations['neighbor'] = i+1
-            
-            # Critical step - select column with distances for neighbor i
-            locations['distance'] = distances[:,i]
-            # look for distances greater than cutoff  
-            locations['distoutlier'] = np.where(locations['distance'] > dist_cutoff, True, False)
-            
-            # add location a index
-            # Critical step - select column with indices for neighbor i
-            locations['location a index'] = indices[:,i]
-                       
-            # clear index if distance is greater than cutoff
-            locations.loc[(locations['distoutlier']==True), 'location a index'] = np.nan
-            
-            # Merge by index
-            # https://thispointer.com/pandas-how-to-merge-dataframes-by-index-using-dataframe-merge-part-3/
-            locations = locations.merge(locations_a, left_on = 'location a index', 
-                                             right_index=True, how='inner')
-            
-            # append location data
-            append_locations.append(locations)
-        
-        # Create dataframe from appended locations data
-        locationmatch = pd.concat(append_locations)
+        # One row for each location b and neighbor - neighbor 1 for all 
+        # locations b first. Neighbors with a distance greater than 
+        # the cutoff are dropped.
+        rows_b = np.tile(np.arange(len(locations_b)), k)
+        neighbor = np.repeat(np.arange(1, k+1), len(locations_b))
+        distance = distances.T.ravel()
+        index_a = indices.T.ravel()
+        match = index_a < len(locations_a)
+        if dist_cutoff is not None:
+            match = match & ~(distance > dist_cutoff)
+        rows_b, index_a = rows_b[match], index_a[match]
+
+        # Columns in both locations have the suffixes _x and _y
+        matched_b = locations_b.iloc[rows_b]
+        matched_a = locations_a.iloc[index_a]
+        both = set(locations_b.columns) & set(locations_a.columns)
+        columns = {(col+'_x' if col in both else col) : matched_b[col].values
+                   for col in locations_b.columns}
+        columns['neighbor'] = neighbor[match]
+        columns['distance'] = distance[match]
+        columns['distoutlier'] = np.zeros(len(rows_b), dtype = bool)
+        # location a index is float - missing if the neighbor is dropped
+        columns['location a index'] = index_a.astype(float)
+        columns.update({(col+'_y' if col in both else col) : matched_a[col].values
+                        for col in locations_a.columns})
+        locationmatch = pd.DataFrame(columns, index = matched_b.index)
         
         # Set geodateframe crs
-        from pyproj import CRS
         locationmatch.crs = CRS(save_crs)
 
     
@@ -228,7 +299,10 @@ def spatial_join_points_to_poly(points_gdf,
                                 geolevel, 
                                 epsg: int = 4326,
                                 join_column_list: list = [],
-                                buffer_dist: int = 0.001):
+                                buffer_dist: int = 0.001,
+                                method: str = 'bulk',
+                                tie_break: str = 'last',
+                                chunk_size: int = None):
     """
     Function adds polygon variables to block points.
     point_var: Variable with WKT Point Geometry for Polygon GDF
@@ -247,6 +321,14 @@ def spatial_join_points_to_poly(points_gdf,
 
     future improvement: if there are multiple polygons for a point,
     the function could create multiple rows for the point.
+
+    method: 'bulk' queries all points at once with a STRtree on the polygons,
+        'loop' runs the original loop over polygons.
+    tie_break: polygon used when a point intersects more than one polygon
+        (point on a shared edge) - 'last' or 'first' polygon in polygon_gdf
+        row order. 'last' matches the loop, where later polygons overwrite.
+    chunk_size: number of points per STRtree query - limits memory for
+        large point files. Default is all points in one query.
     """
     # make copies of input df and gdf
     copy_point_gdf = points_gdf.copy(deep=True)
@@ -268,13 +350,38 @@ def spatial_join_points_to_poly(points_gdf,
     # build the r-tree index - for polygon file
     print("Polygon file has",copy_polygon_gdf.shape[0],geolevel,"polygons.")
     sindex_poly_gdf = copy_polygon_gdf.sindex
-    possible_matches_index = list(sindex_poly_gdf.intersection(copy_point_gdf_bounds))
+    possible_matches_index = np.sort(sindex_poly_gdf.intersection(copy_point_gdf_bounds))
     area_poly_gdf = copy_polygon_gdf.iloc[possible_matches_index]
     print("Identified",area_poly_gdf.shape[0],geolevel,"polygons to spatially join.")
 
+    if method == 'bulk':
+        poly_position = bulk_points_in_poly(point_geometry = copy_point_gdf[point_var],
+                                            poly_geometry = area_poly_gdf['geometry'],
+                                            tie_break = tie_break,
+                                            chunk_size = chunk_size)
+        matched = poly_position >= 0
+        print("Joined",matched.sum(),"of",matched.shape[0],"points to",geolevel,"polygons.")
+        if matched.any():
+            for col in join_column_list:
+                values = area_poly_gdf[col].reset_index(drop = True)
+                values = pd.Series(values.reindex(poly_position).values,
+                                   index = copy_point_gdf.index)
+                # Points without a polygon keep existing values - same as the loop
+                if geolevel+col in copy_point_gdf.columns:
+                    values = values.where(matched, copy_point_gdf[geolevel+col])
+                copy_point_gdf[geolevel+col] = values
+
+        # Switch Geometry back to Polygon
+        copy_point_gdf['geometry'] = copy_point_gdf[poly_var]
+
+        return copy_point_gdf
+
     # build the r-tree index - Using Representative Point
     copy_point_gdf['geometry'] = copy_point_gdf[point_var]
     sindex_copy_point_gdf = copy_point_gdf.sindex
+    # Later polygons overwrite earlier polygons
+    if tie_break == 'first':
+        area_poly_gdf = area_poly_gdf.iloc[::-1]
 
     #Loops for spatial join are time consuming
     #Here is a way to know that the loop is running and how long it takes to run
@@ -298,6 +405,43 @@ def spatial_join_points_to_poly(points_gdf,
 
     return copy_point_gdf
 
+def bulk_points_in_poly(point_geometry, 
+                        poly_geometry, 
+                        tie_break: str = 'last',
+                        chunk_size: int = None):
+    """
+    Position of the polygon that intersects each point, -1 if no polygon.
+    Uses one STRtree on the polygons and queries the points in chunks.
+    tie_break: 'last' or 'first' polygon when a point is on a shared edge
+    """
+    point_array = np.asarray(gpd.GeoSeries(point_geometry).values)
+    poly_array = np.asarray(gpd.GeoSeries(poly_geometry).values)
+    n_points = point_array.shape[0]
+    poly_position = np.full(n_points, -1, dtype=np.int64)
+    if n_points == 0 or poly_array.shape[0] == 0:
+        return poly_position
+    if chunk_size is None:
+        chunk_size = n_points
+
+    poly_tree = shapely.STRtree(poly_array)
+    for start in range(0, n_points, chunk_size):
+        end = min(start + chunk_size, n_points)
+        point_idx, poly_idx = poly_tree.query(point_array[start:end],
+                                              predicate = 'intersects')
+        if point_idx.shape[0] == 0:
+            continue
+        # Sort by point then polygon - pick first or last polygon for each point
+        if tie_break == 'last':
+            order = np.lexsort((-poly_idx, point_idx))
+        else:
+            order = np.lexsort((poly_idx, point_idx))
+        point_idx = point_idx[order]
+        poly_idx = poly_idx[order]
+        first_match = np.r_[True, point_idx[1:] != point_idx[:-1]]
+        poly_position[start + point_idx[first_match]] = poly_idx[first_match]
+
+    return poly_position
+
 def single_layer_folium_map(gdf,layer_name, output_folder):   
     # Find the bounds of the Census Block File
     minx = gdf.bounds.minx.min()
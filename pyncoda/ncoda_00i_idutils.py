@@ -0,0 +1,81 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Vectorized functions for building geography ids and primary keys.
+
+The inventories have one row per housing unit, person or job, which can be
+millions of rows for a large county. Building ids with
+df.apply(lambda x: ..., axis=1) creates a Series for every row.
+The functions below use pandas string methods on whole columns instead
+and return the same strings as the row-wise versions.
+
+Example of a housing unit id:
+    Block2010str = "B" + state + county + tract + block = 'B481677201001000'
+    huid = Block2010str + "H" + zero padded counter   = 'B481677201001000H001'
+"""
+
+import numpy as np
+import pandas as pd
+
+def zfill_str(values, width: int):
+    """
+    Convert values to strings and zero pad - same as str(x).zfill(width)
+    """
+    return pd.Series(values).astype(str).str.zfill(width)
+
+def zfill_int(values, width: int):
+    """
+    Convert counter to integer strings and zero pad - same as str(int(x)).zfill(width)
+    """
+    return pd.Series(values).astype(np.int64).astype(str).str.zfill(width)
+
+def counter_maxdigits(counter):
+    """
+    Number of digits needed to zero pad a counter
+    """
+    return len(str(int(pd.Series(counter).max())))
+
+def add_group_counter(df, by_vars, counter_var: str, start: int = 1):
+    """
+    Counter within group - same as df.groupby(by_vars).cumcount() + start
+    """
+    df[counter_var] = df.groupby(by_vars).cumcount() + start
+
+    return df
+
+def make_geoid(df, geo_levels = {'state':  2,
+                                 'county': 3,
+                                 'tract':  6,
+                                 'block':  4}):
+    """
+    Concatenate zero padded geography codes.
+    geo_levels: dictionary with column name and length in order.
+    Returns the zero padded columns and the concatenated geoid.
+    """
+    padded = {}
+    geoid = None
+    for geo_level, length in geo_levels.items():
+        padded[geo_level] = zfill_str(df[geo_level], length).values
+        if geoid is None:
+            geoid = pd.Series(padded[geo_level], index=df.index, dtype=object)
+        else:
+            geoid = geoid + padded[geo_level]
+
+    return padded, geoid
+
+def make_uniqueid(part1, counter, width: int = None, id_type: str = ""):
+    """
+    Unique id from a string part1, an id type and a zero padded counter.
+    width: number of digits for the counter - default is the maximum number of digits
+    """
+    part1 = pd.Series(part1)
+    if width is None:
+        width = counter_maxdigits(counter)
+    counter_str = zfill_int(counter, width)
+    counter_str.index = part1.index
+
+    return part1.astype(str) + id_type + counter_str
@@ -0,0 +1,287 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Checkpoint files for intermediate workflow results.
+
+Each stage of the workflow saves its output so the next run can skip it.
+A checkpoint is read back with the column types it was saved with, so a
+resumed stage gives the next stage the same dataframe as a fresh run.
+Parquet keeps column types and geometry (GeoParquet) and can read a
+subset of columns. CSV is used when pyarrow is not installed - the column
+types are saved next to the CSV ({name}.dtypes.json). Legacy CSV
+checkpoints without column types are read with the schema from the data
+structure (zero padded ids stay strings).
+
+Set the format for all stages with the environment variable
+NCODA_CHECKPOINT_FORMAT = parquet or csv
+
+Example:
+    if checkpoint_exists(folder, name):
+        df = read_checkpoint(folder, name, columns = ['huid','blockid'])
+    ...
+    save_checkpoint(df, folder, name)
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from pyncoda.CommunitySourceData.api_census_gov.acg_00e_incore_huiv2 \
+    import incore_v2_DataStructure
+
+checkpoint_extensions = {'parquet' : '.parquet', 'csv' : '.csv'}
+dtypes_extension = '.dtypes.json'
+
+# Id and geography columns that are zero padded strings
+# but are not in the data structure
+checkpoint_str_vars = ['Block2010','Block2010str','BlockGroup2010','Tract2010',
+                       'County2010','Block2020','Block2020str','BLOCKID10',
+                       'BLOCKID10_str','BLOCKID20','BLOCKID20_str',
+                       'blockBLOCKID10_str','blockBLOCKID20_str',
+                       'precid','strctid','addrptid','guid','GEO_ID','year']
+
+def parquet_available():
+    """
+    Parquet needs pyarrow
+    """
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+def default_checkpoint_format():
+    """
+    Parquet unless NCODA_CHECKPOINT_FORMAT is set or pyarrow is missing
+    """
+    checkpoint_format = os.environ.get('NCODA_CHECKPOINT_FORMAT', 'parquet').lower()
+    if checkpoint_format == 'parquet' and not parquet_available():
+        checkpoint_format = 'csv'
+
+    return checkpoint_format
+
+def schema_from_datastructure(datastructure = incore_v2_DataStructure,
+                              str_vars: list = checkpoint_str_vars):
+    """
+    Column types from the pyType in a data structure dictionary.
+    Strings and integers are set - category and float columns are left
+    to the reader because they can have missing values.
+    """
+    schema = {var : str for var in str_vars}
+    for var in datastructure:
+        if datastructure[var].get('pyType') in [str, int]:
+            schema[var] = datastructure[var]['pyType']
+
+    return schema
+
+checkpoint_schema = schema_from_datastructure()
+
+def apply_schema(df, schema: dict = checkpoint_schema):
+    """
+    Set column types after reading a legacy CSV.
+    Missing values stay missing in string columns and integer columns
+    with missing values are not changed.
+    """
+    for var, pytype in schema.items():
+        if var not in df.columns:
+            continue
+        if pytype is str:
+            values = df[var]
+            if values.dtype == object and values.map(type).isin([str, type(None)]).all():
+                continue
+            # Float ids read from CSV (481677201001000.0) lose the decimal
+            if pd.api.types.is_float_dtype(values):
+                try:
+                    values = values.astype('Int64')
+                except (ValueError, TypeError):
+                    pass
+            df[var] = values.astype(str).where(values.notna(), np.nan)
+        elif pytype is int and df[var].notna().all():
+            try:
+                df[var] = df[var].astype('int64')
+            except (ValueError, TypeError):
+                pass
+
+    return df
+
+def whole_number_to_int(cell):
+    """
+    Integer for float values like 3.0 - other values are not changed
+    """
+    return int(cell) if str(cell).endswith('.0') else cell
+
+def whole_numbers_to_int(df, datastructure = incore_v2_DataStructure):
+    """
+    Save integer columns without .0 - replaces
+    df.applymap(lambda cell: int(cell) if str(cell).endswith('.0') else cell)
+    with the same result. Only numeric columns in the data structure are
+    checked and each column is cast once:
+        category columns - the categories are changed, not each row
+        float columns - int64 if all values are whole numbers and none
+            are missing (with missing values applymap keeps float)
+    datastructure: None checks all columns
+    """
+    if datastructure is None:
+        datastructure = {var : {} for var in df.columns}
+    for var in datastructure:
+        if (var not in df.columns) or (datastructure[var].get('pyType') is str):
+            continue
+        values = df[var]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            df[var] = values.map(whole_number_to_int)
+        elif pd.api.types.is_float_dtype(values):
+            if values.notna().all() and (np.mod(values, 1) == 0).all():
+                df[var] = values.astype('int64')
+
+    return df
+
+def checkpoint_filepath(folder: str, name: str, checkpoint_format: str = None):
+    """
+    Path to checkpoint file
+    """
+    if checkpoint_format is None:
+        checkpoint_format = default_checkpoint_format()
+
+    return os.path.join(folder, name + checkpoint_extensions[checkpoint_format])
+
+def find_checkpoint(folder: str, name: str):
+    """
+    Path and format of saved checkpoint - Parquet is checked before CSV
+    """
+    for checkpoint_format in checkpoint_extensions:
+        filepath = checkpoint_filepath(folder, name, checkpoint_format)
+        if os.path.exists(filepath):
+            if checkpoint_format == 'parquet' and not parquet_available():
+                continue
+            return filepath, checkpoint_format
+
+    return None, None
+
+def csv_dtypes(df):
+    """
+    Column types that can be set when reading a CSV.
+    Geometry is saved as WKT and other types are left to the reader.
+    """
+    dtypes = {}
+    for var in df.columns:
+        dtype = str(df[var].dtype)
+        if dtype == 'object':
+            dtypes[str(var)] = 'str'
+        elif dtype in ['int64','int32','float64','float32','bool','category']:
+            dtypes[str(var)] = dtype
+
+    return dtypes
+
+def checkpoint_exists(folder: str, name: str):
+    """
+    Check if the checkpoint has been saved in any format
+    """
+    filepath, checkpoint_format = find_checkpoint(folder, name)
+
+    return filepath is not None
+
+def remove_checkpoint(folder: str, name: str):
+    """
+    Delete the checkpoint in all formats and its column types
+    """
+    for checkpoint_format in checkpoint_extensions:
+        filepath = checkpoint_filepath(folder, name, checkpoint_format)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    dtypes_filepath = os.path.join(folder, name + dtypes_extension)
+    if os.path.exists(dtypes_filepath):
+        os.remove(dtypes_filepath)
+
+def save_checkpoint(df, folder: str, name: str,
+                    checkpoint_format: str = None,
+                    index: bool = False):
+    """
+    Save dataframe or geodataframe with the column types it has.
+    Falls back to CSV if the dataframe can not be saved as Parquet,
+    for example a column with mixed types.
+    The file is written to a temporary name and then renamed, so an
+    interrupted run does not leave a partial checkpoint.
+    """
+    if checkpoint_format is None:
+        checkpoint_format = default_checkpoint_format()
+
+    if checkpoint_format == 'parquet':
+        filepath = checkpoint_filepath(folder, name, 'parquet')
+        try:
+            df.to_parquet(filepath+'.tmp', index = index)
+            os.replace(filepath+'.tmp', filepath)
+            print("Checkpoint saved:",filepath)
+            return filepath
+        except Exception as e:
+            print("Unable to save",filepath,"as Parquet:",e)
+            print("Saving as CSV.")
+            if os.path.exists(filepath+'.tmp'):
+                os.remove(filepath+'.tmp')
+
+    filepath = checkpoint_filepath(folder, name, 'csv')
+    dtypes_filepath = os.path.join(folder, name + dtypes_extension)
+    with open(dtypes_filepath+'.tmp', 'w') as dtypes_file:
+        json.dump(csv_dtypes(df), dtypes_file, indent = 2)
+    os.replace(dtypes_filepath+'.tmp', dtypes_filepath)
+    df.to_csv(filepath+'.tmp', index = index)
+    os.replace(filepath+'.tmp', filepath)
+    print("Checkpoint saved:",filepath)
+
+    return filepath
+
+def read_checkpoint(folder: str, name: str,
+                    columns: list = None,
+                    schema: dict = checkpoint_schema,
+                    migrate: bool = False,
+                    **read_csv_kwargs):
+    """
+    Read checkpoint - returns None if the checkpoint does not exist.
+    columns: only read these columns
+    schema: column types for legacy CSV files without saved column types
+    migrate: save a Parquet copy when a legacy CSV is read
+    read_csv_kwargs: options used for CSV files e.g. dtype = {'year' : str}
+    """
+    filepath, checkpoint_format = find_checkpoint(folder, name)
+    if filepath is None:
+        return None
+
+    if checkpoint_format == 'parquet':
+        import pyarrow.parquet
+        metadata = pyarrow.parquet.read_schema(filepath).metadata or {}
+        if b'geo' in metadata:
+            df = gpd.read_parquet(filepath, columns = columns)
+        else:
+            df = pd.read_parquet(filepath, columns = columns)
+        print("Checkpoint read:",filepath)
+        return df
+
+    dtypes_filepath = os.path.join(folder, name + dtypes_extension)
+    legacy = not os.path.exists(dtypes_filepath)
+    if not legacy:
+        with open(dtypes_filepath) as dtypes_file:
+            dtype = {var : (str if var_dtype == 'str' else var_dtype)
+                     for var, var_dtype in json.load(dtypes_file).items()}
+    elif schema is not None:
+        dtype = {var : str for var, pytype in schema.items() if pytype is str}
+    else:
+        dtype = {}
+    dtype.update(read_csv_kwargs.pop('dtype', {}))
+    read_csv_kwargs['dtype'] = dtype
+    read_csv_kwargs.setdefault('low_memory', False)
+    if columns is not None:
+        read_csv_kwargs['usecols'] = columns
+    df = pd.read_csv(filepath, **read_csv_kwargs)
+    print("Checkpoint read:",filepath)
+
+    if legacy and schema is not None:
+        df = apply_schema(df, schema)
+    if migrate and columns is None and parquet_available():
+        save_checkpoint(df, folder, name, checkpoint_format = 'parquet')
+
+    return df
@@ -0,0 +1,182 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Geography keys from census block ids.
+
+Census geography ids are nested:
+    Block = state (2) + county (3) + tract (6) + block (4) = 15 digits
+    the block group is the first digit of the block.
+As a 64 bit integer the parent of a block is the block id divided by a
+power of 10:
+    481677201001000 // 10**4  = 48167720100 (Tract)
+    481677201001000 // 10**10 = 48167       (County)
+
+The inventories repeat the same block id for every housing unit, person
+or job. geokey_index parses each unique block once and computes the
+parent codes for the unique blocks. Zero padded strings are only made for
+the unique codes, instead of str(int(x)).zfill(15) and string slicing on
+every row.
+
+The string id columns are part of the saved outputs, so the random merge,
+LODES and HUA code still group and merge on the strings made here. The
+int64 codes are available with codes() for new code.
+
+Example:
+    geokeys = geokey_index(df['w_geocode'])
+    df['w_countyid'] = geokeys.codes('County')       # 48167
+    df['w_countyfips'] = geokeys.strings('County')   # '48167'
+    df['w_stabbr'] = geokeys.apply_unique('State', stfips_to_stabbr)
+"""
+
+import numpy as np
+import pandas as pd
+
+# Number of digits in the id for each geography level
+geo_levels = {'State' : 2,
+              'County' : 5,
+              'Tract' : 11,
+              'BlockGroup' : 12,
+              'Block' : 15}
+
+# Code for missing or invalid ids
+missing_code = -1
+
+def geo_level_name(geolevel: str):
+    """
+    Geography level name with the same case as geo_levels
+    Tract2010 and tract return Tract
+    """
+    for geo_level in geo_levels:
+        if geolevel.lower().startswith(geo_level.lower()):
+            # BlockGroup also starts with Block
+            if geo_level == 'Block' and \
+                geolevel.lower().startswith('blockgroup'):
+                continue
+            return geo_level
+
+    raise ValueError(f"Geography level must be one of {list(geo_levels)}, not {geolevel}")
+
+def parse_geo_codes(values):
+    """
+    Geography ids to int64 codes.
+    Accepts integers, floats, strings with a leading B (Block2010str) and
+    strings read from CSV with a decimal (481677201001000.0).
+    Missing and invalid ids are set to missing_code.
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_integer_dtype(values):
+        return values.to_numpy(dtype = np.int64)
+    if not pd.api.types.is_numeric_dtype(values):
+        values = values.astype(str).str.lstrip('B')
+    # 15 digit ids are exact as float64
+    numeric = pd.to_numeric(values, errors = 'coerce').to_numpy(dtype = float)
+    valid = np.isfinite(numeric)
+    codes = np.full(numeric.shape[0], missing_code, dtype = np.int64)
+    codes[valid] = np.round(numeric[valid]).astype(np.int64)
+
+    return codes
+
+def parent_codes(codes, geolevel: str = 'County', from_geolevel: str = 'Block'):
+    """
+    Parent geography codes - codes // 10**(digits removed)
+    """
+    digits = geo_levels[geo_level_name(from_geolevel)] - \
+        geo_levels[geo_level_name(geolevel)]
+    if digits < 0:
+        raise ValueError(f"{geolevel} is not a parent of {from_geolevel}")
+    codes = np.asarray(codes, dtype = np.int64)
+
+    return np.where(codes >= 0, codes // 10**digits, missing_code)
+
+def codes_to_str(codes, geolevel: str = 'Block'):
+    """
+    Zero padded strings - same as str(int(x)).zfill(digits)
+    Missing codes are NaN
+    """
+    digits = geo_levels[geo_level_name(geolevel)]
+    codes = np.asarray(codes, dtype = np.int64)
+    strings = pd.Series(codes).astype(str).str.zfill(digits).to_numpy(dtype = object)
+    strings[codes < 0] = np.nan
+
+    return strings
+
+class geokey_index():
+    """
+    Unique geography ids of a column and the position of each row.
+    Parent codes and strings are computed once for the unique ids and
+    taken for each row.
+    values: geography ids with the same length - Block ids by default
+    geolevel: geography level of the values
+    """
+
+    def __init__(self, values, geolevel: str = 'Block'):
+        self.geolevel = geo_level_name(geolevel)
+        values = pd.Series(values)
+        self.index = values.index
+        self.row_positions, uniques = pd.factorize(values, use_na_sentinel = True)
+        self.unique_codes = {self.geolevel : parse_geo_codes(uniques)}
+        self.unique_strings = {}
+
+    def codes_for_unique(self, geolevel: str):
+        """
+        Codes for the unique ids at a geography level
+        """
+        geolevel = geo_level_name(geolevel)
+        if geolevel not in self.unique_codes:
+            self.unique_codes[geolevel] = parent_codes(
+                self.unique_codes[self.geolevel], geolevel, self.geolevel)
+
+        return self.unique_codes[geolevel]
+
+    def take(self, unique_values, fill_value):
+        """
+        Value for each row from the value for each unique id
+        """
+        row_values = unique_values.take(np.maximum(self.row_positions, 0))
+        if (self.row_positions < 0).any():
+            if pd.api.types.is_integer_dtype(row_values.dtype) and \
+                not isinstance(fill_value, (int, np.integer)):
+                row_values = row_values.astype(object)
+            row_values[self.row_positions < 0] = fill_value
+
+        return row_values
+
+    def codes(self, geolevel: str = 'Block'):
+        """
+        int64 code for each row - missing_code if the id is missing
+        """
+        return self.take(self.codes_for_unique(geolevel), missing_code)
+
+    def strings(self, geolevel: str = 'Block', prefix: str = ''):
+        """
+        Zero padded string for each row - NaN if the id is missing
+        prefix: added to each string, for example B for Block2010str
+        """
+        geolevel = geo_level_name(geolevel)
+        if (geolevel, prefix) not in self.unique_strings:
+            unique_strings = codes_to_str(self.codes_for_unique(geolevel), geolevel)
+            if prefix != '':
+                valid = pd.notnull(unique_strings)
+                unique_strings[valid] = prefix + unique_strings[valid]
+            self.unique_strings[(geolevel, prefix)] = unique_strings
+
+        return self.take(self.unique_strings[(geolevel, prefix)], np.nan)
+
+    def apply_unique(self, geolevel: str, function):
+        """
+        Apply function to the zero padded string of each unique id.
+        For example the state abbreviation from the state fips code.
+        """
+        geolevel = geo_level_name(geolevel)
+        unique_codes = self.codes_for_unique(geolevel)
+        # Parent codes repeat - apply function once for each code
+        parent_positions, unique_parents = pd.factorize(unique_codes)
+        parent_strings = codes_to_str(unique_parents, geolevel)
+        parent_values = np.array([function(value) if pd.notnull(value) else np.nan
+                                  for value in parent_strings], dtype = object)
+
+        return self.take(parent_values.take(parent_positions), np.nan)
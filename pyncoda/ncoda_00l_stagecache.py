@@ -0,0 +1,266 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Stage cache keyed by a hash of the stage inputs, parameters and code.
+
+A saved stage output is only reused if the inputs, parameters and code
+are the same as when it was saved. Each checkpoint has a manifest
+({name}.stage.json) with the stage key and the hashes used to make it.
+If the key does not match the stage runs again and replaces the
+checkpoint.
+
+Input dataframes are hashed by content (columns, types and values), so
+a value changed in place in a stage output is seen by the next stage.
+Code is hashed by the source of the stage functions and classes, so an
+edit elsewhere in the module does not run the stage again. The manifest
+also has a hash of the saved checkpoint file, so a checkpoint that was
+replaced after the manifest was saved is not reused.
+
+Only stages downstream of a changed input run again: a new building
+inventory changes the key for the housing unit estimate, which changes
+the key for the stages that use the housing unit estimate.
+
+Set NCODA_STAGE_CACHE = exists to reuse checkpoints that exist without
+checking the key (the behavior before the stage cache).
+
+Example:
+    manifest = stage_manifest('predict_housingunit_estimate',
+                    params = {'residential_archetypes' : residential_archetypes},
+                    inputs = {'bldg_inv_gdf' : bldg_inv_gdf},
+                    code = [predict_residential_addresspoints])
+    if stage_cache_hit(folder, name, manifest):
+        return read_stage(folder, name)
+    ...
+    save_stage(df, folder, name, manifest)
+"""
+
+import os
+import json
+import time
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from pyncoda.ncoda_00j_checkpoint import checkpoint_exists, read_checkpoint, \
+    save_checkpoint
+
+manifest_extension = '.stage.json'
+
+def stage_cache_mode():
+    """
+    hash (default) or exists - see NCODA_STAGE_CACHE
+    """
+    return os.environ.get('NCODA_STAGE_CACHE', 'hash').lower()
+
+def sha256_text(text: str):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def column_hash_values(values):
+    """
+    uint64 hash for each row of a column
+    """
+    if isinstance(values.dtype, gpd.array.GeometryDtype):
+        values = gpd.GeoSeries(values).to_wkb()
+    try:
+        return pd.util.hash_pandas_object(values, index = False).to_numpy()
+    except TypeError:
+        # Unhashable values - for example lists
+        return pd.util.hash_pandas_object(values.astype(str), index = False).to_numpy()
+
+def row_hashes(df, columns: list):
+    """
+    Hash of the values in columns for each row as hex strings.
+    Used to find rows that changed between two versions of a dataframe.
+    """
+    hashes = np.zeros(len(df), dtype = np.uint64)
+    for col in columns:
+        hashes = (hashes * np.uint64(1099511628211)) ^ column_hash_values(df[col])
+
+    return pd.Series(hashes, index = df.index).map('{:016x}'.format)
+
+def dataframe_hash(df):
+    """
+    Hash of the columns, types and values of a dataframe or geodataframe.
+    """
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+
+    content = hashlib.sha256()
+    for col in df.columns:
+        content.update(f'{col}:{df[col].dtype}'.encode('utf-8'))
+        content.update(column_hash_values(df[col]).tobytes())
+    if isinstance(df, gpd.GeoDataFrame) and (df.crs is not None):
+        content.update(df.crs.to_string().encode('utf-8'))
+
+    return content.hexdigest()
+
+def file_hash(filepath: str):
+    """
+    Hash of the bytes of a saved file
+    """
+    content = hashlib.sha256()
+    with open(filepath, 'rb') as saved_file:
+        for chunk in iter(lambda: saved_file.read(2**20), b''):
+            content.update(chunk)
+
+    return content.hexdigest()
+
+def normalize_for_hash(value):
+    """
+    Parameters as JSON with a stable order.
+    Dataframes are replaced by their hash.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return {'dataframe' : dataframe_hash(value)}
+    if isinstance(value, dict):
+        items = [[normalize_for_hash(key), normalize_for_hash(item)]
+                 for key, item in value.items()]
+        return {'dict' : sorted(items, key = lambda item: json.dumps(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [normalize_for_hash(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted([normalize_for_hash(item) for item in value], key = json.dumps)
+    if isinstance(value, np.ndarray):
+        return {'array' : hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return 'nan'
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if inspect.isfunction(value) or inspect.isclass(value):
+        return value.__module__+'.'+value.__qualname__
+
+    return repr(value)
+
+def code_hash(functions: list = []):
+    """
+    Hash of the source code of the stage functions, classes or modules.
+    A change to a stage function runs the stage again - comments and
+    other functions in the same module do not.
+    """
+    sources = []
+    for function in functions:
+        try:
+            sources.append(inspect.getsource(function))
+        except (OSError, TypeError):
+            sources.append(getattr(function, '__module__', '')+'.'+
+                           getattr(function, '__qualname__', repr(function)))
+
+    return sha256_text('\n'.join(sources))
+
+def stage_manifest(stage: str,
+                   params: dict = {},
+                   inputs: dict = {},
+                   code: list = []):
+    """
+    Stage key and the hashes used to make the key.
+    params: parameters that change the output
+    inputs: dataframes the stage uses
+    code: stage functions, classes or modules - their source code is hashed
+    """
+    manifest = {'stage' : stage,
+                'params' : sha256_text(json.dumps(normalize_for_hash(params),
+                                                  sort_keys = True)),
+                'inputs' : {name : dataframe_hash(df) for name, df in inputs.items()},
+                'code' : code_hash(code)}
+    manifest['key'] = sha256_text(json.dumps(manifest, sort_keys = True))
+
+    return manifest
+
+def manifest_filepath(folder: str, name: str):
+    return os.path.join(folder, name + manifest_extension)
+
+def read_stage_manifest(folder: str, name: str):
+    """
+    Saved manifest - None if the checkpoint does not have a manifest
+    """
+    filepath = manifest_filepath(folder, name)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath) as manifest_file:
+        return json.load(manifest_file)
+
+def stage_changes(saved_manifest, manifest):
+    """
+    Parts of the stage that changed since the checkpoint was saved
+    """
+    changes = []
+    if saved_manifest['params'] != manifest['params']:
+        changes.append('parameters')
+    if saved_manifest['code'] != manifest['code']:
+        changes.append('code')
+    for name, input_hash in manifest['inputs'].items():
+        if saved_manifest['inputs'].get(name) != input_hash:
+            changes.append('input '+name)
+
+    return changes
+
+def stage_cache_hit(folder: str, name: str, manifest):
+    """
+    Check if the checkpoint exists and was made with the same stage key
+    """
+    if not checkpoint_exists(folder, name):
+        return False
+    if stage_cache_mode() == 'exists':
+        return True
+
+    saved_manifest = read_stage_manifest(folder, name)
+    if saved_manifest is None:
+        print("Checkpoint",name,"has no stage manifest - running stage",manifest['stage'])
+        return False
+    if saved_manifest['key'] != manifest['key']:
+        print("Checkpoint",name,"is out of date - changed:",
+              ", ".join(stage_changes(saved_manifest, manifest)))
+        return False
+    filepath = os.path.join(folder, saved_manifest.get('checkpoint', ''))
+    if (not os.path.isfile(filepath)) or \
+        (saved_manifest.get('output') != file_hash(filepath)):
+        print("Checkpoint",name,"was changed after it was saved - running stage",
+              manifest['stage'])
+        return False
+
+    return True
+
+def read_stage(folder: str, name: str, **kwargs):
+    """
+    Read checkpoint for a stage - call after stage_cache_hit.
+    The checkpoint has the column types of the saved stage output, so a
+    cached and a fresh output have the same dataframe_hash.
+    kwargs are passed to read_checkpoint.
+    """
+    return read_checkpoint(folder, name, **kwargs)
+
+def save_stage_manifest(folder: str, name: str, manifest, filepath: str):
+    """
+    Save manifest for a checkpoint - call after the checkpoint is saved.
+    Used directly by stages that save their own output file.
+    """
+    saved_manifest = dict(manifest)
+    saved_manifest['checkpoint'] = os.path.basename(filepath)
+    saved_manifest['output'] = file_hash(filepath)
+    saved_manifest['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    statefile = manifest_filepath(folder, name)
+    with open(statefile+'.tmp', 'w') as manifest_file:
+        json.dump(saved_manifest, manifest_file, indent = 2)
+    os.replace(statefile+'.tmp', statefile)
+
+    return statefile
+
+def save_stage(df, folder: str, name: str, manifest, **kwargs):
+    """
+    Save checkpoint and manifest.
+    kwargs are passed to save_checkpoint.
+    The manifest is written after the checkpoint, so an interrupted save
+    is not a cache hit.
+    """
+    filepath = save_checkpoint(df, folder, name, **kwargs)
+    save_stage_manifest(folder, name, manifest, filepath)
+
+    return filepath
@@ -0,0 +1,224 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Local store for Census TIGER/Line shapefiles.
+
+Each TIGER zip file (layer, vintage and state or county) is downloaded
+once and saved as GeoParquet. The rows are sorted along a Hilbert curve
+so each row group covers a small area, and bounding box columns
+(minx, miny, maxx, maxy) have row group statistics. Reading a layer with
+a bounding box - for example the blocks of one county - only reads the
+row groups that can overlap the box. The original row order is kept in
+tiger_row, so a layer read from the store has the same order as the
+shapefile.
+
+Offline builds - the zip files can be copied to a mirror folder with the
+same folder tree as https://www2.census.gov/geo/tiger/ or with all zip
+files in one folder. The mirror is used before downloading.
+    NCODA_TIGER_MIRROR = folder with the zip files
+    NCODA_TIGER_OFFLINE = 1 - do not download, missing files are an error
+
+GeoParquet needs pyarrow (in requirements.txt). If pyarrow cannot be
+imported the zip file is kept in the store and read with a bounding box
+filter.
+
+Example:
+    store = tiger_store(store_folder = outputfolders['TIGERCache'])
+    block_gdf = store.read_layer('block', '2010', state_fips = '48',
+                                 state = 'TEXAS', county_fips = '48167')
+    place_gdf = store.read_layer('place', '2010', state_fips = '48',
+                                 bbox = block_gdf.total_bounds)
+"""
+
+import os
+import requests
+import geopandas as gpd
+
+from pyncoda.ncoda_00j_checkpoint import parquet_available
+
+tiger_base_url = 'https://www2.census.gov/geo/tiger/'
+
+# Original shapefile row and bounding box columns added to the GeoParquet
+tiger_row = 'tiger_row'
+bbox_cols = ['minx','miny','maxx','maxy']
+
+def tiger_url(layer: str,
+              year: str,
+              state_fips: str,
+              state: str = None,
+              county_fips: str = None,
+              base_url: str = tiger_base_url):
+    """
+    URL for Census TIGER zip file
+    layer: block, place or puma
+    Blocks are county files and need the state name - see
+    https://www2.census.gov/geo/tiger/TIGER2020PL/STATE/
+    Places and PUMAs are state files.
+    """
+    block_mid_url = f'TIGER2020PL/STATE/{state_fips}_{state}/{county_fips}/tl_2020_'
+    url_list = \
+    {'block' :
+        {'2010' : f'{base_url}{block_mid_url}{county_fips}_tabblock10.zip',
+        '2020' : f'{base_url}{block_mid_url}{county_fips}_tabblock20.zip'},
+    'place' :
+        {'2010' : f'{base_url}TIGER2010/PLACE/2010/tl_2010_{state_fips}_place10.zip',
+        '2020' : f'{base_url}TIGER2020/PLACE/tl_2020_{state_fips}_place.zip'},
+    'puma'  :
+        {'2010' : f'{base_url}TIGER2010/PUMA5/2010/tl_2010_{state_fips}_puma10.zip',
+        '2020' : f'{base_url}TIGER2020/PUMA/tl_2020_{state_fips}_puma10.zip'}}
+
+    return url_list[layer][str(year)]
+
+class tiger_store():
+    """
+    Download each TIGER zip file once and read it from GeoParquet.
+
+    store_folder: zip and parquet files - can be shared by all counties
+    mirror_folder: zip files copied from www2.census.gov/geo/tiger/
+        default is NCODA_TIGER_MIRROR
+    offline: do not download - default is NCODA_TIGER_OFFLINE
+    row_group_size: rows in each GeoParquet row group
+    """
+
+    def __init__(self,
+            store_folder: str = 'TIGERCache',
+            mirror_folder: str = None,
+            offline: bool = None,
+            base_url: str = tiger_base_url,
+            row_group_size: int = 1000,
+            timeout: float = 120):
+
+        if mirror_folder is None:
+            mirror_folder = os.environ.get('NCODA_TIGER_MIRROR')
+        if offline is None:
+            offline = os.environ.get('NCODA_TIGER_OFFLINE', '0').lower() in ['1','true','yes']
+
+        self.store_folder = store_folder
+        self.mirror_folder = mirror_folder
+        self.offline = offline
+        self.base_url = base_url
+        self.row_group_size = row_group_size
+        self.timeout = timeout
+
+    def relative_path(self, url: str):
+        """
+        Path of the zip file below the TIGER base url
+        """
+        if url.startswith(self.base_url):
+            return url[len(self.base_url):]
+        return os.path.basename(url)
+
+    def zip_filepath(self, url: str):
+        return os.path.join(self.store_folder, 'zip', self.relative_path(url))
+
+    def parquet_filepath(self, url: str):
+        filename = os.path.basename(url).replace('.zip', '.parquet')
+        return os.path.join(self.store_folder, 'parquet', filename)
+
+    def mirror_filepath(self, url: str):
+        """
+        Zip file in the mirror folder - None if it is not in the mirror
+        """
+        if self.mirror_folder is None:
+            return None
+        for filepath in [os.path.join(self.mirror_folder, self.relative_path(url)),
+                         os.path.join(self.mirror_folder, os.path.basename(url))]:
+            if os.path.exists(filepath):
+                return filepath
+        return None
+
+    def fetch_zip(self, url: str):
+        """
+        Local path of the zip file - from the store, the mirror or
+        downloaded to the store
+        """
+        filepath = self.zip_filepath(url)
+        if os.path.exists(filepath):
+            return filepath
+        mirror_filepath = self.mirror_filepath(url)
+        if mirror_filepath is not None:
+            print('Reading TIGER file from mirror:',mirror_filepath)
+            return mirror_filepath
+        if self.offline:
+            raise FileNotFoundError('TIGER file is not in the store or mirror '+
+                                    'and downloads are off (NCODA_TIGER_OFFLINE): '+url)
+
+        print('Downloading TIGER file:',url)
+        os.makedirs(os.path.dirname(filepath), exist_ok = True)
+        # Download to a temporary name so an interrupted download
+        # is not used by the next run
+        tmp_filepath = filepath+f'.{os.getpid()}.tmp'
+        with requests.get(url, stream = True, timeout = self.timeout) as response:
+            response.raise_for_status()
+            with open(tmp_filepath, 'wb') as zip_file:
+                for chunk in response.iter_content(chunk_size = 2**20):
+                    zip_file.write(chunk)
+        os.replace(tmp_filepath, filepath)
+
+        return filepath
+
+    def build_parquet(self, url: str):
+        """
+        Convert zip file to GeoParquet sorted along a Hilbert curve with
+        bounding box columns for row group statistics
+        """
+        zip_filepath = self.fetch_zip(url)
+        print('Converting TIGER file to GeoParquet:',os.path.basename(zip_filepath))
+        gdf = gpd.read_file(zip_filepath)
+        gdf[tiger_row] = range(len(gdf))
+        gdf[bbox_cols] = gdf.geometry.bounds.to_numpy()
+        if len(gdf) > 0:
+            gdf = gdf.iloc[gdf.geometry.hilbert_distance().argsort(kind = 'stable')]
+
+        filepath = self.parquet_filepath(url)
+        os.makedirs(os.path.dirname(filepath), exist_ok = True)
+        tmp_filepath = filepath+f'.{os.getpid()}.tmp'
+        gdf.to_parquet(tmp_filepath, index = False, row_group_size = self.row_group_size)
+        os.replace(tmp_filepath, filepath)
+
+        return filepath
+
+    def read_layer(self,
+                   layer: str,
+                   year: str,
+                   state_fips: str,
+                   state: str = None,
+                   county_fips: str = None,
+                   bbox = None):
+        """
+        Read TIGER layer in shapefile row order.
+        bbox: (minx, miny, maxx, maxy) in the layer CRS (EPSG 4269) -
+            only rows with a bounding box that overlaps bbox are read
+        """
+        url = tiger_url(layer = layer,
+                        year = year,
+                        state_fips = state_fips,
+                        state = state,
+                        county_fips = county_fips,
+                        base_url = self.base_url)
+        print(f'Obtaining Census {layer} data from:',url)
+
+        if not parquet_available():
+            zip_filepath = self.fetch_zip(url)
+            if bbox is not None:
+                bbox = tuple(float(value) for value in bbox)
+            return gpd.read_file(zip_filepath, bbox = bbox)
+
+        filepath = self.parquet_filepath(url)
+        if not os.path.exists(filepath):
+            filepath = self.build_parquet(url)
+
+        filters = None
+        if bbox is not None:
+            minx, miny, maxx, maxy = [float(value) for value in bbox]
+            filters = [('maxx', '>=', minx), ('minx', '<=', maxx),
+                       ('maxy', '>=', miny), ('miny', '<=', maxy)]
+        gdf = gpd.read_parquet(filepath, filters = filters)
+        gdf = gdf.sort_values(tiger_row).drop(columns = [tiger_row] + bbox_cols).\
+            reset_index(drop = True)
+
+        return gdf
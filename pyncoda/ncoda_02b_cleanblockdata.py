@@ -1,16 +1,13 @@
-import geopandas as gpd
 import pandas as pd
 import sys
 import os
 from pyncoda.ncoda_00e_geoutilities import *
+from pyncoda.ncoda_00k_geokeys import geokey_index
+from pyncoda.ncoda_00m_tigerstore import tiger_store
 
-def read_in_zip_shapefile_data(geolevel, year, url_list):
-    # Read data from www2.census.gov 
-    census_url = url_list[geolevel][year]
-    print(f'Obtaining Census {geolevel} data from:',census_url)
-    gdf = gpd.read_file(census_url)
-    
-    return gdf
+# Margin in degrees around the county blocks for the place and PUMA
+# bounding box - larger than the spatial join buffer
+tiger_bbox_margin = 0.01
 
 def add_address_point_counts(addpt_df, 
                             block_gdf, 
@@ -29,7 +26,8 @@ def obtain_join_block_place_puma_data(county_fips: str = '48167',
                             state: str = 'TEXAS',
                             year: str = '2010',
                             output_folder: str = 'hua_workflow',
-                            replace: bool = False):
+                            replace: bool = False,
+                            tiger_folder: str = None):
     """
     Function obtains and cleans Census Block Data
     Function uses County FIPS Code and URL list to look up Census ZIP Files
@@ -41,6 +39,10 @@ def obtain_join_block_place_puma_data(county_fips: str = '48167',
         https://www2.census.gov/geo/tiger/TIGER2020PL/STATE/
         Most states are all caps with _ for spaces
         example: NORTH_CAROLINA
+
+    tiger_folder: TIGER store folder - state place and PUMA files are
+        downloaded once for all counties that use the folder.
+        Default is output_folder/TIGERCache. See ncoda_00m_tigerstore.
     """
 
     # Find State FIPS Code from County FIPS Code
@@ -67,28 +69,30 @@ def obtain_join_block_place_puma_data(county_fips: str = '48167',
     else:
         print("Creating block data for ",county_fips)
 
-    # List of URLS for Census Geography Files
-    base_url = 'https://www2.census.gov/geo/tiger/'
-    block_mid_url = f'TIGER2020PL/STATE/{state_fips}_{state}/{county_fips}/tl_2020_'
-    url_list = \
-    {'block' : 
-        {'2010' : f'{base_url}{block_mid_url}{county_fips}_tabblock10.zip',
-        '2020' : f'{base_url}{block_mid_url}{county_fips}_tabblock20.zip'},
-    'place' :
-        {'2010' : f'{base_url}TIGER2010/PLACE/2010/tl_2010_{state_fips}_place10.zip',
-        '2020' : f'{base_url}TIGER2020/PLACE/tl_2020_{state_fips}_place.zip'},
-    'puma'  : 
-        {'2010' : f'{base_url}TIGER2010/PUMA5/2010/tl_2010_{state_fips}_puma10.zip',
-        '2020' : f'{base_url}TIGER2020/PUMA/tl_2020_{state_fips}_puma10.zip'}}
+    # Census Geography Files - block files are county files,
+    # place and PUMA files are state files
+    if tiger_folder is None:
+        tiger_folder = os.path.join(output_folder, 'TIGERCache')
+    store = tiger_store(store_folder = tiger_folder)
 
     # start empty geodataframe dictionary to store geolevel gdfs
     gdf = {}
     join_cols = {}
-    geolevels = ['block','place','puma']
-    for geolevel in geolevels:
-        gdf[geolevel] = read_in_zip_shapefile_data(geolevel=geolevel, 
-                                                   year = year, 
-                                                   url_list = url_list)
+    gdf['block'] = store.read_layer('block',
+                                    year = year,
+                                    state_fips = state_fips,
+                                    state = state,
+                                    county_fips = county_fips)
+    # Only the places and PUMAs near the county blocks are read
+    minx, miny, maxx, maxy = gdf['block'].total_bounds
+    county_bbox = (minx - tiger_bbox_margin, miny - tiger_bbox_margin,
+                   maxx + tiger_bbox_margin, maxy + tiger_bbox_margin)
+    for geolevel in ['place','puma']:
+        gdf[geolevel] = store.read_layer(geolevel,
+                                         year = year,
+                                         state_fips = state_fips,
+                                         bbox = county_bbox)
+    for geolevel in ['block','place','puma']:
         join_cols[geolevel] =  [col for col in gdf[geolevel] if col.startswith("GEOID")]
         join_cols[geolevel] =  join_cols[geolevel] + \
             [col for col in gdf[geolevel] if col.startswith("NAME")]
@@ -113,12 +117,11 @@ def obtain_join_block_place_puma_data(county_fips: str = '48167',
                     join_column_list = join_cols[geolevel])
 
     # Add block id string to block data
-    gdf['block'][f'BLOCKID{yr}'] = \
-        gdf['block'][f'GEOID{yr}'].apply(lambda x : str(int(x)))
+    geokeys = geokey_index(gdf['block'][f'GEOID{yr}'])
+    gdf['block'][f'BLOCKID{yr}'] = geokeys.codes('Block').astype(str)
     # Add Block ID as string with "CB" prefix = protects block id
     # from losing the leading zero when converted to integer
-    gdf['block'][f'BLOCKID{yr}_str'] = \
-        gdf['block'][f'GEOID{yr}'].apply(lambda x : "B"+str(int(x)).zfill(15))
+    gdf['block'][f'BLOCKID{yr}_str'] = geokeys.strings('Block', prefix = 'B')
     # move blockid to the start of the dataframe
     first_cols = [f'BLOCKID{yr}',f'BLOCKID{yr}_str'] 
     cols = first_cols  + \
@@ -1,8 +1,45 @@
 import matplotlib.pyplot as plt
 from scipy.stats import pearsonr
 import pandas as pd
+import numpy as np
+import geopandas as gpd
 from pyncoda.ncoda_00d_cleanvarsutils import *
 
+# Block error codes in the order they are checked - see block_error_check_addresspoints
+addresspoint_error_labels = {
+    1 : "1. HU=0",
+    2 : "2. HU=AP",
+    3 : "3. HU<AP",
+    8 : "8. HU > 0, Building Count = Missing",
+    9 : "9. HU > 0, Building Count = 0",
+    10 : "10. HU = 0, Building Count = Missing",
+    5 : "5. HU > 0, AP = 0",
+    4 : "4. HU>AP",
+    6 : "6. HU > 0, AP = Missing, But buildings present",
+    7 : "7. HU > 0, AP = Missing"}
+
+def addresspoint_error_codes(hu_count, addpt_count, bldg_count):
+    """
+    Error code for each block - same codes as block_error_check_addresspoints.
+    The first condition that is true sets the code, 0 if none are true.
+    hu_count: expected address points (census housing units)
+    addpt_count: estimated address points
+    bldg_count: building count
+    """
+    conditions = {
+        1 : (hu_count == 0),
+        2 : (hu_count == addpt_count),
+        3 : (hu_count < addpt_count),
+        8 : (hu_count > 0) & np.isnan(bldg_count),
+        9 : (hu_count > 0) & (bldg_count == 0),
+        10 : (hu_count == 0) & np.isnan(bldg_count),
+        5 : (hu_count > 0) & (addpt_count == 0),
+        4 : (hu_count > addpt_count),
+        6 : (hu_count > 0) & np.isnan(addpt_count) & (bldg_count > 0),
+        7 : (hu_count > 0) & np.isnan(addpt_count)}
+
+    return np.select(list(conditions.values()), list(conditions.keys()), default = 0)
+
 def predict_residential_addresspoints(building_to_block_gdf,
                                      hui_df,
                                      hui_blockid,
@@ -12,27 +49,28 @@ def predict_residential_addresspoints(building_to_block_gdf,
                                      archetype_var, 
                                      residential_archetypes,
                                      building_area_var,
-                                     building_area_cutoff):
+                                     building_area_cutoff,
+                                     return_summary: bool = False):
     """
     Function that attempts to predict housing units in a structure.
     Function runs three rounds of checks and updates the housing unit counts in each round.
-    To Do - This function repeats significant blocks of code that could 
-    be split into sub functions.
+    Round 1 - estimate from residential archetypes and building area
+    Round 2 - scale the difference from the census count by residential area
+    Round 3 - add one housing unit to residential buildings in blocks with too few
+
+    The rounds use sums by block code on arrays, so the buildings for a 
+    whole state can be run in one call.
+    return_summary: also return a dataframe with the correlation 
+        and the block error counts for each round
     """
     
-    # Create a copy of the building data frame
-    bldg_df = building_to_block_gdf.copy(deep=True)
+    # Only the columns used by the estimate - no copy of the geometry
+    bldg_cols = [bldg_blockid,bldg_uniqueid,placename_var,archetype_var,building_area_var]
+    bldg_df = building_to_block_gdf[list(dict.fromkeys(bldg_cols))].copy(deep=True)
+    bldg_df = pd.DataFrame(bldg_df)
+
     # start by assuming that buildings have 0 residential address points
     bldg_df['residentialAP1'] = 0
-    bldg_df['residentialAP1'].label = "Residential Address Point Round 1"
-    bldg_df['residentialAP1'].note = \
-        "Residential Address Point - first attempt to assign residential address points to buildings"
-    
-    bldg_df['residential'] = 0
-    bldg_df['residentialAP1'].label = "Residential Address Point Round 1"
-    bldg_df['residentialAP1'].note = \
-        "Residential Address Point - first attempt to assign residential address points to buildings"
-    
 
     # Update residential address points by assigning 
     # residential archetypes with 1 housing unit
@@ -46,37 +84,19 @@ def predict_residential_addresspoints(building_to_block_gdf,
         else:
             # Assign 1 to residential address points
             bldg_df.loc[condition,'residentialAP1'] = 1
-        # Length of data frame
-        len_bldg_df = bldg_df.loc[condition].shape[0]
-        print(len_bldg_df,"Buildings have Residential Archetype",residential_archetype)
 
     # remove small buildings from residential building list
     condition = (bldg_df[building_area_var] < building_area_cutoff)
     bldg_df.loc[condition,'residentialAP1'] = 0
-    # Length of data frame
-    len_bldg_df = bldg_df.loc[condition].shape[0]
-    print(len_bldg_df,"Buildings have building_area_var less than",building_area_cutoff)
 
-    # Look at shape area divided by the number of address points
-    bldg_df[building_area_var+'_by_AP'] = \
-        bldg_df[building_area_var] / bldg_df['residentialAP1']
-
-    # remove small buildings from residential building list
-    condition = (bldg_df[building_area_var+'_by_AP'] < building_area_cutoff)
-    bldg_df.loc[condition,'residentialAP1'] = 0
-    # Length of data frame
-    len_bldg_df = bldg_df.loc[condition].shape[0]
-    print(len_bldg_df,"Buildings have ",building_area_var,"_by_AP less than",building_area_cutoff)
-
-    # Check residential address points count
-    condition = (bldg_df['residentialAP1'] >= 1)
-    len_bldg_df = bldg_df.loc[condition].shape[0]
-    print(len_bldg_df,"Buildings assigned residential.")
+    # remove buildings with a small area for each address point
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        area_by_ap = bldg_df[building_area_var] / bldg_df['residentialAP1']
+    bldg_df.loc[(area_by_ap < building_area_cutoff),'residentialAP1'] = 0
 
     # Set residential binary using residentialAP1 if residentialAP1 >= 1
     bldg_df['residential'] = 0
-    condition = (bldg_df['residentialAP1'] >= 1)
-    bldg_df.loc[condition,'residential'] = 1
+    bldg_df.loc[(bldg_df['residentialAP1'] >= 1),'residential'] = 1
     bldg_df['bldgcount'] = 1
     
     # Look at address point count by block
@@ -84,11 +104,9 @@ def predict_residential_addresspoints(building_to_block_gdf,
     hua_block_counts.reset_index(inplace = True)
     hua_block_counts = hua_block_counts.\
         rename(columns={'huid': "apcount", hui_blockid : bldg_blockid })
-    # Sum apcount
-    hua_apcount = hua_block_counts['apcount'].sum()
-    print("Total number of expected housing unit address points in county:",hua_apcount)
 
     # merge address point counts by block with building data
+    # blocks with housing units and no buildings are kept
     bldg_df = pd.merge(right = bldg_df,
                        left = hua_block_counts,
                        right_on = bldg_blockid,
@@ -98,240 +116,115 @@ def predict_residential_addresspoints(building_to_block_gdf,
     # fill in missing apcounts with 0 values
     bldg_df['apcount'] = bldg_df['apcount'].fillna(value=0)
 
-    # If Address Point Count (Housing10 + Group Quarters) from Census 
-    # is 0 then Residential Address Point is also 0
-    condition = (bldg_df['apcount'] == 0)
-    len_bldg_df = bldg_df.loc[condition].shape[0]
-    print(len_bldg_df,"buildings are in blocks with no housing units.")
-    bldg_df.loc[condition,'residentialAP1'] = 0
-
-
-    # sum Buildings over the column BLOCKID.
-    # https://www.geeksforgeeks.org/python-pandas-dataframe-sum/
-    block_rap1_gdf = bldg_df[[bldg_blockid,'residentialAP1','bldgcount']].copy(deep=True)
-    block_rap1_gdf_sum = block_rap1_gdf.groupby([bldg_blockid]).sum()
-    block_rap1_gdf_sum = block_rap1_gdf_sum.rename(columns={
-                                            "residentialAP1": "residentialAP1_sum", 
-                                            "bldgcount": "bldgcount1_sum"})
-
-    # Merge Sum of Residential Address Points with Census Counts
-    census_blocks_df_rap1 = pd.merge(left = hua_block_counts, 
-                                    right = block_rap1_gdf_sum,
-                                    left_on=bldg_blockid, 
-                                    right_on=bldg_blockid, 
-                                    how='outer')
-
-    # fill in missing values
-    census_blocks_df_rap1['residentialAP1_sum'] = \
-        census_blocks_df_rap1['residentialAP1_sum'].fillna(value=0)
-    census_blocks_df_rap1['apcount'] = \
-        census_blocks_df_rap1['apcount'].fillna(value=0)
-    # Compare Bldg Count to Housing 10 Correlation
-    # calculate Pearson's correlation
-    data1 = census_blocks_df_rap1['residentialAP1_sum']
-    data2 = census_blocks_df_rap1['apcount']
-    r, prob = pearsonr(data1, data2)
-    print('For Round 1 Estimated Residential Address Points correlation: %.3f' % r)
-
-    # Look at error issues in housing unit counts
-    census_blocks_df_rap1 = \
-        block_error_check_addresspoints(
-            census_blocks_df = census_blocks_df_rap1,
-            expected_count   = 'apcount',
-            estimated_count  = 'residentialAP1_sum',
-            building_count   = 'bldgcount1_sum',
-            ErrorCheck       = 'ErrorCheck1')
-
-    # Identify difference between expected housing unit count and 
-    # sum of estimated address points
-    census_blocks_df_rap1['DiffCount1'] = \
-        census_blocks_df_rap1['apcount'] - census_blocks_df_rap1['residentialAP1_sum']
-
-    # Merge Block level data with building level data
-    keepcolumns = [bldg_blockid,'residentialAP1_sum',
-                  'bldgcount1_sum','DiffCount1','ErrorCheck1_int']
-
-    bldg_df_round2 = pd.merge(left = bldg_df, 
-                              right = census_blocks_df_rap1[keepcolumns], 
-                              left_on=bldg_blockid, 
-                              right_on=bldg_blockid, 
-                              how='left')
+    # Block code for each building - buildings without a block are -1
+    block_codes, block_ids = pd.factorize(bldg_df[bldg_blockid])
+    in_block = (block_codes >= 0)
+    codes = block_codes[in_block]
+    block_count = len(block_ids)
+
+    def block_sum(values):
+        # Sum by block - missing values are 0
+        values = values[in_block]
+        return np.bincount(codes, weights = np.where(np.isnan(values), 0, values),
+                           minlength = block_count)
+
+    def to_buildings(block_values):
+        building_values = np.full(len(block_codes), np.nan)
+        building_values[in_block] = block_values[codes]
+        return building_values
+
+    # Expected address points (Housing10 + Group Quarters) by block
+    apcount = bldg_df['apcount'].to_numpy(dtype = float)
+    block_apcount = np.zeros(block_count)
+    block_apcount[codes] = apcount[in_block]
+    bldgcount = bldg_df['bldgcount'].to_numpy(dtype = float)
+    block_bldgcount = block_sum(bldgcount)
+
+    summary = []
+    def check_round(round_number, block_estimate):
+        # Compare Bldg Count to Housing 10 Correlation and error codes by block
+        errors = addresspoint_error_codes(block_apcount, block_estimate, block_bldgcount)
+        r, prob = pearsonr(block_estimate, block_apcount)
+        round_summary = {'round' : round_number,
+                         'correlation' : r,
+                         'expected' : block_apcount.sum(),
+                         'estimated' : block_estimate.sum(),
+                         'blocks' : block_count}
+        for error_code, value_label in addresspoint_error_labels.items():
+            round_summary[value_label] = int((errors == error_code).sum())
+        summary.append(round_summary)
+        return errors
+
+    # Round 1
+    # If Address Point Count from Census is 0 then Residential Address Point is also 0
+    residential_ap1 = bldg_df['residentialAP1'].to_numpy(dtype = float)
+    residential_ap1[apcount == 0] = 0
+    block_ap1 = block_sum(residential_ap1)
+    error_check1 = check_round(1, block_ap1)
+    # Difference between expected housing unit count and sum of estimated address points
+    diff_count1 = block_apcount - block_ap1
+
+    # Round 2
+    building_error1 = to_buildings(error_check1)
+    # For Error Code 5 Make each Building a Residential Building
+    residential_ap1[building_error1 == 5] = 1
 
+    # Share of the residential area in the block
+    building_area = bldg_df[building_area_var].fillna(0).\
+        replace([float('inf'), -float('inf')], 0).astype('int64').to_numpy(dtype = float)
+    res_area = np.where(residential_ap1 == 1, building_area, 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        residential_ap2 = (res_area / to_buildings(block_sum(res_area))) * \
+            to_buildings(diff_count1)
 
-    # For Error Code 5 Make each Building a Residential Building
-    condition = (bldg_df_round2['ErrorCheck1_int'] == 5)
-    bldg_df_round2.loc[condition,'residentialAP1']=1
-    len_bldg_df = bldg_df_round2.loc[condition].shape[0]
-    print(len_bldg_df,"buildings with error 5. HU > 0, AP = 0.")
-
-    # Calculate sum of Residential Area By Block
-    bldg_df_round2['Res_Area'] = 0
-    condition = (bldg_df_round2['residentialAP1'] == 1)
-    # Fill non-finite values in building_area_var with 0, then cast to int64
-    bldg_df_round2.loc[condition, 'Res_Area'] = bldg_df_round2[
-        building_area_var
-        ].fillna(0).replace([float('inf'), -float('inf')], 0).astype('int64')
-    bldg_df_round2_area = bldg_df_round2[[bldg_blockid,'Res_Area']].copy(deep=True)
-    bldg_df_round2_area_sum = bldg_df_round2_area.groupby([bldg_blockid]).sum()
-    bldg_df_round2_area_sum = bldg_df_round2_area_sum.\
-        rename(columns={"Res_Area": "Sum_Res_Area"})
-    bldg_df_round2 = pd.merge(left = bldg_df_round2, 
-                              right = bldg_df_round2_area_sum, 
-                              left_on=bldg_blockid, 
-                              right_on=bldg_blockid, 
-                              how='outer')
-
-    # Calculate Number of Address Points Each Building Should Have 
-    # based on Housing Unit Count Difference
-    bldg_df_round2['residentialAP2'] = \
-        (bldg_df_round2['Res_Area'] / bldg_df_round2['Sum_Res_Area']) * \
-            bldg_df_round2['DiffCount1'] 
-
-    ### Estimate new Housing Unit Count in Building
     # Using the distributed difference in address points, 
     # round the value and add to the initial estimate.
-    # For blocks where the housing unit and address points are equal (Error 2) or 
-    # for blocks where the number of address points is greater than 
-    # the number of Housing Units (Error 3) 
-    # use the estimate from Round 1.
-    bldg_df_round2['residentialAP2v2'] = \
-        round(bldg_df_round2['residentialAP2'],0) + bldg_df_round2['residentialAP1']
-    # If Round 1 had a match between Address Points and Housing Units use Round 1
-    condition = (bldg_df_round2['ErrorCheck1_int'] == 2)
-    bldg_df_round2.loc[condition,'residentialAP2v2'] = bldg_df_round2['residentialAP1']
-    len_bldg_df = bldg_df_round2.loc[condition].shape[0]
-    print(len_bldg_df,"buildings with error 2. HU=AP")
-    # If Round 1 had a more Address Points than Housing Units Use Round 1
-    condition = (bldg_df_round2['ErrorCheck1_int'] == 3)
-    bldg_df_round2.loc[condition,'residentialAP2v2'] = bldg_df_round2['residentialAP1']
-    len_bldg_df = bldg_df_round2.loc[condition].shape[0]
-    print(len_bldg_df,"buildings with error 3. HU<AP.")
-    # If Round 1 had no buildings Use Round 1
-    condition = (bldg_df_round2['ErrorCheck1_int'] == 9)
-    bldg_df_round2.loc[condition,'residentialAP2v2'] = bldg_df_round2['residentialAP1']
-    len_bldg_df = bldg_df_round2.loc[condition].shape[0]
-    print(len_bldg_df,"buildings with error 9. no buildings for hu.")
-
+    residential_ap2v2 = np.round(residential_ap2, 0) + residential_ap1
+    # If Round 1 had a match (Error 2), more Address Points than Housing Units (Error 3)
+    # or no buildings (Error 9) use Round 1
+    condition = np.isin(building_error1, [2, 3, 9])
+    residential_ap2v2[condition] = residential_ap1[condition]
     # If Estimated number of Census Housing Units is 0 make AP 0
-    condition = (bldg_df_round2['ErrorCheck1_int'] == 1)
-    bldg_df_round2.loc[condition,'residentialAP2v2'] = 0
-    len_bldg_df = bldg_df_round2.loc[condition].shape[0]
-    print(len_bldg_df,"buildings with error 1. HU=0.")
-
-    # sum Buildings over the column BLOCKID.
-    # https://www.geeksforgeeks.org/python-pandas-dataframe-sum/
-    block_rap2_df = bldg_df_round2[[bldg_blockid,'residentialAP2v2','bldgcount']].copy(deep=True)
-    #block_rap2_df['bldgcountv2'] = 1
-    block_rap2_df_sum = block_rap2_df.groupby([bldg_blockid]).sum()
-    block_rap2_df_sum = \
-        block_rap2_df_sum.rename(columns={
-                                "residentialAP2v2": "residentialAP2v2_sum", 
-                                "bldgcount": "bldgcountv2_sum"})
-    # Merge Sum of Residential Address Points with Census Counts
-    census_blocks_df_rap2 = pd.merge(
-                                  left = census_blocks_df_rap1, 
-                                  right = block_rap2_df_sum,
-                                  left_on=bldg_blockid, 
-                                  right_on=bldg_blockid, 
-                                  how='left')
-
-    # Compare Bldg Count to Housing 10 Correlation
-    # calculate Pearson's correlation
-    data1 = census_blocks_df_rap2['residentialAP2v2_sum']
-    data2 = census_blocks_df_rap2['apcount']
-    r, prob = pearsonr(data1, data2)
-    print('For Round 2 Estimated Residential Address Points correlation: %.3f' % r)
-
-    # Error check round 2
-    census_blocks_df_rap2 = \
-        block_error_check_addresspoints(
-            census_blocks_df = census_blocks_df_rap2,
-            expected_count   = 'apcount',
-            estimated_count  = 'residentialAP2v2_sum',
-            building_count   = 'bldgcountv2_sum',
-            ErrorCheck       = 'ErrorCheck2')
-    # Identify difference between expected housing unit count and
-    # sum of estimated address points
-    census_blocks_df_rap2['DiffCount2'] = \
-        census_blocks_df_rap2['apcount'] - census_blocks_df_rap2['residentialAP2v2_sum']
-
-
-    # Merge Block level data with building level data
-    keepcolumns = [bldg_blockid,'residentialAP2v2_sum', \
-        'bldgcountv2_sum','DiffCount2','ErrorCheck2_int']
-
-    bldg_df_round3 = pd.merge(bldg_df_round2, 
-                              census_blocks_df_rap2[keepcolumns], 
-                              left_on=bldg_blockid, 
-                              right_on=bldg_blockid, 
-                              how='left')
+    residential_ap2v2[building_error1 == 1] = 0
+    error_check2 = check_round(2, block_sum(residential_ap2v2))
 
+    # Round 3
+    building_error2 = to_buildings(error_check2)
     # update estimated address point count
-    bldg_df_round3['huestimate'] = bldg_df_round3['residentialAP2v2']
-    condition1 = (bldg_df_round3['ErrorCheck2_int']==4)
-    condition2 = (bldg_df_round3['residentialAP2v2']>=1)
-    condition = condition1 & condition2
-    bldg_df_round3.loc[condition,'huestimate'] = bldg_df_round3['huestimate'] + 1
-    len_bldg_df = bldg_df_round3.loc[condition].shape[0]
-    print(len_bldg_df,"buildings updated huestimate by 1.")
-
+    huestimate = residential_ap2v2.copy()
+    condition = (building_error2 == 4) & (residential_ap2v2 >= 1)
+    huestimate[condition] = huestimate[condition] + 1
     # Check for condition 5 - too few AP for HUs
-    condition1 = (bldg_df_round3['ErrorCheck2_int']==5)
-    condition2 = (bldg_df_round3['huestimate'].isna())
-    condition = condition1 & condition2
-    bldg_df_round3.loc[condition,'huestimate'] = 1
-    len_bldg_df = bldg_df_round3.loc[condition].shape[0]
-    print(len_bldg_df,"buildings updated huestimate by 1.")
-
-    # sum Buildings over the column BLOCKID.
-    # https://www.geeksforgeeks.org/python-pandas-dataframe-sum/
-    block_rap3_df = bldg_df_round3[[bldg_blockid,'huestimate','bldgcount']].copy(deep=True)
-    #block_rap3_df['bldgcountv3'] = 1
-    block_rap3_df_sum = block_rap3_df.groupby([bldg_blockid]).sum()
-    block_rap3_df_sum = block_rap3_df_sum.rename(columns={
-                                "huestimate": "residentialAP2v3_sum", 
-                                "bldgcount": "bldgcountv3_sum"})
-    # Merge Sum of Residential Address Points with Census Counts
-    census_blocks_df_rap3 = pd.merge(left = census_blocks_df_rap2,
-                                    right = block_rap3_df_sum,
-                                    left_on=bldg_blockid, 
-                                    right_on=bldg_blockid, 
-                                    how='left')
-    # Compare Bldg Count to Housing 10 Correlation
-    # calculate Pearson's correlation
-    data1 = census_blocks_df_rap3['residentialAP2v3_sum']
-    data2 = census_blocks_df_rap3['apcount']
-    r, prob = pearsonr(data1, data2)
-    print('For Round 3 Estimated Residential Address Points correlation: %.3f' % r)
-
-    # Error check round 3
-    census_blocks_df_rap3 = \
-        block_error_check_addresspoints(
-            census_blocks_df = census_blocks_df_rap3,
-            expected_count   = 'apcount',
-            estimated_count  = 'residentialAP2v3_sum',
-            building_count   = 'bldgcountv3_sum',
-            ErrorCheck       = 'ErrorCheck3')
-    # Identify difference between expected housing unit count and 
-    # sum of estimated address points
-    census_blocks_df_rap3['DiffCount3'] = \
-        census_blocks_df_rap3['apcount'] - census_blocks_df_rap3['bldgcountv3_sum']
-
-    # Merge Block level data with building level data
-    keepcolumns = [bldg_blockid,'DiffCount3','ErrorCheck3_int','bldgcountv3_sum']
-
-    bldg_df_round3 = pd.merge(left = bldg_df_round3, 
-                              right = census_blocks_df_rap3[keepcolumns], 
-                              left_on=bldg_blockid, 
-                              right_on=bldg_blockid, 
-                              how='left')                                
-
-    return_cols1 = [bldg_blockid,bldg_uniqueid,placename_var,
+    huestimate[(building_error2 == 5) & np.isnan(huestimate)] = 1
+    error_check3 = check_round(3, block_sum(huestimate))
+
+    # Block level results for each building
+    # Integer columns are float if buildings are missing a block id
+    blocks_missing_hui = ~pd.Index(block_ids).isin(hua_block_counts[bldg_blockid])
+    bldgcount_int = pd.api.types.is_integer_dtype(bldg_df['bldgcount'])
+    block_results = {
+        'DiffCount3' : (block_apcount - block_bldgcount,
+                        bldgcount_int and not blocks_missing_hui.any()),
+        'bldgcountv3_sum' : (block_bldgcount, bldgcount_int),
+        'ErrorCheck1_int' : (error_check1, True),
+        'ErrorCheck2_int' : (error_check2, True),
+        'ErrorCheck3_int' : (error_check3, True)}
+    bldg_df['huestimate'] = huestimate
+    for var, (block_values, integer) in block_results.items():
+        bldg_df[var] = to_buildings(block_values)
+        if integer and in_block.all():
+            bldg_df[var] = bldg_df[var].astype('int64')
+
+    return_cols = [bldg_blockid,bldg_uniqueid,placename_var,
                     archetype_var,'residential','apcount','bldgcount',
                     'huestimate','DiffCount3',"bldgcountv3_sum",
                     'ErrorCheck1_int','ErrorCheck2_int','ErrorCheck3_int']
-    return_cols = return_cols1
-    return bldg_df_round3[return_cols]
+    huestimate_df = bldg_df[return_cols]
+
+    if return_summary:
+        return huestimate_df, pd.DataFrame(summary).set_index('round')
+
+    return huestimate_df
 
 
 def block_error_check_addresspoints(census_blocks_df, 
@@ -428,4 +321,104 @@ def block_error_check_addresspoints(census_blocks_df,
                         df = census_blocks_df, 
                         conditions = error_codes_conditions)
 
-    return pd_df
\ No newline at end of file
+    return pd_df
+
+
+def expand_addresspoints(building_df,
+                         block_df,
+                         building_blockid,
+                         block_blockid,
+                         building_count,
+                         block_count,
+                         counter_var = 'blockidcounter'):
+    """
+    Address points for the buildings and the census blocks.
+    Same result as expanding both dataframes with index.repeat
+    and an outer merge on block id and a counter by block id,
+    without expanding the census blocks.
+
+    The counter is made from a cumulative sum by block on the
+    unexpanded buildings. The k-th building address point in a block
+    is paired with the k-th census address point in the block.
+    Census address points without a building are added after
+    the building address points in the block.
+
+    building_count: address points for each building
+    block_count: address points for each census block
+    Block ids have to be unique in block_df.
+    Buildings with a missing block id are not paired with census blocks.
+    Returns one row for each address point sorted by block id and counter.
+    """
+    building_n = building_df[building_count].to_numpy().astype('int64')
+    building_rows = np.repeat(np.arange(len(building_df)), building_n)
+    # Counter for the first address point of each building in the block
+    block_offset = building_df[building_count].astype('int64').\
+        groupby(building_df[building_blockid], dropna = False, sort = False).\
+        cumsum().to_numpy() - building_n
+    building_start = np.cumsum(building_n) - building_n
+    building_counter = np.arange(len(building_rows)) - \
+        np.repeat(building_start, building_n) + \
+        np.repeat(block_offset, building_n)
+
+    expand_buildings = building_df.iloc[building_rows].reset_index(drop = True)
+    expand_buildings[counter_var] = building_counter
+
+    # Position of the census block for each building address point
+    block_n = block_df[block_count].fillna(0).to_numpy().astype('int64')
+    block_ids = block_df[block_blockid]
+    block_index = pd.Index(block_ids[block_ids.notna()])
+    block_positions = np.flatnonzero(block_ids.notna().to_numpy())
+    block_pos = block_index.get_indexer(expand_buildings[building_blockid])
+    block_pos = np.where(block_pos >= 0, block_positions[block_pos], -1)
+    paired = (block_pos >= 0) & \
+        (building_counter < block_n[np.maximum(block_pos, 0)])
+
+    block_df = block_df.reset_index(drop = True)
+    paired_blocks = block_df.reindex(np.where(paired, block_pos, -1)).\
+        reset_index(drop = True)
+    building_addresspoints = pd.concat([expand_buildings, paired_blocks], axis = 1)
+
+    # Census address points without a building
+    buildings_in_block = expand_buildings.groupby(building_blockid).size()
+    block_start = buildings_in_block.reindex(block_ids).fillna(0).\
+        to_numpy().astype('int64')
+    block_start[block_ids.isna().to_numpy()] = 0
+    block_extra = np.maximum(block_n - block_start, 0)
+    block_rows = np.repeat(np.arange(len(block_df)), block_extra)
+    extra_start = np.cumsum(block_extra) - block_extra
+    census_addresspoints = block_df.iloc[block_rows].reset_index(drop = True)
+    census_addresspoints[counter_var] = np.arange(len(block_rows)) - \
+        np.repeat(extra_start, block_extra) + block_start[block_rows]
+
+    addresspoints = pd.concat([building_addresspoints, census_addresspoints],
+                              ignore_index = True)
+
+    # Outer merge order - block id then counter, missing block ids last
+    sort_blockid = addresspoints[building_blockid].\
+        where(addresspoints[building_blockid].notna(), addresspoints[block_blockid])
+    sort_order = pd.DataFrame({'blockid' : sort_blockid,
+                               'counter' : addresspoints[counter_var]}).\
+        sort_values(by = ['blockid','counter'], na_position = 'last',
+                    kind = 'mergesort').index
+
+    return addresspoints.loc[sort_order].reset_index(drop = True)
+
+
+def point_xy_table(df, keyvar, geometryvar):
+    """
+    X and Y for a point geometry column - one row for each key.
+    Used as a side table so the address points do not carry
+    a copy of the geometry.
+    Geometry can be shapely points or Well Known Text.
+    """
+    points = df[[keyvar, geometryvar]].dropna().drop_duplicates(subset = keyvar)
+    geometry = points[geometryvar]
+    if not isinstance(geometry.dtype, gpd.array.GeometryDtype):
+        if geometry.map(lambda value: isinstance(value, str)).all():
+            geometry = gpd.GeoSeries.from_wkt(geometry)
+        else:
+            geometry = gpd.GeoSeries(geometry)
+
+    return pd.DataFrame({'x' : geometry.x.to_numpy(),
+                         'y' : geometry.y.to_numpy()},
+                        index = points[keyvar].to_numpy())
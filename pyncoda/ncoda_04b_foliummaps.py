@@ -14,6 +14,7 @@ import os
 import matplotlib.pyplot as plt
 import contextily as cx
 import matplotlib.colors as mcolors
+from pyncoda.ncoda_00k_geokeys import geokey_index
 
 def folium_marker_layer_map(gdf,
                              gdfvar,
@@ -102,11 +103,11 @@ def count_gdfvar_by_building(hua_df,
         # Add block id 2010 as string
         # zero pad block id to 15 digits
         print("Adding Block2010")
-        hua_df['Block2010'] = hua_df['blockid'].apply(lambda x : str(int(x)).zfill(15))
+        hua_df['Block2010'] = geokey_index(hua_df['blockid']).strings('Block')
     # Check if Block2010 is a string
     if hua_df['Block2010'].dtype != 'object':
         print("Converting Block2010 to string")
-        hua_df['Block2010'] = hua_df['Block2010'].apply(lambda x : str(int(x)).zfill(15))
+        hua_df['Block2010'] = geokey_index(hua_df['Block2010']).strings('Block')
 
     # check if block number is set
     if blocknum != '':
@@ -43,16 +43,81 @@ import pandas as pd
 import os # For saving output to path
 import urllib
 import sys 
+import time
+import multiprocessing
+import concurrent.futures
 
 # open, read, and execute python program with reusable commands
 from pyncoda.CommunitySourceData.api_census_gov.acg_05a_hui_functions \
     import hui_workflow_functions
-from pyncoda.ncoda_00b_directory_design import directory_design
+from pyncoda.ncoda_00b_directory_design import directory_design, \
+    county_directory_design
 from pyncoda.ncoda_04a_Figures import *
 from pyncoda.ncoda_06c_Codebook import *
 
 from pyncoda.CommunitySourceData.api_census_gov.acg_00e_incore_huiv2 \
     import incore_v2_DataStructure
+from pyncoda.ncoda_00j_checkpoint import whole_numbers_to_int
+from pyncoda.ncoda_00l_stagecache import stage_manifest, stage_cache_hit, \
+    save_stage_manifest
+from pyncoda.ncoda_00j_checkpoint import read_checkpoint
+from pyncoda.CommunitySourceData.api_census_gov.acg_01a_BaseInventory import BaseInventory
+from pyncoda.CommunitySourceData.api_census_gov.acg_02a_add_categorical_char \
+    import add_new_char_by_random_merge_2dfs
+from pyncoda.CommunitySourceData.api_census_gov.acg_02b_incomefunctions \
+    import add_randincome
+from pyncoda.CommunitySourceData.api_census_gov.acg_02d_polishdf \
+    import fill_missingvalues
+
+def county_hui_manifest(county_settings):
+    """
+    Stage key for the county housing unit inventory.
+    The county file does not depend on the community, so communities
+    that share a county share the file in the county folder.
+    """
+    return stage_manifest('generate_county_hui',
+                params = {'state_county' : county_settings['state_county'],
+                          'seed' : county_settings['seed'],
+                          'version' : county_settings['version'],
+                          'basevintage' : county_settings['basevintage']},
+                code = [hui_workflow_functions, BaseInventory,
+                        add_new_char_by_random_merge_2dfs,
+                        add_randincome, fill_missingvalues])
+
+def generate_county_hui(county_settings):
+    """
+    Housing unit inventory in IN-CORE v2 format for one county.
+    Runs in a worker process - county_settings has the arguments for
+    hui_workflow_functions.
+    If another community already generated the county with the same
+    seed, version and code the county file is read from the county folder.
+    """
+    start_time = time.time()
+    generate_df = hui_workflow_functions(**county_settings)
+    county_folder = county_settings['outputfolders']['top']
+    county_filename = f"hui_{county_settings['version_text']}_"\
+        f"{county_settings['state_county']}_{county_settings['basevintage']}_"\
+        f"rs{county_settings['seed']}"
+    manifest = county_hui_manifest(county_settings)
+    if stage_cache_hit(county_folder, county_filename, manifest):
+        print("County",county_settings['state_county'],
+              "already generated, reading:",county_folder+"/"+county_filename)
+        hui_df = read_checkpoint(county_folder, county_filename)
+        # Set IN-CORE v2 types - file already saved
+        hui_incore_df = generate_df.save_incore_version2(hui_df, savecsv = False)
+        return county_settings['state_county'], hui_incore_df, time.time() - start_time
+
+    # Generate base housing unit inventory
+    base_hui_df = generate_df.run_hui_workflow()
+    hui_df = generate_df.final_polish_hui(base_hui_df['primary'])
+
+    # Save version for IN-CORE in v2 format
+    hui_incore_df = generate_df.save_incore_version2(hui_df)
+    if generate_df.savefiles == True:
+        save_stage_manifest(county_folder, county_filename, manifest,
+                            county_folder+"/"+county_filename+'.csv')
+
+    return county_settings['state_county'], hui_incore_df, time.time() - start_time
 
 class generate_hui_functions():
     """
@@ -60,6 +125,12 @@ class generate_hui_functions():
     Process runs for multiple counties.
 
     Outputs CSV files and Codebooks
+
+    max_workers: number of counties generated at the same time in worker
+        processes - default one worker for each county up to os.cpu_count().
+        Each worker holds one county, so max_workers also limits memory.
+        1 generates the counties one after another in this process.
+    start_method: multiprocessing start method - default fork if available
     """
 
     def __init__(self,
@@ -71,7 +142,9 @@ class generate_hui_functions():
             outputfolder: str ="",
             outputfolders = {},
             savefiles: bool = True,
-            use_incore: bool = True):
+            use_incore: bool = True,
+            max_workers: int = None,
+            start_method: str = None):
 
         self.communities = communities
         self.seed = seed
@@ -82,6 +155,13 @@ class generate_hui_functions():
         self.outputfolders = outputfolders
         self.savefiles = savefiles
         self.use_incore = use_incore
+        self.max_workers = max_workers
+        if start_method is None:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                start_method = 'fork'
+            else:
+                start_method = 'spawn'
+        self.start_method = start_method
 
 
         # Save Outputfolder - due to long folder name paths output saved to folder with shorter name
@@ -92,6 +172,43 @@ class generate_hui_functions():
             os.mkdir(self.outputfolder)
 
 
+    def generate_counties_hui(self, county_settings):
+        """
+        Generate the housing unit inventory for each county.
+        Counties run in parallel worker processes and each county is
+        returned when it finishes.
+        Returns dictionary with the IN-CORE v2 dataframe for each county.
+        """
+        hui_incore_county_df = {}
+        max_workers = self.max_workers
+        if max_workers is None:
+            max_workers = min(len(county_settings), os.cpu_count())
+
+        if (max_workers <= 1) or (len(county_settings) <= 1):
+            for state_county in county_settings:
+                state_county, hui_incore_county_df[state_county], run_time = \
+                    generate_county_hui(county_settings[state_county])
+            return hui_incore_county_df
+
+        print("\n***************************************")
+        print("    Generate",len(county_settings),"counties on",max_workers,"workers.")
+        print("***************************************\n")
+
+        start_time = time.time()
+        mp_context = multiprocessing.get_context(self.start_method)
+        with concurrent.futures.ProcessPoolExecutor(max_workers = max_workers,
+                                                    mp_context = mp_context) as executor:
+            pending = [executor.submit(generate_county_hui, county_settings[state_county])
+                       for state_county in county_settings]
+            for future in concurrent.futures.as_completed(pending):
+                state_county, hui_incore_county_df[state_county], run_time = \
+                    future.result()
+                print("County",state_county,"finished in",round(run_time, 1),
+                      "seconds,",len(hui_incore_county_df),"of",len(county_settings),
+                      "counties after",round(time.time() - start_time, 1),"seconds.")
+
+        return hui_incore_county_df
+
     def generate_hui_v2_for_incore(self):
         """
         Generate HUI data for IN-CORE
@@ -119,55 +236,65 @@ class generate_hui_functions():
                     print("Dataset already exists on IN-CORE, use dataset_id:",dataset_id)
                     return dataset_id
     
+            # create output folders for hui data generation
+            outputfolders = directory_design(state_county_name = community,
+                                                outputfolder = self.outputfolder)
+
             # Workflow for generating HUI data for IN-CORE
+            county_settings = {}
             for county in self.communities[community]['counties'].keys():
                 state_county = self.communities[community]['counties'][county]['FIPS Code']
                 state_county_name  = self.communities[community]['counties'][county]['Name']
                 print(state_county_name,': county FIPS Code',state_county)
                 county_list = county_list + state_county_name+': county FIPS Code '+state_county
-
-                # create output folders for hui data generation
-                outputfolders = directory_design(state_county_name = community,
-                                                    outputfolder = self.outputfolder)
-                generate_df = hui_workflow_functions(
+                # County results are shared by all communities with the county
+                county_outputfolders = county_directory_design(
                     state_county = state_county,
-                    state_county_name= state_county_name,
-                    seed = self.seed,
-                    version = self.version,
-                    version_text = self.version_text,
-                    basevintage = self.basevintage,
-                    outputfolder = self.outputfolder,
-                    outputfolders = outputfolders)
-                
-                # Check if output file already exists
-                check_file = outputfolders['top']+"/../"+output_filename+'.csv'
-                if os.path.exists(check_file):
-                    print("File already exists, skipping:",check_file)
-                    # Read in HUI Data
-                    hui_df = pd.read_csv(check_file, header="infer")
-                    # Save version for IN-CORE in v2 format
-                    hui_incore_df = \
-                        generate_df.save_incore_version2(hui_df)
-                    # Remove .0 from data
-                    hui_incore_df_fixed = hui_incore_df.applymap(lambda cell: int(cell) if str(cell).endswith('.0') else cell)
-
-                    return hui_incore_df_fixed
-                                                    
-
-                # Generate base housing unit inventory
-                base_hui_df = generate_df.run_hui_workflow()
-                hui_df = generate_df.final_polish_hui(base_hui_df['primary'])
-
-                # Save version for IN-CORE in v2 format
-                hui_incore_county_df[state_county] = \
-                    generate_df.save_incore_version2(hui_df)
-
-            # combine multiple counties
-            hui_incore_df = pd.concat(hui_incore_county_df.values(), 
-                                            ignore_index=True, axis=0)
+                    outputfolder = self.outputfolder)
+
+                county_settings[state_county] = {
+                    'state_county' : state_county,
+                    'state_county_name' : state_county_name,
+                    'seed' : self.seed,
+                    'version' : self.version,
+                    'version_text' : self.version_text,
+                    'basevintage' : self.basevintage,
+                    'outputfolder' : self.outputfolder,
+                    'outputfolders' : county_outputfolders}
+
+            # Check if output file already exists for the same counties, seed and code
+            check_file = outputfolders['top']+"/../"+output_filename+'.csv'
+            manifest = stage_manifest('generate_hui_v2_for_incore',
+                            params = {'counties' : list(county_settings),
+                                      'seed' : self.seed,
+                                      'version' : self.version,
+                                      'basevintage' : self.basevintage},
+                            code = [generate_hui_functions, hui_workflow_functions,
+                                    BaseInventory, add_new_char_by_random_merge_2dfs,
+                                    add_randincome, fill_missingvalues])
+            if stage_cache_hit(outputfolders['top']+"/..", output_filename, manifest):
+                print("File already exists, skipping:",check_file)
+                generate_df = hui_workflow_functions(
+                    **list(county_settings.values())[0])
+                # Read in HUI Data
+                hui_df = pd.read_csv(check_file, header="infer")
+                # Set IN-CORE v2 types - do not replace the county file
+                hui_incore_df = \
+                    generate_df.save_incore_version2(hui_df, savecsv = False)
+                # Remove .0 from data
+                hui_incore_df_fixed = whole_numbers_to_int(hui_incore_df)
+
+                return hui_incore_df_fixed
+
+            hui_incore_county_df = self.generate_counties_hui(county_settings)
+
+            # combine multiple counties in the order of the community dictionary
+            hui_incore_df = pd.concat([hui_incore_county_df[state_county]
+                                       for state_county in county_settings],
+                                       ignore_index=True, axis=0)
 
             # Remove .0 from data
-            hui_incore_df_fixed = hui_incore_df.applymap(lambda cell: int(cell) if str(cell).endswith('.0') else cell)
+            hui_incore_df_fixed = whole_numbers_to_int(hui_incore_df.copy())
 
             #Save results for community name
             # Output files
@@ -178,6 +305,8 @@ class generate_hui_functions():
             hui_incore_df_fixed.to_csv(savefile, index=False)
             # Save second set of files in common directory
             hui_incore_df_fixed.to_csv(common_directory+'.csv', index=False)
+            save_stage_manifest(outputfolders['top']+"/..", output_filename, manifest,
+                                common_directory+'.csv')
             
             # Generate figures for explore data
             figures_list = []
@@ -53,17 +53,22 @@ import geopandas as gpd # For reading in shapefiles
 import numpy as np
 import sys # For displaying package versions
 import os # For managing directories and file paths if drive is mounted
-
-# Use shapely.wkt loads to convert WKT to GeoSeries
-from shapely.wkt import loads
+import io # For reading the address points the same way as the csv file
 
 
 # open, read, and execute python program with reusable commands
-from pyncoda.ncoda_00b_directory_design import directory_design
+from pyncoda.ncoda_00b_directory_design import county_directory_design
 from pyncoda.ncoda_00e_geoutilities import *
 from pyncoda.ncoda_02b_cleanblockdata import *
 from pyncoda.ncoda_02d_addresspoint import *
+from pyncoda.ncoda_00k_geokeys import geokey_index
+from pyncoda.ncoda_00j_checkpoint import checkpoint_exists, read_checkpoint, \
+    whole_numbers_to_int, apply_schema
+from pyncoda.ncoda_00l_stagecache import stage_manifest, stage_cache_hit, \
+    read_stage, save_stage, save_stage_manifest, row_hashes
 
+# Block id for buildings and address points without a census block
+no_block_id = 'B999999999999999'
 
 class generate_addpt_functions():
     """
@@ -99,7 +104,9 @@ class generate_addpt_functions():
             basevintage: str = 2010,
             outputfolder: str ="",
             savefiles: bool = True,
-            use_incore: bool = True):
+            use_incore: bool = True,
+            incremental: bool = False,
+            previous_bldg_inv_id: str = None):
 
         self.community = community
         self.communities = communities
@@ -119,6 +126,13 @@ class generate_addpt_functions():
         self.savefiles = savefiles
         self.year = basevintage
         self.use_incore = use_incore
+        # Update the address points for the blocks with changed buildings
+        # using the output for the previous building inventory
+        self.incremental = incremental
+        if previous_bldg_inv_id is None:
+            previous_bldg_inv_id = bldg_inv_id
+        self.previous_bldg_inv_id = previous_bldg_inv_id
+        self.changed_blocks = None
 
 
     def obtain_census_block_place_puma_gdf(self, community, year):
@@ -136,10 +150,21 @@ class generate_addpt_functions():
         csv_filepath = check_folder+"/"+output_filename+'.csv'
         savefile = os.path.join(os.getcwd(), csv_filepath)
 
-        # Check if file exists
-        if os.path.exists(savefile):
+        # Check if file exists for the same counties
+        counties = self.communities[community]['counties']
+        manifest = stage_manifest('obtain_census_block_place_puma_gdf',
+                        params = {'year' : year,
+                                  'counties' : [counties[county]['FIPS Code']
+                                                for county in counties],
+                                  'state' : self.communities[community]['STATE']},
+                        code = [generate_addpt_functions, obtain_join_block_place_puma_data])
+        if stage_cache_hit(check_folder, output_filename, manifest):
             print("File already exists: "+savefile)
-            census_block_place_puma_df = pd.read_csv(savefile)
+            census_block_place_puma_df = read_stage(check_folder, output_filename)
+
+            # GeoParquet keeps the geometry - CSV has WKT geometry
+            if isinstance(census_block_place_puma_df, gpd.GeoDataFrame):
+                return census_block_place_puma_df
 
             # Convert df to gdf
             census_block_place_puma_gdf = df2gdf_WKTgeometry(df = census_block_place_puma_df, 
@@ -158,9 +183,9 @@ class generate_addpt_functions():
             state_caps = self.communities[community]['STATE']
             print(state_county_name,': county FIPS Code',state_county)
 
-            # create output folders for hui data generation
-            outputfolders = directory_design(state_county_name = community,
-                                                outputfolder = self.outputfolder)
+            # County block data is shared by all communities with the county
+            outputfolders = county_directory_design(state_county = state_county,
+                                                    outputfolder = self.outputfolder)
 
             output_folder = outputfolders['CommunitySourceData']
             # Read in Census Block PUMA Place Data
@@ -170,53 +195,51 @@ class generate_addpt_functions():
                                 state = state_caps,
                                 year = year,
                                 output_folder = output_folder,
-                                replace = False)
+                                replace = False,
+                                tiger_folder = outputfolders['TIGERCache'])
             
         # Combine all counties into one dataframe
         census_block_place_puma_gdf = pd.concat(county_df.values(), 
                                     ignore_index=True, axis=0)
         
         #Save results for community name
-        savefile = os.path.join(os.getcwd(), csv_filepath)
-        census_block_place_puma_gdf.to_csv(savefile, index=False)
+        save_stage(census_block_place_puma_gdf, check_folder, output_filename, manifest)
 
         return census_block_place_puma_gdf
 
-    def predict_housingunit_estimate(self,
-                                    community,
-                                    year,
-                                    census_block_place_puma_gdf):
-
-        print("***************")
-        print("Predicting Housing Unit Estimates")
-        print("***************")
-        print("")
-
-        check_folder = self.outputfolder
-        output_filename = f'huest_{self.version_text}_{community}_{year}_{self.bldg_inv_id}'
-        csv_filepath = check_folder+"/"+output_filename+'.csv'
-        savefile = os.path.join(os.getcwd(), csv_filepath)
-        if os.path.exists(savefile):
-            print("Housing Unit Estimate File already exists: "+savefile)
-            huesimate_df = pd.read_csv(savefile)
-            return huesimate_df
-
-
+    def housingunit_estimate_manifest(self, year, census_block_place_puma_gdf):
+        """
+        Stage key for the housing unit estimate.
+        A new building inventory, housing unit inventory or archetypes
+        runs the housing unit estimate again.
+        """
+        return stage_manifest('predict_housingunit_estimate',
+                        params = {'year' : year,
+                                  'bldg_uniqueid' : self.bldg_uniqueid,
+                                  'archetype_var' : self.archetype_var,
+                                  'residential_archetypes' : self.residential_archetypes,
+                                  'building_area_var' : self.building_area_var,
+                                  'building_area_cutoff' : self.building_area_cutoff},
+                        inputs = {'bldg_inv_gdf' : self.bldg_inv_gdf,
+                                  'hui_df' : self.hui_df,
+                                  'census_block_place_puma_gdf' : census_block_place_puma_gdf},
+                        code = [generate_addpt_functions, predict_residential_addresspoints])
+
+    def join_buildings_to_blocks(self, 
+                                 bldg_inv_gdf,
+                                 census_block_place_puma_gdf,
+                                 year):
+        """
+        Census block and place for each building
+        """
         yr = year[2:4]
         # Merge Building Inventory and Census Block Data
         join_column_list = [f'BLOCKID{yr}',f'BLOCKID{yr}_str',
                             f'placeGEOID{yr}',f'placeNAME{yr}']
         geolevel = 'block'
-        
-        # Drop observations where geometry is null
-        # Count number of observations dropped
-        print("Dropping observations where geometry is null")
-        no_geometry = self.bldg_inv_gdf[self.bldg_inv_gdf.geometry.isnull()].shape[0]
-        print("Number of observations dropped: ",no_geometry)
-        self.bldg_inv_gdf = self.bldg_inv_gdf[self.bldg_inv_gdf.geometry.notnull()]
 
         # add representative point to buildings
-        bldg_inv_gdf_point = add_representative_point(self.bldg_inv_gdf,year=year)
+        bldg_inv_gdf_point = add_representative_point(bldg_inv_gdf,year=year)
         building_to_block_gdf = spatial_join_points_to_poly(
                     points_gdf = bldg_inv_gdf_point,
                     polygon_gdf = census_block_place_puma_gdf,
@@ -224,17 +247,22 @@ class generate_addpt_functions():
                     poly_var = f'blk{yr}4326',
                     geolevel = geolevel,
                     join_column_list = join_column_list)
-        
 
-        # Housing unit inventory needs the block string variable
-        self.hui_df[f'BLOCKID{yr}_str'] = \
-                self.hui_df[f'blockid'].\
-                    apply(lambda x : "B"+str(int(x)).zfill(15))
+        return building_to_block_gdf
 
+    def run_housingunit_estimate(self, 
+                                 building_to_block_gdf,
+                                 hui_df,
+                                 year):
+        """
+        Predict the housing units in each building and clean block and place
+        hui_df needs the block string variable BLOCKID{yr}_str
+        """
+        yr = year[2:4]
         # Run Address Point Algorithm
-        huesimate_df = predict_residential_addresspoints(
+        huesimate_df, huesimate_summary = predict_residential_addresspoints(
                         building_to_block_gdf = building_to_block_gdf,
-                        hui_df = self.hui_df,
+                        hui_df = hui_df,
                         hui_blockid = f'BLOCKID{yr}_str',
                         bldg_blockid = f'blockBLOCKID{yr}_str',
                         bldg_uniqueid = self.bldg_uniqueid,
@@ -242,13 +270,13 @@ class generate_addpt_functions():
                         archetype_var = self.archetype_var,
                         residential_archetypes = self.residential_archetypes,
                         building_area_var = self.building_area_var,
-                        building_area_cutoff = self.building_area_cutoff
+                        building_area_cutoff = self.building_area_cutoff,
+                        return_summary = True
                         )
 
-        # Check errors
-        #huesimate_df['apcount'].groupby(huesimate_df['ErrorCheck1_int']).describe()
-        #huesimate_df['apcount'].groupby(huesimate_df['ErrorCheck2_int']).describe()
-        #huesimate_df['apcount'].groupby(huesimate_df['ErrorCheck3_int']).describe()
+        # Check errors - correlation and block error counts by round
+        print("Housing unit estimate by round:")
+        print(huesimate_summary.T.to_string())
 
         # Add Single Family Dummy Variable
         condition1 = (huesimate_df["huestimate"] > 1)
@@ -267,7 +295,7 @@ class generate_addpt_functions():
          # Check if Block ID is missing with filled in values
         condition2 = (huesimate_df[f'blockBLOCKID{yr}_str'].isna())
         huesimate_df.loc[condition2,f'blockplaceNAME{yr}'] = "No Block ID"
-        huesimate_df.loc[condition2,f'blockBLOCKID{yr}_str'] = 'B999999999999999'
+        huesimate_df.loc[condition2,f'blockBLOCKID{yr}_str'] = no_block_id
 
         # Identify Unincorporated Areas with Place Name
         # There are many address points that fall just outside of city limits 
@@ -277,7 +305,53 @@ class generate_addpt_functions():
         huesimate_df.loc[(huesimate_df[f'blockplaceNAME{yr}'].isna()),
                     f'blockplaceNAME{yr}'] = f"Unincorporated"
 
-        huesimate_df.to_csv(savefile, index=False)
+        return huesimate_df
+
+    def predict_housingunit_estimate(self,
+                                    community,
+                                    year,
+                                    census_block_place_puma_gdf):
+
+        print("***************")
+        print("Predicting Housing Unit Estimates")
+        print("***************")
+        print("")
+
+        check_folder = self.outputfolder
+        output_filename = f'huest_{self.version_text}_{community}_{year}_{self.bldg_inv_id}'
+        csv_filepath = check_folder+"/"+output_filename+'.csv'
+        savefile = os.path.join(os.getcwd(), csv_filepath)
+        # A new building inventory, housing unit inventory or archetypes
+        # runs the housing unit estimate again
+        manifest = self.housingunit_estimate_manifest(year, census_block_place_puma_gdf)
+        if stage_cache_hit(check_folder, output_filename, manifest):
+            print("Housing Unit Estimate File already exists: "+savefile)
+            huesimate_df = read_stage(check_folder, output_filename)
+            return huesimate_df
+
+        yr = year[2:4]
+        # Drop observations where geometry is null
+        # Count number of observations dropped
+        print("Dropping observations where geometry is null")
+        no_geometry = self.bldg_inv_gdf[self.bldg_inv_gdf.geometry.isnull()].shape[0]
+        print("Number of observations dropped: ",no_geometry)
+        self.bldg_inv_gdf = self.bldg_inv_gdf[self.bldg_inv_gdf.geometry.notnull()]
+
+        building_to_block_gdf = self.join_buildings_to_blocks(
+                    bldg_inv_gdf = self.bldg_inv_gdf,
+                    census_block_place_puma_gdf = census_block_place_puma_gdf,
+                    year = year)
+
+        # Housing unit inventory needs the block string variable
+        self.hui_df[f'BLOCKID{yr}_str'] = \
+                geokey_index(self.hui_df[f'blockid']).strings('Block', prefix = 'B')
+
+        huesimate_df = self.run_housingunit_estimate(
+                    building_to_block_gdf = building_to_block_gdf,
+                    hui_df = self.hui_df,
+                    year = year)
+
+        save_stage(huesimate_df, check_folder, output_filename, manifest)
 
         return huesimate_df
 
@@ -335,91 +409,33 @@ class generate_addpt_functions():
 
         return dataset_id
 
-    def generate_addpt_v2_for_incore(self):
+    def address_point_manifest(self, year, huesimate_df, census_block_place_puma_gdf):
         """
-        Generate Address Point data for IN-CORE
+        Stage key for the address point inventory
         """
-        print("***************")
-        print("Address Point Inventory Workflow")
-        print("***************")
-        print("")
-
-        # set year
-        year = str(self.year)
-        
-        # Set community
-        community = self.community
-        title = "Address Point Inventory v2.0.0 data for "+community + " " + str(year)
-        print("Generating",title)
-        output_filename = f'addpt_{self.version_text}_{community}_{year}_{self.bldg_inv_id}'
-        csv_filepath = self.outputfolder+"/"+output_filename+'.csv'
-        savefile = os.path.join(os.getcwd(), csv_filepath)
-
-        if self.use_incore:
-            # Functions from IN-CORE
-            from pyncoda.ncoda_06d_INCOREDataService import return_dataservice_id
-
-            # Check if file exists on IN-CORE
-            dataset_id = return_dataservice_id(title, output_filename)
-
-            # if dataset_id is not None, return id
-            if dataset_id is not None:
-                print("Dataset already exists on IN-CORE, use dataset_id:",dataset_id)
-                return dataset_id
-
-        # Workflow for generating Address Point Inventory data for IN-CORE
-        census_block_place_puma_gdf = \
-            self.obtain_census_block_place_puma_gdf(community = community, 
-                                                    year = year)
-
-        huesimate_df = \
-            self.predict_housingunit_estimate(community = community,
-                                            year = year,
-                                            census_block_place_puma_gdf = census_block_place_puma_gdf)
-
-        # make a county list for community
-        county_list = ''
-        for county in self.communities[community]['counties'].keys():
-            state_county = self.communities[community]['counties'][county]['FIPS Code']
-            state_county_name  = self.communities[community]['counties'][county]['Name']
-            print(state_county_name,': county FIPS Code',state_county)
-            county_list = county_list + state_county_name+': county FIPS Code '+state_county
-
-            # Check if file exists on local drive
-        if os.path.exists(savefile):
-            # If using IN-CORE
-            if self.use_incore:
-                print("File already exists on local drive but "+
-                    "not on incore dataservice: "
-                    +savefile)
-                # upload file to INCORE dataservice
-                dataset_id_final = self.upload_addpt_file_to_incore(
-                    title = title,
-                    county_list = county_list,
-                    csv_filepath = csv_filepath,
-                    output_filename = output_filename)
-                
-                if dataset_id_final == "No Dataset ID":
-                    print("Could not upload file to INCORE")
-                    print("dataset_id is set to the dataframe")
-                    # Read in csv as dataframe
-                    address_point_df = pd.read_csv(csv_filepath, low_memory=False)
-                    return address_point_df
-                
-                return dataset_id_final
-            else:
-                print("File already exists on local drive: "+savefile)
-                # Read in csv as dataframe
-                address_point_df = pd.read_csv(csv_filepath, low_memory=False)
-                return address_point_df
-
+        return stage_manifest('generate_addpt_v2_for_incore',
+                        params = {'year' : year,
+                                  'bldg_uniqueid' : self.bldg_uniqueid},
+                        inputs = {'huesimate_df' : huesimate_df,
+                                  'census_block_place_puma_gdf' : census_block_place_puma_gdf,
+                                  'hui_df' : self.hui_df[['blockid','huid']]},
+                        code = [generate_addpt_functions])
+
+    def build_address_points(self,
+                             huesimate_df,
+                             census_block_place_puma_gdf,
+                             hui_df,
+                             bldg_inv_gdf):
         """
         Convert the Building inventory into a list of address points
-
+        hui_df and census_block_place_puma_gdf can be a subset of blocks
+        - address point ids only depend on the buildings and housing
+        units in the same block.
         """
 
         # Set up census block place puma gdf for merge
-        select_cols = ['BLOCKID10_str','BLOCKID10','geometry','rppnt104269']
+        # Geometry is not copied to each address point - see point_xy_table
+        select_cols = ['BLOCKID10_str','BLOCKID10']
         census_blocks_df_cols = census_block_place_puma_gdf[select_cols].copy(deep=True)
 
         # Set up housing unit estimate file for merge
@@ -429,7 +445,7 @@ class generate_addpt_functions():
         # Look at address point count by block
         hui_blockid = 'blockid'
         bldg_blockid = 'BLOCKID10'
-        hua_block_counts = self.hui_df[[hui_blockid,'huid']].groupby(hui_blockid).agg('count')
+        hua_block_counts = hui_df[[hui_blockid,'huid']].groupby(hui_blockid).agg('count')
         hua_block_counts.reset_index(inplace = True)
         hua_block_counts = hua_block_counts.\
             rename(columns={'huid': "tothupoints", hui_blockid : bldg_blockid })
@@ -438,14 +454,16 @@ class generate_addpt_functions():
         print("Total number of expected housing unit address points in county:",hua_apcount)
 
         # Check to make sure that bldg_blockid is a string in both dataframes
-        if not isinstance(census_blocks_df_cols[bldg_blockid][0], str):
+        if (len(census_blocks_df_cols) > 0) and \
+            not isinstance(census_blocks_df_cols[bldg_blockid].iloc[0], str):
             print("Converting Census Block Dataframe block id to string")
             try:
                 census_blocks_df_cols[bldg_blockid] = census_blocks_df_cols[bldg_blockid].astype(str)
             except:
                 print("Could not convert block id to string")
                 return None
-        if not isinstance(hua_block_counts[bldg_blockid][0], str):
+        if (len(hua_block_counts) > 0) and \
+            not isinstance(hua_block_counts[bldg_blockid].iloc[0], str):
             print("Converting HU Block Counts Dataframe block id to string")
             try:
                 hua_block_counts[bldg_blockid] = hua_block_counts[bldg_blockid].astype(str)
@@ -491,23 +509,6 @@ class generate_addpt_functions():
         ### Expand var cannot be missing
         huesimate_df_cols.loc[(huesimate_df_cols.expandvar.isna(),'expandvar')] = 1
 
-        # The address point inventory is the expanded housing unit estimate dataframe
-        # code to expand dataframe using .repeat() method
-        huesimate_df_cols_expand = huesimate_df_cols.reindex(
-            huesimate_df_cols.index.repeat(huesimate_df_cols['expandvar']))
-        
-        # Expand Residential Address Point Count File
-        ## Using the count of address point variable expand residential address point count file
-        # The expand variable can not have missing values
-        census_blocks_df_cols.loc[(census_blocks_df_cols['tothupoints'].isna()) \
-            ,'expandvar'] = 0
-        census_blocks_df_cols.loc[(census_blocks_df_cols['tothupoints']>=0),\
-            'expandvar'] = census_blocks_df_cols['tothupoints']
-
-        # Expand data using repeat method
-        census_blocks_df_cols_expand = census_blocks_df_cols.reindex(
-            census_blocks_df_cols.index.repeat(census_blocks_df_cols['expandvar']))
-
         ## Merge Two Address Point Files
         '''
         Combing the address points based on building inventory and 
@@ -519,33 +520,19 @@ class generate_addpt_functions():
         The combined file will also help to show the populations 
         impacted both inside the study community and in neighboring areas.
 
-        To merge the two files need to add a counter to each file by blockid.
-        '''
-        # Add counter by block id - use cumulative count method
-        census_blocks_df_cols_expand['blockidcounter'] = \
-            census_blocks_df_cols_expand.groupby('BLOCKID10').cumcount()
-
-        # Add counter by block id - use cumulative count method
-        huesimate_df_cols_expand['blockidcounter'] = \
-            huesimate_df_cols_expand.groupby('blockBLOCKID10_str').cumcount()
-
-        # Merge 2 files based on blockid and blockid counter - 
-        # keep all observations from both files with full outer join
-        address_point_inventory = pd.merge(left = huesimate_df_cols_expand, 
-                                        right = census_blocks_df_cols_expand,
-                                        left_on=['blockBLOCKID10_str','blockidcounter'], 
-                                        right_on=['BLOCKID10_str','blockidcounter'], how='outer')
-
-        '''
-        # Check merge - examples were Building Id is missing
-        displaycols = [self.bldg_uniqueid,'BLOCKID10']
-        condition = address_point_inventory[self.bldg_uniqueid].isna()
-        address_point_inventory[displaycols].loc[condition].head()
-        # Check merge - examples were there is no census data
-        displaycols = [self.bldg_uniqueid,'BLOCKID10']
-        condition = address_point_inventory['tothupoints'].isnull()
-        address_point_inventory[displaycols].loc[condition].head()
+        To merge the two files the address points have a counter by blockid.
+        The k-th building address point in a block is merged with the
+        k-th census address point in the block. The counter is made from
+        the buildings before they are expanded, and the census blocks
+        are not expanded.
         '''
+        address_point_inventory = expand_addresspoints(
+                                        building_df = huesimate_df_cols,
+                                        block_df = census_blocks_df_cols,
+                                        building_blockid = 'blockBLOCKID10_str',
+                                        block_blockid = 'BLOCKID10_str',
+                                        building_count = 'expandvar',
+                                        block_count = 'tothupoints')
 
         # Fix issue with missing blockid vs BLOCKID10
         address_point_inventory.loc[address_point_inventory.BLOCKID10_str.isna(),
@@ -558,16 +545,12 @@ class generate_addpt_functions():
         building but in cases where the building id is missing 
         then the address point is based on the Census Block ID.
         '''
-        address_point_inventory.loc[(address_point_inventory[self.bldg_uniqueid].isna()),
-            'strctid'] = address_point_inventory.\
-            apply(lambda x: "C"+ str(x['BLOCKID10_str']).zfill(36), axis=1)
-        address_point_inventory.loc[(address_point_inventory[self.bldg_uniqueid].notna()),
-            'strctid'] = address_point_inventory.\
-            apply(lambda x: "ST"+ str(x[self.bldg_uniqueid]).zfill(36), axis=1)
-
-        # Sort Address Points by The first part of the address point 
-        address_point_inventory.sort_values(by=['strctid'])
-        # Add Counter by Building
+        address_point_inventory['strctid'] = np.where(
+            address_point_inventory[self.bldg_uniqueid].isna(),
+            "C" + address_point_inventory['BLOCKID10_str'].astype(str).str.zfill(36),
+            "ST" + address_point_inventory[self.bldg_uniqueid].astype(str).str.zfill(36))
+
+        # Add Counter by Building - address points are in block id and counter order
         address_point_inventory['apcounter'] = address_point_inventory.groupby('strctid').cumcount()
 
         '''
@@ -576,8 +559,8 @@ class generate_addpt_functions():
         Within each Building or Census Block the counter variable provides a way to 
         identify address points within a block.
         '''
-        address_point_inventory['addrptid'] = address_point_inventory.apply(lambda x: x['strctid'] + "AP" +
-                                                                str(int(x['apcounter'])).zfill(6), axis=1)
+        address_point_inventory['addrptid'] = address_point_inventory['strctid'] + "AP" + \
+            address_point_inventory['apcounter'].astype(str).str.zfill(6)
         # Move Primary Key Column to first Column
         cols = ['addrptid']  + [col for col in address_point_inventory if col != 'addrptid']
         address_point_inventory = address_point_inventory[cols]
@@ -616,18 +599,29 @@ class generate_addpt_functions():
 
         If there is a building representative point use the building representative point
         If there building data is missing use the representative point from the census block
+
+        The address points do not carry a copy of the geometry. 
+        X and Y are looked up in side tables with one row for 
+        each building and each census block.
         '''
-        # Merge self.bldg_uniqueid and geometry from building inventory to address point inventory
-        address_point_inventory_geo = pd.merge(left = address_point_inventory,
-                                            right = self.bldg_inv_gdf[[self.bldg_uniqueid,'geometry']],
-                                            left_on=[self.bldg_uniqueid],
-                                            right_on=[self.bldg_uniqueid], 
-                                            how='left')
-        # Rename geometry column to block geometry
-        address_point_inventory_geo.rename(columns={'geometry_x':'block10_geometry'}, inplace=True)
-
-        # Rename geometry column to building geometry
-        address_point_inventory_geo.rename(columns={'geometry_y':'building_geometry'}, inplace=True)
+        address_point_inventory_geo = address_point_inventory
+        building_xy = point_xy_table(df = bldg_inv_gdf,
+                                     keyvar = self.bldg_uniqueid,
+                                     geometryvar = 'geometry')
+        block_xy = point_xy_table(df = census_block_place_puma_gdf,
+                                  keyvar = 'BLOCKID10_str',
+                                  geometryvar = 'rppnt104269')
+        # The default geometry is the building representative point
+        address_point_xy = building_xy.reindex(
+            address_point_inventory_geo[self.bldg_uniqueid]).to_numpy()
+        # When the building representative point is missing use the Census Block Representative Point
+        # Only address points merged with a census block have a census block point
+        block_point_xy = block_xy.reindex(address_point_inventory_geo['BLOCKID10_str'].\
+            where(address_point_inventory_geo['tothupoints'].notna())).to_numpy()
+        missing_building_point = np.isnan(address_point_xy[:,0])
+        address_point_xy[missing_building_point] = block_point_xy[missing_building_point]
+        address_point_inventory_geo['x'] = address_point_xy[:,0]
+        address_point_inventory_geo['y'] = address_point_xy[:,1]
 
         ### Identify Residential Address Points
         '''
@@ -657,8 +651,7 @@ class generate_addpt_functions():
         ## Create block id variable from substring of BLOCKID10_str
         address_point_inventory_geo['blockid'] = address_point_inventory_geo['BLOCKID10_str'].str[1:16]
         select_cols = ['addrptid','strctid',self.bldg_uniqueid,'blockid','BLOCKID10_str',
-            'building_geometry','block10_geometry','rppnt104269',
-            'huestimate','residential','bldgobs','flag_ap']
+            'huestimate','residential','bldgobs','flag_ap','x','y']
         address_point_inventory_cols = address_point_inventory_geo[select_cols].copy(deep=True)
 
         ### Merge Address Point inventory with Building and Census Data
@@ -671,7 +664,7 @@ class generate_addpt_functions():
         '''
         # Keep columns for merge
         merge_cols = [self.bldg_uniqueid,self.archetype_var]
-        building_df_merge_cols = self.bldg_inv_gdf[merge_cols]
+        building_df_merge_cols = bldg_inv_gdf[merge_cols]
 
         # merge selected columns from building inventory to address point inventory
         address_point_inventory_cols_bldg = pd.merge(
@@ -710,46 +703,22 @@ class generate_addpt_functions():
 
         ### Save Work as CSV
         '''
-        A CSV file with the Well Known Text (WKT) geometry provides flexibility for saving and working with files.
+        To be consistent with previous address point inventories
+        the X and Y variables are the last columns.
         '''
         # Move Foreign Key Columns Block ID State, County, Tract to first Columns
         first_columns = ['addrptid',self.bldg_uniqueid,'strctid','blockid','placeGEOID10','placeNAME10','COUNTYFP10']
-        cols = first_columns + [col for col in address_point_inventory_cols_bldg_block if col not in first_columns]
+        last_columns = ['x','y']
+        cols = first_columns + [col for col in address_point_inventory_cols_bldg_block 
+                                if col not in first_columns + last_columns] + last_columns
         address_point_inventory_cols_bldg_block = address_point_inventory_cols_bldg_block[cols]
 
-        #Save results for community name
-        address_point_inventory_cols_bldg_block.to_csv(savefile, index=False)
-
-        # Save second set of files in common directory
-        #common_directory = self.outputfolder+"/../"+output_filename
-        #address_point_inventory_cols_bldg_block.to_csv(common_directory+'.csv', index=False)
-
-        #### Add X Y variables
-        '''
-        To be consistent with previous address point inventories add X and Y variables
-
-        Issue with missing geometries could not be fixed earlier because 
-        data frames were geodataframes. 
-        Now that the data frame is a regular data frame can use geometry columns as string to fix the issue.
-        '''
-        ## read in the address point inventory csv file
-        address_point_df = pd.read_csv(csv_filepath, low_memory=False)
-
-        # Set Address Point Geometry
-        # The default geometry is the building representative point
-        address_point_df['geometry'] = address_point_df['building_geometry']
-        # When the building representative point is missing use the Census Block Representative Point
-        address_point_df.loc[(address_point_df['geometry'].isnull()),'geometry'] = address_point_df['rppnt104269']
-
-        # Convert Data Frame to Geodataframe
-        address_point_gdf = gpd.GeoDataFrame(address_point_df)
+        # Read the address point inventory the same way as the csv file
+        # so the column types are the same as the saved file
+        address_point_df = pd.read_csv(
+            io.StringIO(address_point_inventory_cols_bldg_block.to_csv(index=False)),
+            low_memory=False)
 
-        address_point_gdf['geometry'] = address_point_gdf['geometry'].apply(lambda x: loads(x))
-
-        # Add X and Y variables
-        address_point_gdf['x'] = address_point_gdf['geometry'].x
-        address_point_gdf['y'] = address_point_gdf['geometry'].y
-        
         ### ISSUE - There are buildings on the edge of the county
         '''
         These observations do not geocode inside the county boundary.
@@ -763,39 +732,357 @@ class generate_addpt_functions():
         
 
         # Set observations outside of the county to with filled in values
-        condition1 = (address_point_gdf['COUNTYFP10'].isna())
-        address_point_gdf.loc[condition1,'COUNTYFP10'] = 999
-        address_point_gdf.loc[condition1,'placeNAME10'] = "Outside County"
-        address_point_gdf.loc[condition1,'blockid'] = 999999999999999
-        address_point_gdf.loc[condition1,'BLOCKID10_str'] = 'B999999999999999'
+        condition1 = (address_point_df['COUNTYFP10'].isna())
+        address_point_df.loc[condition1,'COUNTYFP10'] = 999
+        address_point_df.loc[condition1,'placeNAME10'] = "Outside County"
+        address_point_df.loc[condition1,'blockid'] = 999999999999999
+        address_point_df.loc[condition1,'BLOCKID10_str'] = no_block_id
         # Check if placeGEOID10 is missing
-        condition1 = (address_point_gdf['placeGEOID10'].isna())
-        address_point_gdf.loc[condition1,'placeGEOID10'] = 9999999
+        condition1 = (address_point_df['placeGEOID10'].isna())
+        address_point_df.loc[condition1,'placeGEOID10'] = 9999999
 
         # Check if Block ID is missing with filled in values
-        condition2 = (address_point_gdf['blockid'].isna())
-        address_point_gdf.loc[condition2,'COUNTYFP10'] = 999
-        address_point_gdf.loc[condition2,'placeNAME10'] = "No Block ID"
-        address_point_gdf.loc[condition2,'blockid'] = 999999999999999
-        address_point_gdf.loc[condition2,'BLOCKID10_str'] = 'B999999999999999'
+        condition2 = (address_point_df['blockid'].isna())
+        address_point_df.loc[condition2,'COUNTYFP10'] = 999
+        address_point_df.loc[condition2,'placeNAME10'] = "No Block ID"
+        address_point_df.loc[condition2,'blockid'] = 999999999999999
+        address_point_df.loc[condition2,'BLOCKID10_str'] = no_block_id
 
 
         # Remove .0 from data
-        address_point_gdfv2 = address_point_gdf.\
-            applymap(lambda cell: int(cell) if str(cell).endswith('.0') else cell)
+        address_point_dfv2 = whole_numbers_to_int(address_point_df, datastructure = None)
         
         # Check if blockid is 15 characters long and a string
-        varid_max = max(address_point_gdf.blockid)      
+        varid_max = max(address_point_df.blockid)      
         print("Longest Block ID:",varid_max)
-        varid_min = min(address_point_gdf.blockid)      
+        varid_min = min(address_point_df.blockid)      
         print("Shortest Block ID:",varid_max)
 
-        # drop columns not needed for analysis
-        address_point_gdfv2.drop(['geometry','building_geometry','block10_geometry','rppnt104269'], \
-            axis=1, inplace=True)
+        return address_point_dfv2
+
+    def building_state_manifest(self, year, census_block_place_puma_gdf):
+        """
+        Stage key for the building state - the inputs other than the
+        building inventory that the housing unit estimate and address
+        points use. The address points for a previous building inventory
+        can only be updated if these are the same.
+        """
+        return stage_manifest('building_state',
+                        params = {'year' : year,
+                                  'bldg_uniqueid' : self.bldg_uniqueid,
+                                  'archetype_var' : self.archetype_var,
+                                  'residential_archetypes' : self.residential_archetypes,
+                                  'building_area_var' : self.building_area_var,
+                                  'building_area_cutoff' : self.building_area_cutoff},
+                        inputs = {'hui_df' : self.hui_df[['blockid','huid']],
+                                  'census_block_place_puma_gdf' : census_block_place_puma_gdf},
+                        code = [generate_addpt_functions, predict_residential_addresspoints])
+
+    def building_state(self, bldg_inv_gdf):
+        """
+        Building id and a hash of the columns used by the housing unit estimate
+        """
+        hash_cols = list(dict.fromkeys(['geometry',self.archetype_var,self.building_area_var]))
+        bldg_inv_gdf = bldg_inv_gdf[bldg_inv_gdf.geometry.notnull()]
+        building_state_df = pd.DataFrame({
+                self.bldg_uniqueid : bldg_inv_gdf[self.bldg_uniqueid].to_numpy(),
+                'bldghash' : row_hashes(bldg_inv_gdf, hash_cols).to_numpy()})
+
+        return building_state_df
+
+    def save_building_state(self, community, year, census_block_place_puma_gdf,
+                            building_state_df = None):
+        """
+        Save the building state for the next incremental update
+        """
+        output_filename = f'bldgstate_{self.version_text}_{community}_{year}_{self.bldg_inv_id}'
+        manifest = self.building_state_manifest(year, census_block_place_puma_gdf)
+        if building_state_df is None:
+            building_state_df = self.building_state(self.bldg_inv_gdf)
+        save_stage(building_state_df, self.outputfolder, output_filename, manifest)
+
+        return building_state_df
+
+    def update_addpt_for_changed_buildings(self,
+                                           community,
+                                           year,
+                                           census_block_place_puma_gdf):
+        """
+        Update the housing unit estimate and address points for the blocks
+        with added, removed or changed buildings.
+
+        Uses the housing unit estimate, address points and building state
+        for the previous building inventory. The housing unit estimate
+        and address point ids only depend on the buildings and housing 
+        units in the same block, so the address points in the other 
+        blocks are kept and their addrptid does not change.
+        The updated files are saved with the stage manifest for the 
+        current building inventory - the workflow then reads them 
+        from the stage cache.
+
+        Returns False if there is no previous output to update.
+        """
+        print("***************")
+        print("Updating Address Points for Changed Buildings")
+        print("***************")
+        print("")
+
+        yr = year[2:4]
+        check_folder = self.outputfolder
+        uniqueid = self.bldg_uniqueid
+        bldg_blockid = f'blockBLOCKID{yr}_str'
+        placename_var = f'blockplaceNAME{yr}'
+        previous_text = f'{self.version_text}_{community}_{year}_{self.previous_bldg_inv_id}'
+        current_text = f'{self.version_text}_{community}_{year}_{self.bldg_inv_id}'
+        previous_addpt_filepath = check_folder+"/addpt_"+previous_text+'.csv'
+
+        # The previous output needs to use the same housing units, 
+        # census blocks, parameters and code
+        state_manifest = self.building_state_manifest(year, census_block_place_puma_gdf)
+        if not (stage_cache_hit(check_folder, 'bldgstate_'+previous_text, state_manifest) and
+                checkpoint_exists(check_folder, 'huest_'+previous_text) and
+                os.path.exists(previous_addpt_filepath)):
+            print("No address points to update for building inventory",
+                  self.previous_bldg_inv_id,"- running all blocks")
+            return False
+
+        previous_state_df = read_checkpoint(check_folder, 'bldgstate_'+previous_text)
+        previous_huesimate_df = read_checkpoint(check_folder, 'huest_'+previous_text)
+        # x and y are not changed for the address points that are kept
+        previous_address_point_df = pd.read_csv(previous_addpt_filepath, low_memory=False,
+                                                float_precision = 'round_trip')
+
+        # Compare building ids and hashes with the previous building inventory
+        # Building ids have the same type as the ids in the checkpoints -
+        # legacy checkpoints have string ids
+        bldg_inv_gdf = self.bldg_inv_gdf[self.bldg_inv_gdf.geometry.notnull()].copy()
+        if previous_state_df[uniqueid].dtype == object:
+            bldg_inv_gdf[uniqueid] = apply_schema(pd.DataFrame(bldg_inv_gdf[[uniqueid]]),
+                                                  {uniqueid : str})[uniqueid]
+        building_state_df = self.building_state(bldg_inv_gdf)
+        state_df = pd.merge(building_state_df, previous_state_df,
+                            on = uniqueid,
+                            how = 'outer',
+                            suffixes = ('','_previous'),
+                            indicator = True)
+        changed = (state_df['bldghash'] != state_df['bldghash_previous'])
+        changed_ids = state_df.loc[changed, uniqueid]
+        print("Buildings added:",(state_df['_merge'] == 'left_only').sum())
+        print("Buildings removed:",(state_df['_merge'] == 'right_only').sum())
+        print("Buildings changed:",(changed & (state_df['_merge'] == 'both')).sum())
+
+        # Blocks of the removed and changed buildings in the previous inventory
+        changed_blocks = set(previous_huesimate_df.loc[
+            previous_huesimate_df[uniqueid].isin(changed_ids), bldg_blockid])
+        # Blocks of the added and changed buildings in the new inventory
+        changed_bldg_inv_gdf = bldg_inv_gdf[bldg_inv_gdf[uniqueid].isin(changed_ids)].copy()
+        block_place_cols = [uniqueid, bldg_blockid, placename_var]
+        block_place_df = previous_huesimate_df[block_place_cols].iloc[0:0]
+        if len(changed_bldg_inv_gdf) > 0:
+            building_to_block_gdf = self.join_buildings_to_blocks(
+                    bldg_inv_gdf = changed_bldg_inv_gdf,
+                    census_block_place_puma_gdf = census_block_place_puma_gdf,
+                    year = year)
+            # Join columns are missing if no building is in a block
+            block_place_df = pd.DataFrame(building_to_block_gdf).reindex(columns = block_place_cols)
+            changed_blocks.update(block_place_df[bldg_blockid].fillna(no_block_id))
+        self.changed_blocks = sorted(changed_blocks)
+        print("Blocks to update:",len(self.changed_blocks))
+
+        huest_manifest = self.housingunit_estimate_manifest(year, census_block_place_puma_gdf)
+        huesimate_df = previous_huesimate_df.loc[
+            ~previous_huesimate_df[bldg_blockid].isin(changed_blocks)]
+        address_point_df = previous_address_point_df
+        if len(changed_blocks) > 0:
+            # Buildings that did not change use the previous block and place
+            unchanged_block_place_df = previous_huesimate_df.loc[
+                previous_huesimate_df[bldg_blockid].isin(changed_blocks) &
+                previous_huesimate_df[uniqueid].notna() &
+                ~previous_huesimate_df[uniqueid].isin(changed_ids), block_place_cols].copy()
+            no_block = (unchanged_block_place_df[bldg_blockid] == no_block_id)
+            unchanged_block_place_df.loc[no_block, [bldg_blockid, placename_var]] = np.nan
+            block_place_df = pd.concat([unchanged_block_place_df, block_place_df],
+                                       ignore_index = True)
+
+            # Buildings in the changed blocks in building inventory order
+            bldg_cols = list(dict.fromkeys([uniqueid,self.archetype_var,self.building_area_var]))
+            building_to_block_df = pd.DataFrame(bldg_inv_gdf.loc[
+                bldg_inv_gdf[uniqueid].isin(block_place_df[uniqueid]), bldg_cols])
+            building_to_block_df = pd.merge(building_to_block_df, block_place_df,
+                                            on = uniqueid,
+                                            how = 'left')
+
+            # Housing units in the changed blocks
+            hui_df = self.hui_df[['blockid','huid']].copy(deep=True)
+            hui_df[f'BLOCKID{yr}_str'] = \
+                geokey_index(hui_df['blockid']).strings('Block', prefix = 'B')
+            hui_df = hui_df.loc[hui_df[f'BLOCKID{yr}_str'].isin(changed_blocks)]
+
+            changed_huesimate_df = self.run_housingunit_estimate(
+                    building_to_block_gdf = building_to_block_df,
+                    hui_df = hui_df,
+                    year = year)
+            huesimate_df = pd.concat([huesimate_df, changed_huesimate_df],
+                                     ignore_index = True)
+
+            # Address points for the changed blocks
+            changed_census_gdf = census_block_place_puma_gdf.loc[
+                census_block_place_puma_gdf[f'BLOCKID{yr}_str'].isin(changed_blocks)].\
+                reset_index(drop = True)
+            changed_address_point_df = self.build_address_points(
+                    huesimate_df = changed_huesimate_df,
+                    census_block_place_puma_gdf = changed_census_gdf,
+                    hui_df = hui_df,
+                    bldg_inv_gdf = bldg_inv_gdf)
+            if changed_address_point_df is None:
+                return False
+
+            # Replace the address points in the changed blocks.
+            # Address points without a building that are outside the
+            # county are not in a changed block.
+            outside_county = (previous_address_point_df[f'BLOCKID{yr}_str'] == no_block_id) & \
+                (previous_address_point_df[uniqueid].isna())
+            keep = ~previous_address_point_df[f'BLOCKID{yr}_str'].isin(changed_blocks) | \
+                outside_county
+            address_point_df = pd.concat([previous_address_point_df.loc[keep],
+                                          changed_address_point_df],
+                                         ignore_index = True)
+            address_point_df = address_point_df[previous_address_point_df.columns]
+
+        # Same row order as running all blocks - block id order.
+        # Address points without a building were sorted by the block id 
+        # in strctid before blocks outside the county were set to no_block_id.
+        huesimate_df = huesimate_df.sort_values(bldg_blockid, kind = 'mergesort',
+                                                ignore_index = True)
+        for col, dtype in previous_huesimate_df.dtypes.items():
+            if (dtype.kind == 'i') and huesimate_df[col].notna().all():
+                huesimate_df[col] = huesimate_df[col].astype(dtype)
+        sort_key = address_point_df[f'BLOCKID{yr}_str'].where(
+            address_point_df[uniqueid].notna(),
+            address_point_df['strctid'].str[1:].str.lstrip('0'))
+        address_point_df = address_point_df.iloc[
+            np.argsort(sort_key.to_numpy(dtype = str), kind = 'stable')].\
+            reset_index(drop = True)
+        address_point_df = whole_numbers_to_int(address_point_df, datastructure = None)
+
+        # Save with the stage manifests for the current building inventory
+        save_stage(huesimate_df, check_folder, 'huest_'+current_text, huest_manifest)
+        addpt_manifest = self.address_point_manifest(year, huesimate_df, census_block_place_puma_gdf)
+        addpt_filepath = os.path.join(os.getcwd(), check_folder+"/addpt_"+current_text+'.csv')
+        address_point_df.to_csv(addpt_filepath, index=False)
+        save_stage_manifest(check_folder, 'addpt_'+current_text, addpt_manifest, addpt_filepath)
+        self.save_building_state(community, year, census_block_place_puma_gdf,
+                                 building_state_df = building_state_df)
+
+        return True
+
+    def generate_addpt_v2_for_incore(self):
+        """
+        Generate Address Point data for IN-CORE
+        """
+        print("***************")
+        print("Address Point Inventory Workflow")
+        print("***************")
+        print("")
+
+        # set year
+        year = str(self.year)
         
-        # Resave results for community name
-        address_point_gdfv2.to_csv(savefile, index=False)
+        # Set community
+        community = self.community
+        title = "Address Point Inventory v2.0.0 data for "+community + " " + str(year)
+        print("Generating",title)
+        output_filename = f'addpt_{self.version_text}_{community}_{year}_{self.bldg_inv_id}'
+        csv_filepath = self.outputfolder+"/"+output_filename+'.csv'
+        savefile = os.path.join(os.getcwd(), csv_filepath)
+
+        if self.use_incore:
+            # Functions from IN-CORE
+            from pyncoda.ncoda_06d_INCOREDataService import return_dataservice_id
+
+            # Check if file exists on IN-CORE
+            dataset_id = return_dataservice_id(title, output_filename)
+
+            # if dataset_id is not None, return id
+            if dataset_id is not None:
+                print("Dataset already exists on IN-CORE, use dataset_id:",dataset_id)
+                return dataset_id
+
+        # Workflow for generating Address Point Inventory data for IN-CORE
+        census_block_place_puma_gdf = \
+            self.obtain_census_block_place_puma_gdf(community = community, 
+                                                    year = year)
+
+        # Update the blocks with changed buildings if the previous 
+        # building inventory has address points
+        if self.incremental:
+            huest_manifest = self.housingunit_estimate_manifest(year, census_block_place_puma_gdf)
+            if not stage_cache_hit(self.outputfolder, 
+                    f'huest_{self.version_text}_{community}_{year}_{self.bldg_inv_id}',
+                    huest_manifest):
+                self.update_addpt_for_changed_buildings(community = community,
+                                            year = year,
+                                            census_block_place_puma_gdf = census_block_place_puma_gdf)
+
+        huesimate_df = \
+            self.predict_housingunit_estimate(community = community,
+                                            year = year,
+                                            census_block_place_puma_gdf = census_block_place_puma_gdf)
+
+        # make a county list for community
+        county_list = ''
+        for county in self.communities[community]['counties'].keys():
+            state_county = self.communities[community]['counties'][county]['FIPS Code']
+            state_county_name  = self.communities[community]['counties'][county]['Name']
+            print(state_county_name,': county FIPS Code',state_county)
+            county_list = county_list + state_county_name+': county FIPS Code '+state_county
+
+        # Check if file exists on local drive for the same inputs
+        manifest = self.address_point_manifest(year, huesimate_df, census_block_place_puma_gdf)
+        if stage_cache_hit(self.outputfolder, output_filename, manifest):
+            if self.incremental and not stage_cache_hit(self.outputfolder,
+                    f'bldgstate_{self.version_text}_{community}_{year}_{self.bldg_inv_id}',
+                    self.building_state_manifest(year, census_block_place_puma_gdf)):
+                self.save_building_state(community, year, census_block_place_puma_gdf)
+            # If using IN-CORE
+            if self.use_incore:
+                print("File already exists on local drive but "+
+                    "not on incore dataservice: "
+                    +savefile)
+                # upload file to INCORE dataservice
+                dataset_id_final = self.upload_addpt_file_to_incore(
+                    title = title,
+                    county_list = county_list,
+                    csv_filepath = csv_filepath,
+                    output_filename = output_filename)
+                
+                if dataset_id_final == "No Dataset ID":
+                    print("Could not upload file to INCORE")
+                    print("dataset_id is set to the dataframe")
+                    # Read in csv as dataframe
+                    address_point_df = pd.read_csv(csv_filepath, low_memory=False)
+                    return address_point_df
+                
+                return dataset_id_final
+            else:
+                print("File already exists on local drive: "+savefile)
+                # Read in csv as dataframe
+                address_point_df = pd.read_csv(csv_filepath, low_memory=False)
+                return address_point_df
+
+        address_point_dfv2 = self.build_address_points(
+                    huesimate_df = huesimate_df,
+                    census_block_place_puma_gdf = census_block_place_puma_gdf,
+                    hui_df = self.hui_df,
+                    bldg_inv_gdf = self.bldg_inv_gdf)
+        if address_point_dfv2 is None:
+            return None
+
+        # Save results for community name
+        address_point_dfv2.to_csv(savefile, index=False)
+        save_stage_manifest(self.outputfolder, output_filename, manifest, savefile)
+        if self.incremental:
+            self.save_building_state(community, year, census_block_place_puma_gdf)
 
         # If using IN-CORE
         if self.use_incore:
@@ -810,10 +1097,10 @@ class generate_addpt_functions():
             if dataset_id_final == "No Dataset ID":
                 print("Could not upload file to INCORE")
                 print("dataset_id is the dataframe")
-                return address_point_gdfv2
+                return address_point_dfv2
         else:
             print("Not using IN-CORE. Dataset_id is the dataframe")
-            return address_point_gdfv2
+            return address_point_dfv2
 
         return dataset_id_final
 
@@ -21,6 +21,7 @@ from pyncoda.ncoda_00b_directory_design import directory_design
 from pyncoda \
      import ncoda_00c_save_output_log as logfile
 from pyncoda.ncoda_00e_geoutilities import *
+from pyncoda.ncoda_00k_geokeys import geokey_index
 
 # Load in data structure dictionaries
 from pyncoda.CommunitySourceData.api_census_gov.acg_00a_general_datastructures import *
@@ -30,12 +31,19 @@ from pyncoda.CommunitySourceData.api_census_gov.acg_00e_incore_huiv2 \
 # open, read, and execute python program with reusable commands
 from pyncoda.CommunitySourceData.api_census_gov.acg_02a_add_categorical_char \
      import add_new_char_by_random_merge_2dfs
+from pyncoda.ncoda_07g_hua_allocation_engine import hua_allocation_engine
+from pyncoda.ncoda_00l_stagecache import stage_manifest, stage_cache_hit, \
+    save_stage_manifest
 
 
 class hua_workflow_functions():
     """
     Function runs full process for generating the housing unit inventories
     Process runs for 1 county.
+
+    hua_engine: "randommerge" (default) runs the cascade as a series of
+        add_new_char_by_random_merge_2dfs merges.
+        "allocation" runs the same cascade in one pass with hua_allocation_engine.
     """
 
     def __init__(self,
@@ -53,7 +61,8 @@ class hua_workflow_functions():
             outputfolder: str ="",
             outputfolders = {},
             savefiles: bool = True,
-            use_incore: bool = True):
+            use_incore: bool = True,
+            hua_engine: str = 'randommerge'):
 
         self.community = community
         self.hui_df = hui_df
@@ -70,6 +79,7 @@ class hua_workflow_functions():
         self.outputfolders = outputfolders
         self.savefiles = savefiles
         self.use_incore = use_incore
+        self.hua_engine = hua_engine
 
 
     def save_environment_version_details(self):
@@ -259,6 +269,28 @@ class hua_workflow_functions():
         addpt_intersect_hui_df = self.check_addpt_predictownershp(addpt_intersect_hui_df)
         hui_intersect_addpt_df = self.check_hui_ownershp(hui_intersect_addpt_df)
 
+        if self.hua_engine == 'allocation':
+            hua_engine = hua_allocation_engine(
+                    hui_df = hui_intersect_addpt_df,
+                    addpt_df = addpt_intersect_hui_df,
+                    seed = self.seed,
+                    new_char = 'strctid',
+                    extra_vars = ['addrptid',self.bldg_uniqueid,'huestimate','huicounter_addpt','placeNAME10','x','y'],
+                    fillna_value= '-999',
+                    geovintage = "2010")
+            hua_allocation_df = hua_engine.run_allocation()
+
+            if self.savefiles == True:
+                summary_filepath = self.outputfolders['RandomMerge']+"/"+output_filename+'_summary.csv'
+                hua_allocation_df['summary'].to_csv(summary_filepath, index=False)
+                print("Allocation summary saved:",summary_filepath)
+
+            # Stop log file
+            if savelog == True:
+                logfile.stop()
+
+            return hua_allocation_df
+
         for huicounter in ['huicounter1','huicounter2','huicounter3']:
             for ownershp in ['ownershp1','ownershp2','ownershp3']:
 
@@ -443,7 +475,18 @@ class hua_workflow_functions():
         output_filename = f'hua_{self.version_text}_{self.community}_{self.basevintage}_{self.bldg_inv_id}_rs{self.seed}'
         csv_filepath = self.outputfolders['top']+"/"+output_filename+'.csv'
         savefile = os.path.join(os.getcwd(), csv_filepath)
-        if os.path.exists(savefile):
+        manifest = stage_manifest('housing_unit_allocation_workflow',
+                        params = {'seed' : self.seed,
+                                  'bldg_uniqueid' : self.bldg_uniqueid,
+                                  'archetype_var' : self.archetype_var,
+                                  'hua_engine' : self.hua_engine},
+                        inputs = {'hui_df' : self.hui_df,
+                                  'addpt_df' : self.addpt_df,
+                                  'bldg_gdf' : self.bldg_gdf[[self.bldg_uniqueid,
+                                                self.archetype_var,'geometry']]},
+                        code = [hua_workflow_functions, hua_allocation_engine,
+                                add_new_char_by_random_merge_2dfs])
+        if stage_cache_hit(self.outputfolders['top'], output_filename, manifest):
             print("Housing Unit Allocation file already exists: "+savefile)
             huav2_df = pd.read_csv(csv_filepath, low_memory=False)
             # Convert df to gdf
@@ -481,7 +524,7 @@ class hua_workflow_functions():
         # Convert Block2010 to string
         # fill in missing values
         huav2_gdf['Block2010'] = huav2_gdf['Block2010'].fillna(999999999999999)
-        huav2_gdf['Block2010'] = huav2_gdf['Block2010'].apply(lambda x : str(int(x)).zfill(15))
+        huav2_gdf['Block2010'] = geokey_index(huav2_gdf['Block2010']).strings('Block')
 
         # Drop if geometry is null
         # Count how many obesrvations having missing geometry
@@ -491,6 +534,7 @@ class hua_workflow_functions():
 
         #Save results for community name
         huav2_gdf.to_csv(savefile, index=False)
+        save_stage_manifest(self.outputfolders['top'], output_filename, manifest, savefile)
 
         return huav2_gdf
     
@@ -33,7 +33,8 @@ import os # For saving output to path
 import sys
 
 # open, read, and execute python program with reusable commands
-from pyncoda.ncoda_00b_directory_design import directory_design
+from pyncoda.ncoda_00b_directory_design import directory_design, \
+    county_directory_design
 from pyncoda.CommunitySourceData.api_census_gov.acg_05b_prec_functions \
     import prec_workflow_functions
 
@@ -86,6 +87,10 @@ class generate_prec_functions():
             print("Generating",title)
             output_filename = f'prec_{self.version_text}_{community}_{self.basevintage}_rs{self.seed}'
             county_list = ''
+
+            # create output folders for prec data generation
+            outputfolders = directory_design(state_county_name = community,
+                                                outputfolder = self.outputfolder)
     
             # Workflow for generating prec data for IN-CORE
             for county in self.communities[community]['counties'].keys():
@@ -94,9 +99,10 @@ class generate_prec_functions():
                 print(state_county_name,': county FIPS Code',state_county)
                 county_list = county_list + state_county_name+': county FIPS Code '+state_county
 
-                # create output folders for prec data generation
-                outputfolders = directory_design(state_county_name = community,
-                                                    outputfolder = self.outputfolder)
+                # County results are shared by all communities with the county
+                county_outputfolders = county_directory_design(
+                    state_county = state_county,
+                    outputfolder = self.outputfolder)
                                                     
                 generate_df = prec_workflow_functions(
                     state_county = state_county,
@@ -106,7 +112,7 @@ class generate_prec_functions():
                     version_text = self.version_text,
                     basevintage = self.basevintage,
                     outputfolder = self.outputfolder,
-                    outputfolders = outputfolders)
+                    outputfolders = county_outputfolders)
 
                 # Generate base housing unit inventory
                 prec_county_df[state_county] = generate_df.run_prec_workflow()
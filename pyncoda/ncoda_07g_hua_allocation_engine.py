@@ -0,0 +1,265 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+import numpy as np
+import pandas as pd
+
+# open, read, and execute python program with reusable commands
+from pyncoda.CommunitySourceData.api_census_gov.acg_02a_add_categorical_char \
+     import add_new_char_by_random_merge_2dfs
+
+class hua_allocation_engine():
+    """
+    Housing Unit Allocation in one pass.
+
+    The housing unit inventory (hui) and address point inventory (addpt)
+    are read once. Block and Block Group codes are built once and each round
+    pairs the k-th random housing unit with the k-th random address point
+    within the same group. Allocated housing units and used address points
+    are removed from the pools before the next round.
+
+    The cascade follows hua_workflow_functions.run_hua_functions:
+        1. huicounter1-3 by ownershp1-3 at the Block level
+           with the predicted tenure updated after each counter
+        2. no counter by ownershp1 at the Block level
+        3. no counter and no tenure at the Block level
+        4. repeat 2 and 3 at the Block Group level
+
+    Both dataframes need the columns added by
+    hua_workflow_functions.check_hui_huicounter, check_hui_ownershp,
+    check_addpt_huicounter and check_addpt_predictownershp.
+    """
+
+    def __init__(self,
+            hui_df,
+            addpt_df,
+            seed: int = 9876,
+            hui_primarykey: str = 'huid',
+            addpt_primarykey: str = 'addrptid',
+            hui_blockid: str = 'blockid',
+            addpt_blockid: str = 'blockid',
+            new_char: str = 'strctid',
+            extra_vars: list = ['addrptid','guid','huestimate',
+                                'huicounter_addpt','placeNAME10','x','y'],
+            fillna_value = '-999',
+            geovintage: str = "2010"):
+
+        self.hui_df = hui_df
+        self.addpt_df = addpt_df
+        self.seed = seed
+        self.hui_primarykey = hui_primarykey
+        self.addpt_primarykey = addpt_primarykey
+        self.hui_blockid = hui_blockid
+        self.addpt_blockid = addpt_blockid
+        self.new_char = new_char
+        self.extra_vars = extra_vars
+        self.fillna_value = fillna_value
+        self.geovintage = geovintage
+        self.flag_var = self.new_char+'_flagsetrm'
+
+    @staticmethod
+    def make_blockid_str(blockid):
+        """
+        Block ID as a 15 character zero padded string.
+        Handles block ids read in as integers, floats or strings.
+        """
+        blockid_str = blockid.astype(str).str.replace(r'\.0$', '', regex=True)
+        blockid_str = blockid_str.str.zfill(15)
+        blockid_str[blockid.isna()] = np.nan
+
+        return blockid_str
+
+    @staticmethod
+    def make_rounds():
+        """
+        List of allocation rounds.
+        A round with update_tenure = True updates ownershp1 for the
+        address points after the round is complete.
+        """
+        rounds = []
+        for huicounter in ['huicounter1','huicounter2','huicounter3']:
+            for ownershp in ['ownershp1','ownershp2','ownershp3']:
+                rounds.append({'geolevel' : 'Block',
+                               'common_group_vars' : [huicounter, ownershp],
+                               'update_tenure' : ownershp == 'ownershp3'})
+        for geolevel in ['Block','BlockGroup']:
+            rounds.append({'geolevel' : geolevel,
+                           'common_group_vars' : ['ownershp1'],
+                           'update_tenure' : False})
+            rounds.append({'geolevel' : geolevel,
+                           'common_group_vars' : [],
+                           'update_tenure' : False})
+
+        return rounds
+
+    def update_predictownershp(self, hu_ownershp, hu_addpt_row,
+                               addpt_struct_codes, addpt_ownershp1):
+        """
+        Array version of hua_workflow_functions.update_addpt_predictownershp.
+        Average tenure of the housing units allocated to each structure
+        updates the predicted tenure of the address points in the structure.
+        """
+        allocated = (hu_addpt_row >= 0) & ~np.isnan(hu_ownershp)
+        allocated[allocated] = addpt_struct_codes[hu_addpt_row[allocated]] >= 0
+        hu_struct = addpt_struct_codes[hu_addpt_row[allocated]]
+        n_struct = addpt_struct_codes.max(initial=-1) + 1
+        ownershp_sum = np.bincount(hu_struct, weights=hu_ownershp[allocated],
+                                   minlength=n_struct)
+        ownershp_count = np.bincount(hu_struct, minlength=n_struct)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            struct_mean = ownershp_sum / ownershp_count
+        predictownershp = np.where(addpt_struct_codes >= 0,
+                                   struct_mean[addpt_struct_codes], np.nan)
+
+        updated = addpt_ownershp1.copy()
+        condition = (predictownershp != updated) & ~np.isnan(predictownershp) & \
+            (updated == 1)
+        updated[condition] = predictownershp[condition]
+
+        # Check ownership is 1 or 2
+        updated[updated > 2] = 2
+        updated[(updated > 1) & (updated < 2)] = 1
+        updated[updated < 1] = -777
+
+        return updated
+
+    def run_allocation(self, rounds = None):
+        """
+        Run all allocation rounds.
+        Returns dictionary with primary (hui with allocated address point),
+        secondary (address points with flag) and summary (one row per round).
+        """
+        if rounds is None:
+            rounds = self.make_rounds()
+
+        hui_df = self.hui_df.reset_index(drop=True).copy()
+        addpt_df = self.addpt_df.reset_index(drop=True).copy()
+        length_hui = hui_df.shape[0]
+        length_addpt = addpt_df.shape[0]
+
+        print("\n***************************************")
+        print("    Housing unit allocation for",length_hui,"housing units and",
+              length_addpt,"address points.")
+        print("***************************************\n")
+
+        # Geography codes shared by both inventories - built once
+        block_str = pd.concat([self.make_blockid_str(hui_df[self.hui_blockid]),
+                               self.make_blockid_str(addpt_df[self.addpt_blockid])],
+                              ignore_index=True)
+        geo_codes = {}
+        geo_codes['Block'] = add_new_char_by_random_merge_2dfs.sort_codes(block_str.values)
+        geo_codes['BlockGroup'] = add_new_char_by_random_merge_2dfs.sort_codes(
+            block_str.str[:12].values)
+        missing_geo = block_str.isna().values
+        hui_df['Block'+self.geovintage] = block_str.values[:length_hui]
+        addpt_df['Block'+self.geovintage] = block_str.values[length_hui:]
+
+        # Random numbers are drawn in primary key order
+        hui_rank = add_new_char_by_random_merge_2dfs.sort_codes(
+            hui_df[self.hui_primarykey].values)
+        addpt_rank = add_new_char_by_random_merge_2dfs.sort_codes(
+            addpt_df[self.addpt_primarykey].values)
+
+        # Structure codes for tenure update
+        addpt_struct_codes = pd.factorize(addpt_df[self.new_char])[0]
+        hu_ownershp = pd.to_numeric(hui_df['ownershp'].astype(object),
+                                    errors='coerce').values.astype(float)
+        addpt_ownershp1 = addpt_df['ownershp1'].values.astype(float)
+
+        # Pools - allocated housing units and used address points
+        hu_addpt_row = np.full(length_hui, -1, dtype=np.int64)
+        hu_round = np.zeros(length_hui, dtype=np.int64)
+        addpt_round = np.zeros(length_addpt, dtype=np.int64)
+
+        summary = []
+        for round_number, round_options in enumerate(rounds, start=1):
+            geolevel = round_options['geolevel']
+            common_group_vars = round_options['common_group_vars']
+
+            # Values for the group by variables
+            var_values = []
+            for var in common_group_vars:
+                if var == 'ownershp1':
+                    addpt_values = pd.Series(addpt_ownershp1)
+                else:
+                    addpt_values = addpt_df[var].reset_index(drop=True)
+                var_values.append(pd.concat([hui_df[var].reset_index(drop=True),
+                                             addpt_values], ignore_index=True))
+
+            # Rows still in the pools with all group by variables
+            eligible = ~missing_geo.copy()
+            for values in var_values:
+                eligible &= values.notna().values
+            hu_eligible = np.flatnonzero(eligible[:length_hui] & (hu_addpt_row < 0))
+            addpt_eligible = np.flatnonzero(eligible[length_hui:] & (addpt_round == 0))
+
+            # Encode group by variables - geography and common group vars
+            code_columns = [geo_codes[geolevel]] + \
+                [add_new_char_by_random_merge_2dfs.sort_codes(values.values)
+                 for values in var_values]
+            all_rows = np.concatenate([hu_eligible, addpt_eligible + length_hui])
+            if all_rows.shape[0] > 0:
+                _, group_codes = np.unique(
+                    np.column_stack([codes[all_rows] for codes in code_columns]),
+                    axis=0, return_inverse=True)
+                group_codes = group_codes.reshape(-1).astype(np.int64)
+            else:
+                group_codes = np.zeros(0, dtype=np.int64)
+            hu_codes = group_codes[:hu_eligible.shape[0]]
+            addpt_codes = group_codes[hu_eligible.shape[0]:]
+
+            # k-th random housing unit is paired with the k-th random address point
+            round_seed = self.seed + round_number
+            hu_mergeorder = add_new_char_by_random_merge_2dfs.random_mergeorder_codes(
+                hui_rank[hu_eligible], hu_codes, round_seed)
+            addpt_mergeorder = add_new_char_by_random_merge_2dfs.random_mergeorder_codes(
+                addpt_rank[addpt_eligible], addpt_codes, round_seed)
+            match = add_new_char_by_random_merge_2dfs.pair_mergeorder(
+                hu_codes, hu_mergeorder, addpt_codes, addpt_mergeorder)
+            matched = match >= 0
+
+            # Remove matched rows from the pools
+            hu_matched = hu_eligible[matched]
+            addpt_matched = addpt_eligible[match[matched]]
+            hu_addpt_row[hu_matched] = addpt_matched
+            hu_round[hu_matched] = round_number
+            addpt_round[addpt_matched] = round_number
+
+            hu_left = int((hu_addpt_row < 0).sum())
+            summary.append({'round' : round_number,
+                    'geolevel' : geolevel,
+                    'common_group_vars' : ', '.join(common_group_vars),
+                    'hu_eligible' : hu_eligible.shape[0],
+                    'addpt_eligible' : addpt_eligible.shape[0],
+                    'matched' : int(matched.sum()),
+                    'hu_left' : hu_left,
+                    'addpt_left' : int((addpt_round == 0).sum()),
+                    'percent_left_to_predict' : hu_left / max(length_hui, 1) * 100})
+
+            if round_options['update_tenure']:
+                addpt_ownershp1 = self.update_predictownershp(hu_ownershp,
+                    hu_addpt_row, addpt_struct_codes, addpt_ownershp1)
+
+            if hu_left == 0:
+                break
+
+        summary_df = pd.DataFrame(summary)
+        print(summary_df.to_string(index=False))
+
+        # Add address point columns to housing units
+        hua_df = hui_df
+        allocated = hu_addpt_row >= 0
+        keep_vars = [self.new_char] + [var for var in self.extra_vars
+                                       if var in addpt_df.columns]
+        for var in keep_vars:
+            hua_df[var] = addpt_df[var].reindex(hu_addpt_row).values
+        hua_df[self.new_char] = hua_df[self.new_char].where(allocated, self.fillna_value)
+        hua_df[self.flag_var] = hu_round
+
+        addpt_df['ownershp1'] = addpt_ownershp1
+        addpt_df[self.flag_var] = addpt_round
+
+        return {'primary' : hua_df, 'secondary' : addpt_df, 'summary' : summary_df}
@@ -24,6 +24,11 @@ class process_community_workflow():
     1. Housing Unit Inventory
     2. Address Point Inventory
     3. Housing Unit Allocation
+
+    Optional building_inventory settings in the community dictionary:
+    incremental and previous_id - update the address points for the
+        previous building inventory
+    hua_engine - randommerge (default) or allocation
     """
 
     def __init__(self,
@@ -159,6 +164,9 @@ class process_community_workflow():
         bldg_inv_id = community_dict['building_inventory']['id']
         bldg_uniqueid = community_dict['building_inventory']['bldg_uniqueid']
         use_incore = community_dict['building_inventory']['use_incore']
+        # Optional - update the address points for the previous building inventory
+        incremental = community_dict['building_inventory'].get('incremental', False)
+        previous_bldg_inv_id = community_dict['building_inventory'].get('previous_id', None)
 
         print("Generate Address point inventory for: "+community)
         print("Based on building inventory: "+bldg_inv_id)
@@ -178,7 +186,9 @@ class process_community_workflow():
                             version_text=   self.version_text,
                             basevintage=    self.basevintage,
                             outputfolder=   self.outputfolder,
-                            use_incore=     use_incore
+                            use_incore=     use_incore,
+                            incremental=    incremental,
+                            previous_bldg_inv_id = previous_bldg_inv_id
                             )
 
         addpt_dataset_id = generate_addpt_df.generate_addpt_v2_for_incore()
@@ -229,6 +239,8 @@ class process_community_workflow():
 
         archetype_var = community_dict['building_inventory']['archetype_var']
         use_incore = community_dict['building_inventory']['use_incore']
+        # Optional - randommerge or allocation, see hua_workflow_functions
+        hua_engine = community_dict['building_inventory'].get('hua_engine', 'randommerge')
 
         print("Housing Unit Allocation for: "+community)
         print("Based on building inventory: "+bldg_inv_id)
@@ -247,7 +259,8 @@ class process_community_workflow():
                                 basevintage=    self.basevintage,
                                 outputfolder=   self.outputfolder,
                                 outputfolders = outputfolders,
-                                use_incore=     use_incore
+                                use_incore=     use_incore,
+                                hua_engine =    hua_engine
                                 )
 
         hua_gdf = run_hua_gdf.housing_unit_allocation_workflow()
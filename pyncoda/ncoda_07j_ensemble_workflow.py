@@ -0,0 +1,440 @@
+# Copyright (c) 2021 Nathanael Rosenheim. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the Mozilla Public License v2.0 which accompanies this distribution,
+# and is available at https://www.mozilla.org/en-US/MPL/2.0/
+
+"""
+Multi-seed ensemble of the Housing Unit Inventory and Housing Unit Allocation.
+
+The random merges that add household income to the housing unit inventory
+and the allocation of housing units to address points depend on the seed.
+The Census API data, the address point inventory and the building inventory
+do not. The ensemble reads the inputs once and runs the seed dependent
+stages for each seed on a pool of worker processes.
+
+Outputs are saved in the Uncertainty_propagation folder:
+    _base        housing unit inventory columns that do not change by seed
+    _assignments one column for each seed and assignment variable,
+                 for example incomegroup_rs1000, strctid_rs1000
+    _summary     statistics for each seed and across seeds
+
+Each seed saves a checkpoint when it finishes. If the run is interrupted,
+running the ensemble again skips the finished seeds.
+
+Example:
+    ensemble = ensemble_workflow_functions(
+                    communities = communities,
+                    community = 'Lumberton_NC',
+                    seeds = range(1000, 1100),
+                    outputfolder = 'OutputData',
+                    max_workers = 16)
+    ensemble_output = ensemble.run_ensemble(addpt_df = addpt_inv_df,
+                    bldg_inv_id = bldg_inv_id,
+                    bldg_uniqueid = 'guid')
+"""
+
+import os
+import io
+import time
+import pickle
+import contextlib
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from pyncoda.ncoda_00b_directory_design import directory_design, \
+    county_directory_design
+from pyncoda.ncoda_00j_checkpoint import checkpoint_exists, read_checkpoint, \
+    save_checkpoint, remove_checkpoint
+from pyncoda.CommunitySourceData.api_census_gov.acg_05a_hui_functions \
+    import hui_workflow_functions
+from pyncoda.ncoda_07d_run_hua_workflow import hua_workflow_functions
+
+# Inputs shared by all seeds in a worker process
+shared_inputs = {}
+
+def init_worker(shared_inputs_filepath = None):
+    """
+    Load shared inputs once for each worker process
+    """
+    if (shared_inputs_filepath is not None) and (len(shared_inputs) == 0):
+        with open(shared_inputs_filepath, 'rb') as shared_file:
+            shared_inputs.update(pickle.load(shared_file))
+
+def seed_checkpoint_name(ensemble_filename, seed):
+    """
+    Checkpoint with the assignments for one seed
+    """
+    return ensemble_filename+'_rs'+str(seed)
+
+def run_seed_stages(seed):
+    """
+    Random merge household income and allocate housing units for one seed.
+    Returns the housing unit inventory with the assignment variables.
+    """
+    settings = shared_inputs['settings']
+    hui_county_df = {}
+    for state_county, county_inputs in shared_inputs['hui_inputs'].items():
+        generate_df = hui_workflow_functions(
+            state_county = state_county,
+            state_county_name = county_inputs['state_county_name'],
+            seed = seed,
+            version = settings['version'],
+            version_text = settings['version_text'],
+            basevintage = settings['basevintage'],
+            outputfolder = settings['outputfolder'],
+            outputfolders = shared_inputs['outputfolders'],
+            savefiles = False,
+            merge_engine = settings['merge_engine'])
+        block_income_df = generate_df.random_merge_hui_inputs(
+            county_inputs['block_df'], county_inputs['tract_df'])
+        hui_df = generate_df.try_polish(block_income_df['primary'])
+        # IN-CORE columns only - the ensemble saves the seed checkpoint
+        hui_county_df[state_county] = generate_df.save_incore_version2(hui_df,
+                                                        savecsv = False)
+    hui_df = pd.concat(hui_county_df.values(), ignore_index=True, axis=0)
+
+    if shared_inputs.get('addpt_df') is not None:
+        run_hua = hua_workflow_functions(
+            community = settings['community'],
+            hui_df = hui_df,
+            addpt_df = shared_inputs['addpt_df'],
+            bldg_gdf = None,
+            bldg_inv_id = settings['bldg_inv_id'],
+            bldg_uniqueid = settings['bldg_uniqueid'],
+            seed = seed,
+            version = settings['version'],
+            version_text = settings['version_text'],
+            basevintage = settings['basevintage'],
+            outputfolder = settings['outputfolder'],
+            outputfolders = shared_inputs['outputfolders'],
+            savefiles = False,
+            use_incore = False,
+            hua_engine = 'allocation')
+        hua_df = run_hua.run_hua_functions(savelog = False)['primary']
+        hua_vars = [var for var in settings['hua_assignment_vars']
+                    if var in hua_df.columns]
+        hui_df = pd.merge(left = hui_df.drop(columns = hua_vars, errors = 'ignore'),
+                          right = hua_df[['huid'] + hua_vars],
+                          on = 'huid', how = 'left', validate = '1:1')
+
+    return hui_df
+
+def seed_assignment_vars(settings):
+    """
+    Variables saved for each seed - the assignment variables and the
+    variables merged in from the housing unit allocation
+    """
+    assignment_vars = list(settings['assignment_vars'])
+    for var in settings['hua_assignment_vars']:
+        if var not in assignment_vars:
+            assignment_vars.append(var)
+    return assignment_vars
+
+def run_seed_task(seed, save_base = False):
+    """
+    Run the seed dependent stages and save the assignment variables
+    """
+    settings = shared_inputs['settings']
+    start_time = time.time()
+    if settings['quiet']:
+        with contextlib.redirect_stdout(io.StringIO()):
+            hui_df = run_seed_stages(seed)
+    else:
+        hui_df = run_seed_stages(seed)
+
+    assignment_vars = [var for var in seed_assignment_vars(settings)
+                       if var in hui_df.columns]
+    folder = settings['ensemble_folder']
+    ensemble_filename = settings['ensemble_filename']
+    if save_base:
+        base_df = hui_df.drop(columns = assignment_vars)
+        save_checkpoint(base_df, folder, ensemble_filename+'_base')
+    save_checkpoint(hui_df[['huid'] + assignment_vars], folder,
+                    seed_checkpoint_name(ensemble_filename, seed))
+
+    return seed, time.time() - start_time
+
+class ensemble_workflow_functions():
+    """
+    Run the seed dependent stages of the housing unit inventory and
+    housing unit allocation for many seeds.
+
+    seeds: list of random seeds
+    assignment_vars: variables that change by seed - saved for each seed
+        with the housing unit allocation variables (strctid, addrptid
+        and the building unique id)
+    merge_engine: random merge engine - numpy gives the same result as
+        pandas and is faster
+    max_workers: number of worker processes - default os.cpu_count()
+        1 runs the seeds in this process
+    start_method: multiprocessing start method - default fork if available
+    quiet: hide the output of the worker processes
+    """
+
+    def __init__(self,
+            communities,
+            community: str,
+            seeds = range(1000, 1100),
+            version: str = '2.0.0',
+            version_text: str = 'v2-0-0',
+            basevintage: str = 2010,
+            outputfolder: str = "OutputData",
+            assignment_vars: list = ['incomegroup','hhinc','randincome','poverty',
+                                     'strctid','addrptid'],
+            merge_engine: str = 'numpy',
+            max_workers: int = None,
+            start_method: str = None,
+            quiet: bool = True):
+
+        self.communities = communities
+        self.community = community
+        self.seeds = [int(seed) for seed in seeds]
+        self.version = version
+        self.version_text = version_text
+        self.basevintage = basevintage
+        self.outputfolder = outputfolder
+        self.assignment_vars = assignment_vars
+        self.merge_engine = merge_engine
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        self.max_workers = max_workers
+        if start_method is None:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                start_method = 'fork'
+            else:
+                start_method = 'spawn'
+        self.start_method = start_method
+        self.quiet = quiet
+
+        self.outputfolders = directory_design(state_county_name = community,
+                                              outputfolder = outputfolder)
+        self.ensemble_folder = self.outputfolders['Uncertainty_propagation']
+        self.ensemble_filename = f'ensemble_{self.version_text}_{self.community}_'+\
+            f'{self.basevintage}_rs{self.seeds[0]}-{self.seeds[-1]}'
+
+    def load_hui_inputs(self):
+        """
+        Census API inputs for each county - read once for all seeds.
+        Uses the county folders shared with the other communities.
+        """
+        hui_inputs = {}
+        counties = self.communities[self.community]['counties']
+        for county in counties.keys():
+            state_county = counties[county]['FIPS Code']
+            state_county_name = counties[county]['Name']
+            print(state_county_name,': county FIPS Code',state_county)
+            generate_df = hui_workflow_functions(
+                state_county = state_county,
+                state_county_name = state_county_name,
+                version = self.version,
+                version_text = self.version_text,
+                basevintage = self.basevintage,
+                outputfolder = self.outputfolder,
+                outputfolders = county_directory_design(
+                    state_county = state_county,
+                    outputfolder = self.outputfolder))
+            block_df, tract_df = generate_df.load_hui_inputs()
+            # Only the last block inventory is used by the random merge
+            hui_inputs[state_county] = {'state_county_name' : state_county_name,
+                                        'block_df' : {'hispan' : block_df['hispan']},
+                                        'tract_df' : tract_df}
+
+        return hui_inputs
+
+    def run_seeds(self, seeds, save_base_seed):
+        """
+        Run seeds on the worker processes.
+        Returns dictionary with the run time of each finished seed.
+        """
+        run_time = {}
+        if len(seeds) == 0:
+            return run_time
+
+        if self.max_workers <= 1:
+            for seed in seeds:
+                try:
+                    seed, run_time[seed] = run_seed_task(seed, seed == save_base_seed)
+                except Exception as e:
+                    print("Seed",seed,"failed:",e)
+            return run_time
+
+        shared_inputs_filepath = None
+        if self.start_method != 'fork':
+            shared_inputs_filepath = os.path.join(self.ensemble_folder,
+                self.ensemble_filename+'_inputs.pkl')
+            with open(shared_inputs_filepath, 'wb') as shared_file:
+                pickle.dump(shared_inputs, shared_file, protocol = pickle.HIGHEST_PROTOCOL)
+
+        start_time = time.time()
+        mp_context = multiprocessing.get_context(self.start_method)
+        with concurrent.futures.ProcessPoolExecutor(max_workers = self.max_workers,
+                                                    mp_context = mp_context,
+                                                    initializer = init_worker,
+                                                    initargs = (shared_inputs_filepath,)) as executor:
+            pending = {executor.submit(run_seed_task, seed, seed == save_base_seed) : seed
+                       for seed in seeds}
+            try:
+                for future in concurrent.futures.as_completed(pending):
+                    seed = pending[future]
+                    try:
+                        seed, run_time[seed] = future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        # Worker was killed - rerun to resume from checkpoints
+                        raise
+                    except Exception as e:
+                        print("Seed",seed,"failed:",e)
+                    print("Ensemble:",len(run_time),"of",len(seeds),"seeds finished after",
+                          round(time.time() - start_time, 1),"seconds.")
+            except KeyboardInterrupt:
+                print("Ensemble interrupted - finished seeds are saved.")
+                executor.shutdown(wait = False, cancel_futures = True)
+                raise
+
+        if shared_inputs_filepath is not None:
+            os.remove(shared_inputs_filepath)
+
+        return run_time
+
+    def combine_seeds(self, seeds):
+        """
+        One column for each seed and assignment variable in the same row
+        order as the base table
+        """
+        base_df = read_checkpoint(self.ensemble_folder, self.ensemble_filename+'_base')
+        assignment_columns = {}
+        for seed in seeds:
+            seed_df = read_checkpoint(self.ensemble_folder,
+                        seed_checkpoint_name(self.ensemble_filename, seed))
+            seed_df = seed_df.set_index('huid').reindex(base_df['huid'])
+            for var in seed_df.columns:
+                assignment_columns[f'{var}_rs{seed}'] = seed_df[var].to_numpy()
+        assignments_df = pd.DataFrame(assignment_columns)
+        assignments_df.insert(0, 'huid', base_df['huid'].to_numpy())
+
+        return base_df, assignments_df
+
+    @staticmethod
+    def ensemble_summary(assignments_df, seeds, fillna_values = ['-999', -999]):
+        """
+        Statistics for each assignment variable and seed with the mean,
+        standard deviation, minimum and maximum across seeds.
+        Numeric variables: mean, 10th, 50th and 90th percentile
+        Other variables: number of units assigned and unique values
+        """
+        seed_stats = {}
+        for seed in seeds:
+            suffix = f'_rs{seed}'
+            stats = {}
+            for col in assignments_df.columns:
+                if not col.endswith(suffix):
+                    continue
+                var = col[:-len(suffix)]
+                values = assignments_df[col]
+                assigned = values.notnull() & ~values.isin(fillna_values)
+                stats[(var, 'assigned')] = assigned.sum()
+                if pd.api.types.is_numeric_dtype(values):
+                    stats[(var, 'mean')] = values[assigned].mean()
+                    for percentile in [10, 50, 90]:
+                        stats[(var, f'p{percentile}')] = \
+                            values[assigned].quantile(percentile / 100)
+                else:
+                    stats[(var, 'unique')] = values[assigned].nunique()
+            seed_stats[seed] = stats
+
+        summary_df = pd.DataFrame(seed_stats)
+        summary_df.index.names = ['variable','statistic']
+        seed_cols = summary_df.columns
+        summary_df.columns = [f'rs{seed}' for seed in seed_cols]
+        seed_values = summary_df.astype(float)
+        summary_df.insert(0, 'max', seed_values.max(axis=1))
+        summary_df.insert(0, 'min', seed_values.min(axis=1))
+        summary_df.insert(0, 'std', seed_values.std(axis=1))
+        summary_df.insert(0, 'mean', seed_values.mean(axis=1))
+
+        return summary_df.reset_index()
+
+    def run_ensemble(self,
+                     addpt_df = None,
+                     bldg_inv_id: str = '',
+                     bldg_uniqueid: str = 'guid'):
+        """
+        Run all seeds and save base table, assignments and summary.
+        addpt_df: address point inventory - if None only the housing unit
+            inventory stages run
+        Returns dictionary with base, assignments and summary dataframes.
+        """
+        output_names = {key : self.ensemble_filename+'_'+key
+                        for key in ['base','assignments','summary']}
+        if all(checkpoint_exists(self.ensemble_folder, name)
+               for name in output_names.values()):
+            print("Ensemble",self.ensemble_filename,"already exists - reading saved files.")
+            return {key : read_checkpoint(self.ensemble_folder, name)
+                    for key, name in output_names.items()}
+
+        start_time = time.time()
+        print("\n***************************************")
+        print("    Ensemble of",len(self.seeds),"seeds for",self.community)
+        print("***************************************\n")
+
+        # Share inputs with workers
+        shared_inputs.clear()
+        shared_inputs.update({
+            'hui_inputs' : self.load_hui_inputs(),
+            'addpt_df' : addpt_df,
+            'outputfolders' : self.outputfolders,
+            'settings' : {'community' : self.community,
+                          'version' : self.version,
+                          'version_text' : self.version_text,
+                          'basevintage' : self.basevintage,
+                          'outputfolder' : self.outputfolder,
+                          'bldg_inv_id' : bldg_inv_id,
+                          'bldg_uniqueid' : bldg_uniqueid,
+                          'merge_engine' : self.merge_engine,
+                          'assignment_vars' : self.assignment_vars,
+                          'hua_assignment_vars' : ['strctid','addrptid',bldg_uniqueid],
+                          'ensemble_folder' : self.ensemble_folder,
+                          'ensemble_filename' : self.ensemble_filename,
+                          'quiet' : self.quiet}})
+
+        # Skip seeds with a checkpoint
+        seeds_todo = [seed for seed in self.seeds if not checkpoint_exists(
+            self.ensemble_folder, seed_checkpoint_name(self.ensemble_filename, seed))]
+        save_base_seed = None
+        if not checkpoint_exists(self.ensemble_folder, output_names['base']):
+            save_base_seed = self.seeds[0]
+            if save_base_seed not in seeds_todo:
+                seeds_todo.insert(0, save_base_seed)
+        print("Running",len(seeds_todo),"of",len(self.seeds),"seeds on",
+              self.max_workers,"workers.")
+        run_time = self.run_seeds(seeds_todo, save_base_seed)
+
+        finished_seeds = [seed for seed in self.seeds if checkpoint_exists(
+            self.ensemble_folder, seed_checkpoint_name(self.ensemble_filename, seed))]
+        failed_seeds = [seed for seed in self.seeds if seed not in finished_seeds]
+        if (len(failed_seeds) > 0) or \
+            (not checkpoint_exists(self.ensemble_folder, output_names['base'])):
+            print("Seeds not finished:",failed_seeds)
+            print("Run the ensemble again to finish the remaining seeds.")
+            return None
+
+        base_df, assignments_df = self.combine_seeds(finished_seeds)
+        summary_df = self.ensemble_summary(assignments_df, finished_seeds)
+        save_checkpoint(assignments_df, self.ensemble_folder, output_names['assignments'])
+        save_checkpoint(summary_df, self.ensemble_folder, output_names['summary'])
+
+        # Assignments for each seed are in the combined file
+        for seed in finished_seeds:
+            remove_checkpoint(self.ensemble_folder,
+                seed_checkpoint_name(self.ensemble_filename, seed))
+
+        print("\n***************************************")
+        print("    Ensemble of",len(finished_seeds),"seeds finished in",
+              round(time.time() - start_time, 1),"seconds.")
+        if len(run_time) > 0:
+            print("    Average seed run time %6.1f seconds" % np.mean(list(run_time.values())))
+        print("***************************************\n")
+
+        return {'base' : base_df, 'assignments' : assignments_df, 'summary' : summary_df}